@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Microbenchmark for packing and parsing messages full of small events.
+
+Builds messages of close to 64 KB out of small encoded events, then times
+packing them with WriteBuffer, reading them back with ReadBuffer, and the
+full Channel.on_message_received path including event decoding.
+
+Run from the repository root:
+
+    python -m benchmarks.buffers [--message-size 65535]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+# keep pygame's import banner out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from mm.common.codec import EventCodec
+from mm.common.events import AttackEvent, HealEvent, SetTargetEvent
+from mm.common.networking import Channel, ReadBuffer, WriteBuffer
+from mm.common.world import ActorStore
+
+
+def build_events(codec, message_size):
+    events = []
+    size = 0
+    actor_id = 100
+    while True:
+        actor_id += 1
+        for event in (AttackEvent(actor_id, actor_id + 1, 10),
+                      HealEvent(actor_id, 5),
+                      SetTargetEvent(actor_id, actor_id + 1)):
+            # two bytes of length prefix per event
+            size += 2 + len(codec.encode(event))
+            if size > message_size:
+                return events
+            events.append(event)
+
+
+def pack(serialized_events, message_size):
+    writer = WriteBuffer(message_size)
+    for serialized_event in serialized_events:
+        if not writer.write_bytes(serialized_event):
+            raise RuntimeError('Message overflow')
+    return bytes(writer.get_buffer_data())
+
+
+def read_all(message_data):
+    reader = ReadBuffer(message_data)
+    count = 0
+    while reader.can_read():
+        if reader.read_bytes() is None:
+            break
+        count += 1
+    return count
+
+
+def parse(channel, message_data):
+    channel.on_message_received(message_data)
+    return len(list(channel.receive_events()))
+
+
+def time_call(func, min_seconds):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--message-size', type=int, default=65535)
+    parser.add_argument(
+        '--min-seconds', type=float, default=1.,
+        help='time each operation for at least this long')
+    args = parser.parse_args()
+
+    codec = EventCodec(ActorStore('actors.json'))
+    events = build_events(codec, args.message_size)
+    serialized_events = [codec.encode(event) for event in events]
+    message_data = pack(serialized_events, args.message_size)
+
+    channel = Channel(None, codec)
+    if read_all(message_data) != len(events):
+        raise RuntimeError('ReadBuffer lost events')
+    if parse(channel, message_data) != len(events):
+        raise RuntimeError('Channel lost events')
+
+    results = []
+    for name, func in (
+            ('pack', lambda: pack(serialized_events, args.message_size)),
+            ('read', lambda: read_all(message_data)),
+            ('parse_and_decode', lambda: parse(channel, message_data))):
+        seconds = time_call(func, args.min_seconds)
+        results.append({
+            'operation': name,
+            'seconds_per_message': seconds,
+            'ns_per_event': seconds * 1e9 / len(events),
+            'megabytes_per_second': len(message_data) / seconds / 1e6,
+        })
+
+    json.dump({
+        'benchmark': 'buffers',
+        'message_bytes': len(message_data),
+        'events_per_message': len(events),
+        'results': results,
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
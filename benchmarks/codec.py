@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Compare the binary event codec against pickle for full actor states.
+
+The states come from a World, or with --backend numpy from an ArrayWorld,
+whose fields are numpy values. Every event is checked to come out of the
+codec the way it went in.
+
+Run from the repository root:
+
+    python -m benchmarks.codec [--actors 10 100 1000 10000]
+        [--backend python numpy]
+"""
+
+import argparse
+import json
+import math
+import os
+import pickle
+import random
+import sys
+import time
+
+# keep pygame's import banner out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from thirdparty.vec2 import vec2
+
+from mm.common.codec import EventCodec
+from mm.common.events import EventDistributor, EnterGameEvent
+from mm.common.scheduling import Scheduler
+from mm.common.world import World, ActorStore
+
+
+def build_world(actor_store, num_actors, ticks, world_class=World):
+    side = int(math.sqrt(num_actors * 2500.))
+    world = world_class(
+        EventDistributor(), Scheduler(), actor_store, side, side)
+    actor_types = sorted(actor_store.get_all_names())
+    for _ in range(num_actors):
+        world.spawn_actor(
+            random.choice(actor_types),
+            vec2(random.uniform(0, side), random.uniform(0, side)))
+
+    # run a little so targets, timers and health are not all at defaults
+    for _ in range(ticks):
+        world.update(0.1)
+
+    return world
+
+
+def build_event(actor_store, num_actors, ticks, world_class=World):
+    world = build_world(actor_store, num_actors, ticks, world_class)
+    return EnterGameEvent(
+        world.width, world.height, world.get_actor_states())
+
+
+def check_round_trip(codec, event):
+    data = codec.encode(event)
+    decoded = codec.decode(data)
+    if codec.encode(decoded) != data:
+        raise RuntimeError('Codec did not round trip')
+    for state, decoded_state in zip(event.actor_states, decoded.actor_states):
+        if (decoded_state.actor_id != state.actor_id or
+                decoded_state.radius != state.radius or
+                decoded_state.health != state.health):
+            raise RuntimeError(
+                'Actor %d did not round trip' % (state.actor_id,))
+
+
+def time_call(func, arg, min_seconds):
+    # repeat until the total is long enough to time reliably
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func(arg)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / count
+
+
+def measure(name, encode, decode, event, min_seconds):
+    data = encode(event)
+    num_states = max(1, len(event.actor_states))
+    encode_seconds = time_call(encode, event, min_seconds)
+    decode_seconds = time_call(decode, data, min_seconds)
+    return {
+        'format': name,
+        'bytes_per_event': len(data),
+        'bytes_per_actor_state': float(len(data)) / num_states,
+        'encode_ns_per_event': encode_seconds * 1e9,
+        'decode_ns_per_event': decode_seconds * 1e9,
+        'encode_ns_per_actor_state': encode_seconds * 1e9 / num_states,
+        'decode_ns_per_actor_state': decode_seconds * 1e9 / num_states,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--actors', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument(
+        '--backend', choices=('python', 'numpy'), nargs='+',
+        default=['python', 'numpy'])
+    parser.add_argument('--ticks', type=int, default=10)
+    parser.add_argument(
+        '--min-seconds', type=float, default=0.5,
+        help='time each operation for at least this long')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    actor_store = ActorStore('actors.json')
+    codec = EventCodec(actor_store)
+
+    results = []
+    for backend in args.backend:
+        if backend == 'numpy':
+            from mm.common.array_world import ArrayWorld as world_class
+        else:
+            world_class = World
+
+        for num_actors in args.actors:
+            random.seed(args.seed)
+            event = build_event(
+                actor_store, num_actors, args.ticks, world_class)
+            check_round_trip(codec, event)
+            for name, encode, decode in (
+                    ('pickle', pickle.dumps, pickle.loads),
+                    ('codec', codec.encode, codec.decode)):
+                result = measure(
+                    name, encode, decode, event, args.min_seconds)
+                result['actors'] = len(event.actor_states)
+                result['backend'] = backend
+                results.append(result)
+
+    json.dump(
+        {'benchmark': 'codec', 'results': results}, sys.stdout, indent=2,
+        sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
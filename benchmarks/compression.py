@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Compression ratio and CPU cost of the Channel compression schemes.
+
+Records the messages a client would get from a running world, one batch of
+game events and a DeltaStateEvent per tick, and compresses them:
+
+ * message: zlib.compress on every message, as Channel used to.
+ * stream: one zlib stream for the connection, sync flushed per message.
+ * stream_dictionary: the same, primed with a dictionary trained on the
+   traffic of a separate run with another seed.
+
+Both stream schemes skip messages under --min-size bytes. Ratios are
+compressed bytes, including the scheme byte, over uncompressed bytes.
+
+Run from the repository root:
+
+    python -m benchmarks.compression [--actors 50 500]
+        [--write-dictionary res/events.zdict]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+# keep pygame's import banner out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from benchmarks.codec import build_world
+
+from mm.common.codec import EventCodec
+from mm.common.compression import (Compression, COMPRESSION_LEVEL,
+                                   train_dictionary)
+from mm.common.events import ALL_GAME_EVENT_TYPES, DeltaStateEvent
+from mm.common.networking import Channel, pack_events
+from mm.common.world import ActorStore
+
+
+def record_messages(codec, actor_store, num_actors, ticks, seed):
+    random.seed(seed)
+    world = build_world(actor_store, num_actors, 10)
+    world.event_distributor.update()
+
+    events = []
+    world.event_distributor.add_handler(events.append, ALL_GAME_EVENT_TYPES)
+
+    messages = []
+    world.take_actor_deltas()
+    for _ in range(ticks):
+        world.scheduler.update(0.1)
+        world.update(0.1)
+        world.event_distributor.update()
+
+        events.append(DeltaStateEvent(world.take_actor_deltas()))
+        messages.extend(
+            bytes(message_data) for message_data in pack_events(
+                codec, events, Channel.MAX_MESSAGE_SIZE))
+        del events[:]
+
+    return messages
+
+
+def compress_messages(messages):
+    return [zlib.compress(message, COMPRESSION_LEVEL) for message in messages]
+
+
+def decompress_messages(compressed_messages):
+    return [zlib.decompress(data) for data in compressed_messages]
+
+
+def channel_compressor(compression, scheme_offer):
+    def compress(messages):
+        compressor = compression.create_compressor()
+        compressor.on_peer_offer(scheme_offer)
+        return [compressor.compress(message) for message in messages]
+    return compress
+
+
+def channel_decompressor(compression):
+    def decompress(compressed_messages):
+        decompressor = compression.create_decompressor(
+            Channel.MAX_MESSAGE_SIZE)
+        return [decompressor.decompress(data) for data in compressed_messages]
+    return decompress
+
+
+def time_call(func, arg, min_seconds):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        result = func(arg)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return result, elapsed / count
+
+
+def measure(name, compress, decompress, messages, min_seconds):
+    raw_bytes = sum(len(message) for message in messages)
+    compressed, compress_seconds = time_call(compress, messages, min_seconds)
+    decompressed, decompress_seconds = time_call(
+        decompress, compressed, min_seconds)
+    if [bytes(message) for message in decompressed] != messages:
+        raise RuntimeError('%s did not round trip' % (name,))
+
+    compressed_bytes = sum(len(data) for data in compressed)
+    return {
+        'scheme': name,
+        'raw_bytes': raw_bytes,
+        'compressed_bytes': compressed_bytes,
+        'ratio': float(compressed_bytes) / raw_bytes,
+        'compress_ns_per_byte': compress_seconds * 1e9 / raw_bytes,
+        'decompress_ns_per_byte': decompress_seconds * 1e9 / raw_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--actors', type=int, nargs='+', default=[50, 500])
+    parser.add_argument('--ticks', type=int, default=200)
+    parser.add_argument('--min-size', type=int,
+                        default=Compression.DEFAULT_MIN_SIZE)
+    parser.add_argument(
+        '--min-seconds', type=float, default=0.5,
+        help='time each operation for at least this long')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument(
+        '--write-dictionary', metavar='FILENAME',
+        help='save the dictionary trained on the largest actor count')
+    args = parser.parse_args()
+
+    actor_store = ActorStore('actors.json')
+    codec = EventCodec(actor_store)
+
+    results = []
+    dictionary = None
+    for num_actors in args.actors:
+        training_messages = record_messages(
+            codec, actor_store, num_actors, args.ticks, args.seed + 1)
+        dictionary = train_dictionary(training_messages)
+        messages = record_messages(
+            codec, actor_store, num_actors, args.ticks, args.seed)
+
+        stream = Compression(args.min_size)
+        stream_dictionary = Compression(args.min_size, dictionary)
+        for name, compress, decompress in (
+                ('message', compress_messages, decompress_messages),
+                ('stream', channel_compressor(stream, stream.get_offer()),
+                 channel_decompressor(stream)),
+                ('stream_dictionary',
+                 channel_compressor(
+                     stream_dictionary, stream_dictionary.get_offer()),
+                 channel_decompressor(stream_dictionary))):
+            result = measure(
+                name, compress, decompress, messages, args.min_seconds)
+            result['actors'] = num_actors
+            result['messages'] = len(messages)
+            result['bytes_per_message'] = (
+                float(result['raw_bytes']) / len(messages))
+            results.append(result)
+
+    if args.write_dictionary and dictionary:
+        with open(args.write_dictionary, 'wb') as dictionary_file:
+            dictionary_file.write(dictionary)
+
+    json.dump(
+        {'benchmark': 'compression', 'min_size': args.min_size,
+         'results': results}, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Bytes per actor per tick of the DeltaStateEvent stream.
+
+Runs a world and, every tick, encodes the actor state changes three ways:
+pickled full states and codec encoded full states for every actor with
+any changed field, as the server used to send them, and the per-field
+ActorDeltas of World.take_actor_deltas it sends now. Sizes are reported
+before and after zlib compression.
+
+Run from the repository root:
+
+    python -m benchmarks.delta [--actors 100 1000 10000] [--ticks 50]
+"""
+
+import argparse
+import json
+import os
+import pickle
+import random
+import sys
+import zlib
+
+# keep pygame's import banner out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from benchmarks.codec import build_world
+
+from mm.common.codec import EventCodec
+from mm.common.events import EnterGameEvent, DeltaStateEvent
+from mm.common.world import ActorStore
+
+FORMATS = ('pickle_full_states', 'codec_full_states', 'codec_deltas')
+
+
+def get_changed_states(new_states, last_states):
+    changed = []
+    for state in new_states:
+        last_state = last_states.get(state.actor_id)
+        if last_state is None or any(
+                value != last_state.get(key) for key, value in state.items()):
+            changed.append(state)
+    return changed
+
+
+def encode_tick(codec, new_states, last_states, actor_deltas):
+    changed = get_changed_states(new_states, last_states)
+    return {
+        'pickle_full_states': pickle.dumps(
+            DeltaStateEvent(changed), pickle.HIGHEST_PROTOCOL),
+        'codec_full_states': codec.encode(EnterGameEvent(0, 0, changed)),
+        'codec_deltas': codec.encode(DeltaStateEvent(actor_deltas)),
+    }
+
+
+def run(codec, world, ticks, frame_time):
+    raw_bytes = dict.fromkeys(FORMATS, 0)
+    compressed_bytes = dict.fromkeys(FORMATS, 0)
+    actor_ticks = 0
+
+    last_states = dict(
+        (state.actor_id, state) for state in world.get_actor_states())
+    # the warmup changes are not measured
+    world.take_actor_deltas()
+    for _ in range(ticks):
+        world.scheduler.update(frame_time)
+        world.update(frame_time)
+        world.event_distributor.update()
+
+        new_states = world.get_actor_states()
+        actor_deltas = world.take_actor_deltas()
+        for name, data in encode_tick(
+                codec, new_states, last_states, actor_deltas).items():
+            raw_bytes[name] += len(data)
+            compressed_bytes[name] += len(zlib.compress(data))
+        actor_ticks += len(new_states)
+        last_states = dict((state.actor_id, state) for state in new_states)
+
+    actor_ticks = max(1, actor_ticks)
+    results = []
+    for name in FORMATS:
+        results.append({
+            'format': name,
+            'bytes_per_actor_per_tick': float(raw_bytes[name]) / actor_ticks,
+            'compressed_bytes_per_actor_per_tick':
+                float(compressed_bytes[name]) / actor_ticks,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--actors', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--ticks', type=int, default=50)
+    parser.add_argument(
+        '--warmup-ticks', type=int, default=10,
+        help='ticks to run before measuring')
+    parser.add_argument('--tick-rate', type=float, default=10.)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    actor_store = ActorStore('actors.json')
+    codec = EventCodec(actor_store)
+    frame_time = 1. / args.tick_rate
+
+    results = []
+    for num_actors in args.actors:
+        random.seed(args.seed)
+        world = build_world(actor_store, num_actors, args.warmup_ticks)
+
+        format_results = run(codec, world, args.ticks, frame_time)
+        baseline = format_results[1]['bytes_per_actor_per_tick']
+        for result in format_results:
+            result['actors'] = num_actors
+            result['ticks'] = args.ticks
+            result['size_vs_codec_full_states'] = (
+                result['bytes_per_actor_per_tick'] / baseline
+                if baseline else None)
+            results.append(result)
+
+    json.dump(
+        {'benchmark': 'delta', 'results': results}, sys.stdout, indent=2,
+        sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Microbenchmark for EventDistributor dispatch at thousands of events per tick.
+
+Registers the handlers server_main.py does, with handlers that only count
+their calls, and dispatches a tick's worth of mostly game events:
+
+ * list_scan: the old distributor, which checks the event types of every
+   handler for every event.
+ * indexed: EventDistributor.update, looking up the handlers by type.
+ * send_many: EventDistributor.send_many, the same grouped by type.
+
+All three have to make the same handler calls.
+
+Run from the repository root:
+
+    python -m benchmarks.events [--events 1000 5000 20000]
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+# keep pygame's import banner out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from mm.common.events import *
+
+
+class ListScanDistributor(object):
+    """EventDistributor as it was before dispatch was indexed by type."""
+
+    def __init__(self):
+        self.handler_id = 100
+        self.handlers = {}
+        self.queue = []
+
+    def add_handler(self, handler, event_types):
+        if not isinstance(event_types, (list, tuple)):
+            event_types = [event_types]
+
+        self.handler_id += 1
+        self.handlers[self.handler_id] = (handler, event_types)
+        return self.handler_id
+
+    def update(self):
+        q = self.queue
+        self.queue = []
+        for event in q:
+            self.send(event)
+
+    def send(self, event):
+        for (handler, event_types) in self.handlers.values():
+            if type(event) in event_types:
+                handler(event)
+
+    def post(self, event):
+        self.queue.append(event)
+
+
+def add_server_handlers(event_distributor, counts):
+    def counter(name):
+        def handler(event):
+            counts[name] += 1
+        return handler
+
+    # as registered by server_main.py
+    event_distributor.add_handler(counter('debug'), ALL_EVENT_TYPES)
+    event_distributor.add_handler(counter('interest'), ALL_GAME_EVENT_TYPES)
+    event_distributor.add_handler(
+        counter('connected'), ClientConnectedEvent)
+    event_distributor.add_handler(
+        counter('disconnected'), ClientDisconnectedEvent)
+    event_distributor.add_handler(counter('client'), ClientEvent)
+    event_distributor.add_handler(
+        counter('spawn_mob'), PlayerActionSpawnMobEvent)
+
+
+def build_events(num_events, rng):
+    events = []
+    for index in range(num_events):
+        actor_id = 100 + index
+        roll = rng.random()
+        if roll < 0.4:
+            event = SetTargetEvent(actor_id, actor_id + 1)
+        elif roll < 0.7:
+            event = AttackEvent(actor_id, actor_id + 1, 10)
+        elif roll < 0.85:
+            event = HealEvent(actor_id, 5)
+        elif roll < 0.9:
+            event = ActorDiedEvent(actor_id)
+        elif roll < 0.95:
+            event = LootEvent(actor_id, 10)
+        elif roll < 0.98:
+            event = ActorSpawnedEvent(None)
+        else:
+            event = ClientEvent(1, PlayerActionSpawnMobEvent('creep', None))
+        events.append(event)
+    return events
+
+
+def dispatch_update(event_distributor, events):
+    for event in events:
+        event_distributor.post(event)
+    event_distributor.update()
+
+
+def dispatch_send_many(event_distributor, events):
+    event_distributor.send_many(events)
+
+
+def measure(name, distributor_class, dispatch, events, min_seconds):
+    counts = collections.Counter()
+    event_distributor = distributor_class()
+    add_server_handlers(event_distributor, counts)
+
+    # the first tick fills the dispatch cache
+    dispatch(event_distributor, events)
+    calls = dict(counts)
+
+    ticks = 0
+    start = time.perf_counter()
+    while True:
+        dispatch(event_distributor, events)
+        ticks += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            break
+
+    return calls, {
+        'scheme': name,
+        'events': len(events),
+        'tick_ms': 1000. * elapsed / ticks,
+        'ns_per_event': 1e9 * elapsed / (ticks * len(events)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--events', type=int, nargs='+', default=[1000, 5000, 20000],
+        help='events per tick')
+    parser.add_argument(
+        '--min-seconds', type=float, default=0.5,
+        help='time each scheme for at least this long')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    results = []
+    for num_events in args.events:
+        events = build_events(num_events, random.Random(args.seed))
+        expected_calls = None
+        for name, distributor_class, dispatch in (
+                ('list_scan', ListScanDistributor, dispatch_update),
+                ('indexed', EventDistributor, dispatch_update),
+                ('send_many', EventDistributor, dispatch_send_many)):
+            calls, result = measure(
+                name, distributor_class, dispatch, events, args.min_seconds)
+            if expected_calls is None:
+                expected_calls = calls
+            elif calls != expected_calls:
+                raise RuntimeError('%s made different handler calls' % (name,))
+            results.append(result)
+
+    json.dump(
+        {'benchmark': 'events', 'results': results}, sys.stdout, indent=2,
+        sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
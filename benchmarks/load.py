@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""Headless bots putting load on a running server.
+
+Opens --clients connections to a server started with server_main.py, spread
+over --processes worker processes and ramped up over --ramp seconds. Every
+bot sets a viewport, takes in EnterGameEvent and DeltaStateEvent like the
+game client, and sends PlayerActionSpawnMobEvents at --spawn-rate per second,
+at positions picked by --pattern:
+
+ * uniform: anywhere in the world.
+ * hotspot: within --hotspot-radius of the centre of the world, so all
+   bots with the centre in view see all spawns.
+ * local: within the bot's own viewport.
+
+Reported for every bot and summed up over all of them:
+
+ * throughput: bytes and events received per second connected.
+ * decode: the share of time spent reading, decompressing and decoding
+   what the server sent.
+ * spawn latency: time from sending a spawn until its ActorSpawnedEvent
+   comes back, for the spawns inside the bot's own viewport.
+ * state intervals: time between DeltaStateEvents, one tick while the
+   server keeps up. Intervals over --late-factor ticks count as late.
+
+The timeline has the connected bots and the state intervals for every
+second of the run, so it shows the client count at which the server tick
+starts missing its deadline. The server logs its tick overruns too.
+
+Run from the repository root, with the server running:
+
+    python server_main.py &
+    python -m benchmarks.load [--clients 50] [--spawn-rate 1]
+        [--pattern uniform] [--duration 30] [--ramp 10]
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import time
+
+# keep pygame's import banner out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from thirdparty.vec2 import vec2
+
+from mm.common.codec import EventCodec
+from mm.common.compression import Compression
+from mm.common.events import (ActorSpawnedEvent, ClientDisconnectedEvent,
+                              DeltaStateEvent, EnterGameEvent,
+                              EventDistributor, PlayerActionSpawnMobEvent,
+                              SetViewportEvent)
+from mm.common.networking import Client, DEFAULT_NETWORK_PORT
+from mm.common.snapshots import SnapshotClient, create_client_socket
+from mm.common.world import ActorStore
+
+PATTERNS = ('uniform', 'hotspot', 'local')
+
+# positions go over the wire as single precision floats
+FLOAT_PAIR = struct.Struct('!ff')
+
+
+def to_wire_pos(x, y):
+    return FLOAT_PAIR.unpack(FLOAT_PAIR.pack(x, y))
+
+
+class Bot(object):
+    """One connection, updated by run_worker along with the others."""
+
+    def __init__(self, index, args, codec, rng):
+        self.index = index
+        self.args = args
+        self.rng = rng
+
+        self.event_distributor = EventDistributor()
+        self.client = Client(
+            self.event_distributor, codec, Compression(args.min_size))
+        self.snapshots = None
+        if args.snapshots:
+            self.snapshots = SnapshotClient(
+                self.event_distributor, codec, create_client_socket(),
+                args.host)
+
+        self.channel = None
+        self.now = None
+        self.viewport = None
+        self.world_size = None
+        self.next_spawn_time = None
+        # (actor_type, x, y) -> times spawns there were sent
+        self.pending_spawns = {}
+
+        self.connect_time = None
+        self.disconnect_time = None
+        self.event_count = 0
+        self.state_count = 0
+        self.decode_time = 0.
+        self.spawn_count = 0
+        self.latencies = []
+        self.last_state_time = None
+        # (arrival time, interval) of every DeltaStateEvent after the first
+        self.state_intervals = []
+
+        distributor = self.event_distributor
+        distributor.add_handler(self.on_enter_game, EnterGameEvent)
+        distributor.add_handler(self.on_delta_state, DeltaStateEvent)
+        distributor.add_handler(self.on_actor_spawned, ActorSpawnedEvent)
+        distributor.add_handler(
+            self.on_disconnected, ClientDisconnectedEvent)
+
+    def connect(self, now):
+        try:
+            if not self.client.connect(self.args.host, self.args.port):
+                return False
+        except socket.error:
+            return False
+        # kept for its counters once the client disconnects
+        self.channel = self.client.channel
+        self.connect_time = now
+        return True
+
+    def disconnect(self, now):
+        if self.client.is_connected():
+            self.client.disconnect()
+        if self.snapshots:
+            self.snapshots.close()
+        if self.disconnect_time is None:
+            self.disconnect_time = now
+
+    def get_socket(self):
+        return self.client.server_socket
+
+    def update(self, now):
+        client = self.client
+        start = time.perf_counter()
+        client.read_from_server()
+        if self.snapshots:
+            self.snapshots.read_snapshots()
+        self.decode_time += time.perf_counter() - start
+
+        self.now = now
+        self.event_distributor.update()
+
+        if self.next_spawn_time is not None and now >= self.next_spawn_time:
+            self.spawn(now)
+            self.next_spawn_time += 1. / self.args.spawn_rate
+
+        if client.is_connected():
+            client.write_to_server()
+
+    def on_enter_game(self, event):
+        self.event_count += 1
+        args = self.args
+        width = min(args.viewport[0], event.width)
+        height = min(args.viewport[1], event.height)
+        rng = self.rng
+        self.world_size = (event.width, event.height)
+        self.viewport = (
+            rng.randint(0, event.width - width),
+            rng.randint(0, event.height - height), width, height)
+        self.client.send_event(SetViewportEvent(*self.viewport))
+
+        if args.spawn_rate > 0:
+            # bots spawn out of step with each other
+            self.next_spawn_time = (
+                self.now + rng.uniform(0, 1. / args.spawn_rate))
+
+    def on_delta_state(self, event):
+        self.event_count += 1
+        self.state_count += 1
+        now = self.now
+        if self.last_state_time is not None:
+            self.state_intervals.append((now, now - self.last_state_time))
+        self.last_state_time = now
+
+    def on_actor_spawned(self, event):
+        self.event_count += 1
+        state = event.actor_state
+        key = (state.actor_type,) + to_wire_pos(state.pos.x, state.pos.y)
+        send_times = self.pending_spawns.get(key)
+        if send_times:
+            self.latencies.append(self.now - send_times.pop(0))
+            if not send_times:
+                del self.pending_spawns[key]
+
+    def on_disconnected(self, event):
+        self.disconnect_time = self.now
+
+    def pick_position(self):
+        args = self.args
+        rng = self.rng
+        width, height = self.world_size
+        if args.pattern == 'hotspot':
+            angle = rng.uniform(0, 2 * math.pi)
+            distance = args.hotspot_radius * math.sqrt(rng.random())
+            return (width / 2. + distance * math.cos(angle),
+                    height / 2. + distance * math.sin(angle))
+        if args.pattern == 'local':
+            x, y, width, height = self.viewport
+            return x + rng.uniform(0, width), y + rng.uniform(0, height)
+        return rng.uniform(0, width), rng.uniform(0, height)
+
+    def spawn(self, now):
+        x, y = to_wire_pos(*self.pick_position())
+        self.client.send_event(
+            PlayerActionSpawnMobEvent(self.args.actor_type, vec2(x, y)))
+        self.spawn_count += 1
+
+        # only spawns inside the viewport come back to this bot
+        view_x, view_y, width, height = self.viewport
+        if view_x <= x <= view_x + width and view_y <= y <= view_y + height:
+            self.pending_spawns.setdefault(
+                (self.args.actor_type, x, y), []).append(now)
+
+    def get_result(self, end_time):
+        stats = self.channel.get_stats()
+        connected_time = (
+            (self.disconnect_time or end_time) - self.connect_time)
+        return {
+            'bot': self.index,
+            'connect_time': self.connect_time,
+            'disconnect_time': self.disconnect_time,
+            'connected_s': connected_time,
+            'received_bytes': stats.get('received_bytes', 0),
+            'sent_bytes': stats.get('sent_bytes', 0),
+            'events': self.event_count,
+            'states': self.state_count,
+            'decode_s': self.decode_time,
+            'spawns': self.spawn_count,
+            'latencies': self.latencies,
+            'state_intervals': self.state_intervals,
+        }
+
+
+def run_worker(args, indices, start_time):
+    """Run the bots with the given indices until the run is over, and
+    return their results.
+    """
+    actor_store = ActorStore('actors.json')
+    codec = EventCodec(actor_store)
+    end_time = start_time + args.ramp + args.duration
+
+    bots = [
+        Bot(index, args, codec, random.Random(args.seed + index))
+        for index in indices]
+    waiting = list(bots)
+    running = []
+
+    while True:
+        now = time.monotonic()
+        if now >= end_time:
+            break
+
+        # bots connect evenly spread over the ramp
+        while waiting and now >= start_time + (
+                args.ramp * waiting[0].index / args.clients):
+            bot = waiting.pop(0)
+            if bot.connect(now):
+                running.append(bot)
+
+        sockets = [bot.get_socket() for bot in running if bot.get_socket()]
+        if sockets:
+            select.select(sockets, [], [], args.poll_interval)
+        else:
+            time.sleep(args.poll_interval)
+
+        now = time.monotonic()
+        for bot in running:
+            if bot.client.is_connected():
+                bot.update(now)
+
+    now = time.monotonic()
+    results = [bot.get_result(now) for bot in running]
+    for bot in running:
+        bot.disconnect(now)
+    return results
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    count = len(values)
+    return {
+        'count': count,
+        'mean_ms': 1000. * sum(values) / count,
+        'p50_ms': 1000. * values[count // 2],
+        'p99_ms': 1000. * values[min(count - 1, int(count * 0.99))],
+        'max_ms': 1000. * values[-1],
+    }
+
+
+def spread(values):
+    if not values:
+        return None
+    return {
+        'min': min(values),
+        'mean': float(sum(values)) / len(values),
+        'max': max(values),
+    }
+
+
+def summarize_bot(result, late_interval):
+    connected_time = max(result['connected_s'], 1e-9)
+    intervals = [interval for _, interval in result['state_intervals']]
+    return {
+        'bot': result['bot'],
+        'connected_s': result['connected_s'],
+        'disconnected': result['disconnect_time'] is not None,
+        'received_bytes_per_s': result['received_bytes'] / connected_time,
+        'sent_bytes_per_s': result['sent_bytes'] / connected_time,
+        'events_per_s': result['events'] / connected_time,
+        'states_per_s': result['states'] / connected_time,
+        'decode_share': result['decode_s'] / connected_time,
+        'spawns': result['spawns'],
+        'spawn_latency': percentiles(result['latencies']),
+        'state_interval': percentiles(intervals),
+        'late_states': sum(
+            1 for interval in intervals if interval > late_interval),
+    }
+
+
+def build_timeline(results, start_time, late_interval):
+    end_time = max(
+        [result['disconnect_time'] or result['connect_time'] +
+         result['connected_s'] for result in results] + [start_time])
+    seconds = int(math.ceil(end_time - start_time))
+
+    timeline = []
+    for second in range(seconds):
+        begin = start_time + second
+        end = begin + 1.
+        clients = sum(
+            1 for result in results
+            if result['connect_time'] < end and
+            (result['disconnect_time'] is None or
+             result['disconnect_time'] >= begin))
+        intervals = [
+            interval for result in results
+            for arrival, interval in result['state_intervals']
+            if begin <= arrival < end]
+        summary = percentiles(intervals) or {}
+        timeline.append({
+            'second': second,
+            'clients': clients,
+            'states': len(intervals),
+            'state_interval_p99_ms': summary.get('p99_ms'),
+            'state_interval_max_ms': summary.get('max_ms'),
+            'late_states': sum(
+                1 for interval in intervals if interval > late_interval),
+        })
+    return timeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_NETWORK_PORT)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument(
+        '--processes', type=int, default=1,
+        help='worker processes to spread the bots over')
+    parser.add_argument(
+        '--duration', type=float, default=30.,
+        help='seconds to run once all bots are connected')
+    parser.add_argument(
+        '--ramp', type=float, default=10.,
+        help='seconds over which the bots connect')
+    parser.add_argument(
+        '--spawn-rate', type=float, default=1.,
+        help='spawns per second for every bot')
+    parser.add_argument('--pattern', choices=PATTERNS, default='uniform')
+    parser.add_argument('--hotspot-radius', type=float, default=50.)
+    parser.add_argument('--actor-type', default='creep')
+    parser.add_argument(
+        '--viewport', type=int, nargs=2, default=[800, 600],
+        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument(
+        '--snapshots', action='store_true',
+        help='take states over UDP if the server offers snapshots')
+    parser.add_argument('--tick-rate', type=float, default=10.)
+    parser.add_argument(
+        '--late-factor', type=float, default=1.5,
+        help='state intervals over this many ticks count as late')
+    parser.add_argument('--min-size', type=int,
+                        default=Compression.DEFAULT_MIN_SIZE)
+    parser.add_argument('--poll-interval', type=float, default=0.002)
+    parser.add_argument('--per-bot', action='store_true',
+                        help='include the summary of every bot')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # give the workers a moment to start before the first bot connects
+    start_time = time.monotonic() + 0.5
+    processes = max(1, min(args.processes, args.clients))
+    indices = [
+        list(range(worker, args.clients, processes))
+        for worker in range(processes)]
+
+    if processes == 1:
+        results = run_worker(args, indices[0], start_time)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = [
+                result for worker_results in pool.starmap(
+                    run_worker, [(args, worker_indices, start_time)
+                                 for worker_indices in indices])
+                for result in worker_results]
+        finally:
+            pool.close()
+            pool.join()
+
+    late_interval = args.late_factor / args.tick_rate
+    bots = [summarize_bot(result, late_interval) for result in results]
+    late_states = sum(bot['late_states'] for bot in bots)
+    report = {
+        'benchmark': 'load',
+        'clients': args.clients,
+        'connected': len(results),
+        'disconnected': sum(1 for bot in bots if bot['disconnected']),
+        'pattern': args.pattern,
+        'spawn_rate': args.spawn_rate,
+        'spawns': sum(bot['spawns'] for bot in bots),
+        'received_bytes_per_s': spread(
+            [bot['received_bytes_per_s'] for bot in bots]),
+        'events_per_s': spread([bot['events_per_s'] for bot in bots]),
+        'decode_share': spread([bot['decode_share'] for bot in bots]),
+        'spawn_latency': percentiles(
+            [latency for result in results
+             for latency in result['latencies']]),
+        'state_interval': percentiles(
+            [interval for result in results
+             for _, interval in result['state_intervals']]),
+        'late_states': late_states,
+        'timeline': build_timeline(results, start_time, late_interval),
+    }
+    if args.per_bot:
+        report['bots'] = bots
+
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
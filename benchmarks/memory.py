@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Report memory use per actor for a populated World.
+
+Run from the repository root:
+
+    python -m benchmarks.memory [--actors 100000] [--backend numpy]
+
+The dict backend is the python World with Actor and ActorState keeping
+their fields in a per-instance __dict__ instead of __slots__, as a
+baseline for the slotted layout.
+"""
+
+import argparse
+import gc
+import json
+import math
+import os
+import random
+import sys
+import tracemalloc
+
+# keep pygame's import banner out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from thirdparty.vec2 import vec2
+
+from mm.common.events import EventDistributor
+from mm.common.scheduling import Scheduler
+from mm.common.world import World, ActorStore, Actor, ActorState
+
+ACTOR_TYPES = ['hero', 'creep', 'supercreep', 'runner', 'sniper', 'tower']
+
+
+def without_slots(cls, **namespace):
+    """Return a copy of a slotted class whose instances keep their fields
+    in a __dict__.
+    """
+    skipped = set(cls.__slots__)
+    skipped.update(['__slots__', '__dict__', '__weakref__'])
+    for key, value in vars(cls).items():
+        if key not in skipped:
+            namespace.setdefault(key, value)
+    return type(cls.__name__, cls.__bases__, namespace)
+
+
+DictActorState = without_slots(ActorState)
+
+
+def get_dict_state(actor):
+    return DictActorState(
+        *[value for _, value in Actor.get_state(actor).items()])
+
+
+DictActor = without_slots(Actor, get_state=get_dict_state)
+
+
+class DictWorld(World):
+    def create_actor(self, actor_type, actor_id, pos):
+        return DictActor.from_params(
+            self.actor_store.get_params(actor_type), actor_id, self, pos=pos)
+
+
+def get_traced_bytes():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def measure(world_class, actor_store, num_actors, area_per_actor):
+    side = int(math.sqrt(num_actors * area_per_actor))
+    event_distributor = EventDistributor()
+
+    tracemalloc.start()
+
+    start = get_traced_bytes()
+    world = world_class(
+        event_distributor, Scheduler(), actor_store, side, side)
+    empty_world = get_traced_bytes()
+
+    for _ in range(num_actors):
+        world.spawn_actor(
+            random.choice(ACTOR_TYPES),
+            vec2(random.uniform(0, side), random.uniform(0, side)))
+
+    # the spawn events hold state snapshots, they don't count
+    event_distributor.queue = []
+    populated_world = get_traced_bytes()
+
+    states = [actor.get_state() for actor in world.actors]
+    with_states = get_traced_bytes()
+
+    tracemalloc.stop()
+
+    del states
+
+    return {
+        'world': world_class.__name__,
+        'actors': num_actors,
+        'empty_world_bytes': empty_world - start,
+        'bytes_per_actor': float(populated_world - empty_world) / num_actors,
+        'bytes_per_actor_state': float(with_states - populated_world) /
+            num_actors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--actors', type=int, default=100000)
+    parser.add_argument('--area-per-actor', type=float, default=10000.)
+    parser.add_argument(
+        '--backend', choices=['dict', 'python', 'numpy'], action='append')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    actor_store = ActorStore('actors.json')
+
+    results = []
+    for backend in args.backend or ['dict', 'python']:
+        if backend == 'numpy':
+            from mm.common.array_world import ArrayWorld as world_class
+        elif backend == 'dict':
+            world_class = DictWorld
+        else:
+            world_class = World
+        random.seed(args.seed)
+        results.append(measure(
+            world_class, actor_store, args.actors, args.area_per_actor))
+
+    json.dump(
+        {'benchmark': 'memory', 'results': results}, sys.stdout, indent=2,
+        sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Headless simulation benchmark for World.update.
+
+Builds a world from actors.json without pygame windows or sockets, runs a
+fixed number of ticks with a fixed seed and prints machine-readable JSON.
+
+Run from the repository root:
+
+    python -m benchmarks.simulation
+    python -m benchmarks.simulation --scenario dense_melee --actors 5000
+    python -m benchmarks.simulation --scenario custom \
+        --mix hero=1,creep=8,tower=1 --area-per-actor 2000 -o result.json
+"""
+
+import argparse
+import collections
+import functools
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+# keep pygame's import banner out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from thirdparty.vec2 import vec2
+
+from mm.common.events import EventDistributor, ALL_GAME_EVENT_TYPES
+from mm.common.scheduling import Scheduler
+from mm.common.world import World, ActorStore
+
+# name -> (actor type mix, area per actor in square pixels, cluster count)
+SCENARIOS = {
+    # few heroes roaming a big map, nearly everyone is wandering
+    'sparse_wander': ({'hero': 1, 'creep': 20, 'runner': 4}, 40000., 0),
+    # heroes and mobs packed into a handful of brawls
+    'dense_melee': (
+        {'hero': 3, 'creep': 6, 'supercreep': 2, 'runner': 1}, 400., 8),
+    # long ranged mobs and towers shooting into a hero crowd
+    'sniper_heavy': ({'hero': 2, 'sniper': 6, 'tower': 1}, 2500., 0),
+}
+
+DEFAULT_SCENARIOS = ['sparse_wander', 'dense_melee', 'sniper_heavy']
+
+
+def parse_mix(mix_string):
+    mix = {}
+    for item in mix_string.split(','):
+        actor_type, _, weight = item.partition('=')
+        mix[actor_type.strip()] = float(weight or 1)
+    return mix
+
+
+def spawn_positions(num_actors, width, height, num_clusters):
+    if not num_clusters:
+        for _ in range(num_actors):
+            yield vec2(random.uniform(0, width), random.uniform(0, height))
+        return
+
+    centers = [
+        (random.uniform(0, width), random.uniform(0, height))
+        for _ in range(num_clusters)]
+    spread = math.sqrt(width * height / num_clusters) / 6.
+    for _ in range(num_actors):
+        center_x, center_y = random.choice(centers)
+        yield vec2(
+            min(max(random.gauss(center_x, spread), 0), width),
+            min(max(random.gauss(center_y, spread), 0), height))
+
+
+def build_world(world_class, actor_store, mix, num_actors, area_per_actor,
+                num_clusters, cold_update_interval):
+    side = int(math.sqrt(num_actors * area_per_actor))
+    event_distributor = EventDistributor()
+    scheduler = Scheduler()
+    world = world_class(
+        event_distributor, scheduler, actor_store, side, side,
+        cold_update_interval=cold_update_interval)
+
+    actor_types = sorted(mix)
+    weights = [mix[actor_type] for actor_type in actor_types]
+    for pos in spawn_positions(num_actors, side, side, num_clusters):
+        world.spawn_actor(random.choices(actor_types, weights)[0], pos)
+
+    # spawn events are part of setup, not of the measured ticks
+    event_distributor.queue = []
+    return world
+
+
+def time_phase(timings, phase, func):
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[phase] += time.perf_counter() - start
+    return timed
+
+
+def run_scenario(world_class, actor_store, name, mix, num_actors,
+                 area_per_actor, num_clusters, cold_update_interval, ticks,
+                 alloc_ticks, seed, frame_time):
+    random.seed(seed)
+    world = build_world(
+        world_class, actor_store, mix, num_actors, area_per_actor,
+        num_clusters, cold_update_interval)
+    event_distributor = world.event_distributor
+    scheduler = world.scheduler
+
+    event_counts = collections.Counter()
+    event_distributor.add_handler(
+        lambda event: event_counts.update([type(event).__name__]),
+        ALL_GAME_EVENT_TYPES)
+
+    # wrap the world phases on the instance so World.update picks them up
+    timings = collections.defaultdict(float)
+    awake_counts = []
+    for phase in ('acquire_targets', 'move_actors', 'regenerate_actors'):
+        if hasattr(world, phase):
+            setattr(world, phase, time_phase(
+                timings, phase, getattr(world, phase)))
+
+    def tick():
+        start = time.perf_counter()
+        scheduler.update(frame_time)
+        after_scheduler = time.perf_counter()
+        world.update(frame_time)
+        after_world = time.perf_counter()
+        awake_counts.append(world.awake_count)
+        event_distributor.update()
+        end = time.perf_counter()
+
+        timings['scheduler'] += after_scheduler - start
+        timings['update'] += after_world - after_scheduler
+        timings['event_dispatch'] += end - after_world
+
+    blocks_before = sys.getallocatedblocks()
+    start = time.perf_counter()
+    for _ in range(ticks):
+        tick()
+    elapsed = time.perf_counter() - start
+    blocks_after = sys.getallocatedblocks()
+
+    # whatever World.update did outside the wrapped phases is think time
+    phase_seconds = dict(timings)
+    phase_seconds['think'] = phase_seconds.pop('update') - sum(
+        phase_seconds.get(phase, 0.) for phase in
+        ('acquire_targets', 'move_actors', 'regenerate_actors'))
+    tick_event_counts = dict(event_counts)
+    thinking_per_tick = float(sum(awake_counts)) / ticks
+
+    # tracing slows everything down, so measure allocations separately
+    peak_bytes = []
+    tracemalloc.start()
+    for _ in range(alloc_ticks):
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        tick()
+        peak_bytes.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+
+    return {
+        'scenario': name,
+        'mix': mix,
+        'actors': num_actors,
+        'actors_alive': len(world.actors),
+        'area_per_actor': area_per_actor,
+        'clusters': num_clusters,
+        'cold_update_interval': cold_update_interval,
+        'world_size': [world.width, world.height],
+        'ticks': ticks,
+        'seed': seed,
+        'frame_time': frame_time,
+        'elapsed_seconds': elapsed,
+        'ticks_per_second': ticks / elapsed if elapsed else None,
+        'seconds_per_tick': dict(
+            (phase, seconds / ticks)
+            for phase, seconds in phase_seconds.items()),
+        'actors_thinking_per_tick': thinking_per_tick,
+        'events_per_tick': dict(
+            (event_type, float(count) / ticks)
+            for event_type, count in tick_event_counts.items()),
+        'net_allocated_blocks_per_tick':
+            float(blocks_after - blocks_before) / ticks,
+        'peak_allocated_bytes_per_tick':
+            sum(peak_bytes) / len(peak_bytes) if peak_bytes else None,
+        'peak_rss_bytes': get_peak_rss(),
+    }
+
+
+def get_peak_rss():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return peak_rss
+
+
+def get_world_class(backend):
+    if backend == 'numpy':
+        from mm.common.array_world import ArrayWorld
+        return ArrayWorld
+    return World
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--scenario', action='append',
+        choices=sorted(SCENARIOS) + ['custom'],
+        help='may be given several times, defaults to all built-in ones')
+    parser.add_argument('--actors', type=int, default=2000)
+    parser.add_argument('--ticks', type=int, default=100)
+    parser.add_argument(
+        '--alloc-ticks', type=int, default=10,
+        help='extra ticks run under tracemalloc')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--frame-time', type=float, default=0.1)
+    parser.add_argument(
+        '--backend', choices=['python', 'numpy'], default='python')
+    parser.add_argument(
+        '--mix', type=parse_mix,
+        help='actor type weights, e.g. hero=1,creep=5,tower=1')
+    parser.add_argument(
+        '--area-per-actor', type=float,
+        help='square pixels of map per actor, sets the density')
+    parser.add_argument(
+        '--clusters', type=int,
+        help='spawn actors around this many centers, 0 for uniform')
+    parser.add_argument(
+        '--cold-update-interval', type=int,
+        default=World.COLD_UPDATE_INTERVAL,
+        help='ticks between updates of idle actors, 1 disables sleeping')
+    parser.add_argument(
+        '--actors-file', default='actors.json')
+    parser.add_argument(
+        '-o', '--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    actor_store = ActorStore(args.actors_file)
+    world_class = get_world_class(args.backend)
+
+    results = []
+    for name in args.scenario or DEFAULT_SCENARIOS:
+        mix, area_per_actor, num_clusters = SCENARIOS.get(
+            name, ({'hero': 1, 'creep': 5}, 10000., 0))
+        if args.mix:
+            mix = args.mix
+        if args.area_per_actor:
+            area_per_actor = args.area_per_actor
+        if args.clusters is not None:
+            num_clusters = args.clusters
+
+        results.append(run_scenario(
+            world_class, actor_store, name, mix, args.actors, area_per_actor,
+            num_clusters, args.cold_update_interval, args.ticks,
+            args.alloc_ticks, args.seed, args.frame_time))
+
+    report = {
+        'benchmark': 'simulation',
+        'backend': args.backend,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
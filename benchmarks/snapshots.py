@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""Update latency of UDP snapshots against TCP deltas under packet loss.
+
+Runs a world and sends its state every tick to one client over a simulated
+lossy path, with a simulated clock so runs are quick and repeatable:
+
+ * udp_snapshots: SnapshotServer and SnapshotClient exchange their
+   datagrams through a LossyLink, a stand-in for a lossy loopback that drops
+   each datagram, snapshot or ack, with the given probability.
+ * tcp_deltas: a model of one TCP stream carrying a message per tick. A lost
+   segment is retransmitted after the retransmission timeout, doubling on
+   every retry, and holds back all later messages until it gets through.
+   Fast retransmit and congestion control are left out.
+
+The client polls once per frame. The latency of a tick is the time from
+the server sending its state until the client has that or a newer state.
+The snapshot client's view is checked against what the server sent once
+the run is over.
+
+Run from the repository root:
+
+    python -m benchmarks.snapshots [--loss 0 0.01 0.02 0.05 0.1]
+"""
+
+import argparse
+import heapq
+import json
+import os
+import random
+import sys
+
+# keep pygame's import banner out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from benchmarks.codec import build_world
+
+from mm.common.codec import EventCodec, ACTOR_DELTA_FIELDS
+from mm.common.events import DeltaStateEvent, EventDistributor
+from mm.common.snapshots import SnapshotServer, SnapshotClient
+from mm.common.world import ActorStore, ActorDelta
+
+SERVER_ADDRESS = ('server', 9000)
+CLIENT_ADDRESS = ('client', 9001)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.
+
+
+class LossyLink(object):
+    """Delivers datagrams between two LossySockets after latency seconds,
+    dropping each one with probability loss.
+    """
+
+    def __init__(self, clock, loss, latency, rng):
+        self.clock = clock
+        self.loss = loss
+        self.latency = latency
+        self.rng = rng
+        self.sent_count = 0
+        self.lost_count = 0
+        self.sent_bytes = 0
+        self.counter = 0
+        # address -> heap of (delivery time, counter, data, source address)
+        self.queues = {}
+
+    def send(self, data, source, destination):
+        self.sent_count += 1
+        self.sent_bytes += len(data)
+        if self.rng.random() < self.loss:
+            self.lost_count += 1
+            return
+        self.counter += 1
+        heapq.heappush(
+            self.queues.setdefault(destination, []),
+            (self.clock.now + self.latency, self.counter, bytes(data), source))
+
+    def receive(self, address):
+        queue = self.queues.get(address)
+        if not queue or queue[0][0] > self.clock.now:
+            raise BlockingIOError()
+        _, _, data, source = heapq.heappop(queue)
+        return data, source
+
+
+class LossySocket(object):
+    def __init__(self, link, address):
+        self.link = link
+        self.address = address
+
+    def getsockname(self):
+        return self.address
+
+    def sendto(self, data, address):
+        self.link.send(data, self.address, address)
+        return len(data)
+
+    def recvfrom(self, size):
+        return self.link.receive(self.address)
+
+    def close(self):
+        pass
+
+
+def tcp_delivery_times(send_times, loss, latency, min_rto, rng):
+    delivery_times = []
+    last_delivery = 0.
+    for send_time in send_times:
+        arrival = send_time + latency
+        rto = min_rto
+        while rng.random() < loss:
+            arrival += rto
+            rto *= 2.
+        # in order delivery, a message waits for all earlier ones
+        last_delivery = max(last_delivery, arrival)
+        delivery_times.append(last_delivery)
+    return delivery_times
+
+
+def next_frame(time, frame_time):
+    # the client only sees data when it polls
+    frames = int(time / frame_time)
+    if frames * frame_time < time - 1e-9:
+        frames += 1
+    return frames * frame_time
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'mean_ms': 1000. * sum(latencies) / count,
+        'p50_ms': 1000. * latencies[count // 2],
+        'p99_ms': 1000. * latencies[min(count - 1, int(count * 0.99))],
+        'max_ms': 1000. * latencies[-1],
+    }
+
+
+def to_wire(fields):
+    return dict(
+        (name, field_type.to_wire(fields[name])
+         if field_type.to_wire else fields[name])
+        for name, field_type in ACTOR_DELTA_FIELDS)
+
+
+def run_udp(codec, world, args, loss, rng):
+    clock = Clock()
+    link = LossyLink(clock, loss, args.latency, rng)
+
+    server = SnapshotServer(codec, LossySocket(link, SERVER_ADDRESS))
+    channel_event = server.add_client(1)
+
+    event_distributor = EventDistributor()
+    client = SnapshotClient(
+        event_distributor, codec, LossySocket(link, CLIENT_ADDRESS),
+        SERVER_ADDRESS[0])
+    client.on_snapshot_channel(channel_event)
+
+    # the client's copy of the actor fields, from the posted deltas
+    client_view = {}
+
+    def on_delta_state(event):
+        for actor_delta in event.actor_deltas:
+            client_view.setdefault(actor_delta.actor_id, {}).update(
+                actor_delta.changes)
+
+    event_distributor.add_handler(on_delta_state, DeltaStateEvent)
+
+    tick_time = 1. / args.tick_rate
+    frame_time = 1. / args.frame_rate
+    latencies = []
+    next_tick = 0.
+    # (sequence, time sent) of snapshots the client has not caught up with
+    pending = []
+
+    while next_tick < args.ticks * tick_time:
+        # client frames up to the next tick
+        while clock.now < next_tick:
+            client.read_snapshots()
+            event_distributor.update()
+            while pending and pending[0][0] <= client.sequence:
+                _, send_time = pending.pop(0)
+                latencies.append(clock.now - send_time)
+            clock.now = next_frame(clock.now + frame_time / 2, frame_time)
+
+        clock.now = next_tick
+        world.scheduler.update(tick_time)
+        world.update(tick_time)
+        world.event_distributor.update()
+
+        server.receive_acks()
+        server.add_snapshot(world.take_actor_deltas())
+        if server.send_snapshot(
+                1, [actor.actor_id for actor in world.actors]):
+            pending.append((server.clients[1].sequence, clock.now))
+        next_tick += tick_time
+
+    # ticks the client never caught up with are left out
+    sent = server.clients[1].get_view(client.sequence)
+    if server.ring.contains(client.sequence):
+        server_view = dict(
+            (actor_id, to_wire(dict(zip(
+                ActorDelta.FIELDS,
+                server.ring.get_row(actor_id, client.sequence)))))
+            for actor_id in sent)
+        mirrored = dict(
+            (actor_id, to_wire(fields))
+            for actor_id, fields in client_view.items()
+            if actor_id in server_view)
+        if mirrored != server_view:
+            raise RuntimeError('Snapshot client is out of sync')
+
+    result = summarize(latencies)
+    result.update({
+        'transport': 'udp_snapshots',
+        'datagrams_per_tick': float(link.sent_count) / args.ticks,
+        'bytes_per_tick': float(link.sent_bytes) / args.ticks,
+        'datagram_loss': float(link.lost_count) / max(1, link.sent_count),
+    })
+    return result
+
+
+def run_tcp(args, loss, rng):
+    tick_time = 1. / args.tick_rate
+    frame_time = 1. / args.frame_rate
+    send_times = [tick * tick_time for tick in range(args.ticks)]
+    delivery_times = tcp_delivery_times(
+        send_times, loss, args.latency, args.min_rto, rng)
+    latencies = [
+        next_frame(delivered, frame_time) - sent
+        for sent, delivered in zip(send_times, delivery_times)]
+    result = summarize(latencies)
+    result['transport'] = 'tcp_deltas'
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--loss', type=float, nargs='+', default=[0, 0.01, 0.02, 0.05, 0.1])
+    parser.add_argument('--actors', type=int, default=200)
+    parser.add_argument('--ticks', type=int, default=600)
+    parser.add_argument('--tick-rate', type=float, default=10.)
+    parser.add_argument('--frame-rate', type=float, default=60.)
+    parser.add_argument(
+        '--latency', type=float, default=0.001,
+        help='one way latency of the path in seconds')
+    parser.add_argument(
+        '--min-rto', type=float, default=0.2,
+        help='initial TCP retransmission timeout in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    actor_store = ActorStore('actors.json')
+    codec = EventCodec(actor_store)
+
+    results = []
+    for loss in args.loss:
+        random.seed(args.seed)
+        world = build_world(actor_store, args.actors, 10)
+        world.event_distributor.update()
+
+        rng = random.Random(args.seed)
+        for result in (run_udp(codec, world, args, loss, rng),
+                       run_tcp(args, loss, rng)):
+            result['loss'] = loss
+            results.append(result)
+
+    json.dump(
+        {'benchmark': 'snapshots', 'actors': args.actors, 'ticks': args.ticks,
+         'results': results}, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Compare World.find_nearby_actors against the old linear scan.
+
+Run from the repository root:
+
+    python -m benchmarks.spatial_index [--sizes 1000 10000 50000]
+"""
+
+import argparse
+import math
+import random
+import time
+
+from thirdparty.vec2 import vec2
+
+from mm.common.events import EventDistributor
+from mm.common.scheduling import Scheduler
+from mm.common.world import World, ActorStore
+
+ACTOR_TYPES = ['hero', 'creep', 'supercreep', 'runner', 'sniper', 'tower']
+
+
+def linear_find_nearby_actors(world, pos, search_radius):
+    for actor in world.actors:
+        if (actor.is_alive() and
+            pos.get_distance(actor.pos) - actor.radius < search_radius):
+            yield actor
+
+
+def build_world(actor_store, num_actors, area_per_actor):
+    side = int(math.sqrt(num_actors * area_per_actor))
+    world = World(
+        EventDistributor(), Scheduler(), actor_store, side, side)
+    for _ in range(num_actors):
+        world.spawn_actor(
+            random.choice(ACTOR_TYPES),
+            vec2(random.uniform(0, side), random.uniform(0, side)))
+    world.event_distributor.queue = []
+    return world
+
+
+def time_queries(find, world, searchers):
+    found = 0
+    start = time.perf_counter()
+    for actor in searchers:
+        for _ in find(actor.pos, actor.threat_range):
+            found += 1
+    return time.perf_counter() - start, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--area-per-actor', type=float, default=9600.)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    actor_store = ActorStore('actors.json')
+
+    print('%8s %14s %14s %10s' % ('actors', 'linear us/q', 'grid us/q', 'speedup'))
+    for num_actors in args.sizes:
+        world = build_world(actor_store, num_actors, args.area_per_actor)
+        searchers = random.sample(
+            list(world.actors), min(args.queries, num_actors))
+
+        linear_time, linear_found = time_queries(
+            lambda pos, radius: linear_find_nearby_actors(world, pos, radius),
+            world, searchers)
+        grid_time, grid_found = time_queries(
+            world.find_nearby_actors, world, searchers)
+
+        assert linear_found == grid_found, (linear_found, grid_found)
+
+        print('%8d %14.1f %14.1f %9.1fx' % (
+            num_actors,
+            1e6 * linear_time / len(searchers),
+            1e6 * grid_time / len(searchers),
+            linear_time / grid_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ import logging.config
 import pygame
 
 from mm.client.session import Session
+from mm.common.compression import Compression, load_dictionary
 from mm.common.config import Config
 
 LOG = logging.getLogger(__name__)
@@ -40,8 +41,27 @@ def main():
 
         pygame.display.set_caption(WINDOW_TITLE)
 
+        try:
+            compression_min_size = int(
+                config.get('network', 'compression_min_size'))
+        except KeyError:
+            compression_min_size = Compression.DEFAULT_MIN_SIZE
+
+        try:
+            dictionary_filename = config.get(
+                'network', 'compression_dictionary')
+        except KeyError:
+            dictionary_filename = None
+
+        dictionary = None
+        if dictionary_filename:
+            LOG.info('...loading compression dictionary %s',
+                     dictionary_filename)
+            dictionary = load_dictionary(dictionary_filename)
+
         LOG.info('...initializing game')
-        session = Session(screen)
+        session = Session(
+            screen, Compression(compression_min_size, dictionary))
         session.menu()
 
         clock = pygame.time.Clock()
@@ -31,6 +31,10 @@ class ClientWorld(object):
         self.event_distributor.add_handler(self.on_heal, HealEvent)
         self.event_distributor.add_handler(self.on_loot, LootEvent)
         self.event_distributor.add_handler(self.on_set_target, SetTargetEvent)
+        self.event_distributor.add_handler(
+            self.on_actor_entered_view, ActorEnteredViewEvent)
+        self.event_distributor.add_handler(
+            self.on_actor_left_view, ActorLeftViewEvent)
 
     def find_actor_by_id(self, actor_id):
         return self.world.find_actor_by_id(actor_id)
@@ -48,17 +52,18 @@ class ClientWorld(object):
             for actor_state in event.actor_states]
         self.world = World(
             self.event_distributor, self.scheduler, self.actor_store,
-            event.width, event.height, actors=actors)
+            event.width, event.height, actors=actors, track_changes=False)
         self.client_actors = dict(
             (actor.actor_id, self.new_client_actor(actor)) for actor in actors)
 
     def on_delta_state(self, event):
-        for actor_state in event.actor_states:
-            local_actor = self.find_actor_by_id(actor_state.actor_id)
+        for actor_delta in event.actor_deltas:
+            local_actor = self.find_actor_by_id(actor_delta.actor_id)
             if local_actor:
-                local_actor.update_state(actor_state)
+                local_actor.apply_delta(actor_delta)
             else:
-                LOG.warning('State for unknown actor %d', actor_state.actor_id)
+                # snapshots over UDP may overtake enter and leave events
+                LOG.debug('State for unknown actor %d', actor_delta.actor_id)
 
     def on_actor_spawned(self, event):
         LOG.info(
@@ -76,13 +81,31 @@ class ClientWorld(object):
                 actor, self.actor_store.get_params(actor.actor_type),
                 self.renderer)
 
+    def on_actor_entered_view(self, event):
+        if self.find_actor_by_id(event.actor_state.actor_id):
+            LOG.error(
+                'Actor entering view already exists: id=%d',
+                event.actor_state.actor_id)
+        else:
+            actor = Actor.from_state(event.actor_state, self.world)
+            self.world.add_actor(actor)
+            self.client_actors[actor.actor_id] = self.new_client_actor(actor)
+
+    def on_actor_left_view(self, event):
+        local_actor = self.find_actor_by_id(event.actor_id)
+        if local_actor:
+            self.world.remove_actor(local_actor)
+            del self.client_actors[event.actor_id]
+        else:
+            LOG.warning('Unknown actor %d left view', event.actor_id)
+
     def on_actor_died(self, event):
         LOG.info('Actor %d died', event.actor_id)
         local_actor = self.find_actor_by_id(event.actor_id)
         if local_actor:
             # kill the actor
             local_actor.health = 0
-            self.world.actors.remove(local_actor)
+            self.world.remove_actor(local_actor)
 
             # keep body around for a little while
             self.scheduler.post(
@@ -3,7 +3,9 @@ import pygame
 
 from mm.common.scheduling import Scheduler
 from mm.common.world import World, ActorStore
+from mm.common.codec import EventCodec
 from mm.common.networking import Client, DEFAULT_NETWORK_PORT
+from mm.common.snapshots import SnapshotClient, create_client_socket
 from mm.common.events import *
 from mm.client.rendering import Renderer
 from mm.client.hud import Hud
@@ -142,10 +144,12 @@ def event_debug_printer(event):
 
 
 class MultiplayerState(object):
-    def __init__(self, session, client, event_distributor, scheduler, renderer,
-                 actor_store, screen_width, screen_height):
+    def __init__(self, session, client, snapshots, event_distributor,
+                 scheduler, renderer, actor_store, screen_width,
+                 screen_height):
         self.session = session
         self.client = client
+        self.snapshots = snapshots
         self.event_distributor = event_distributor
         self.scheduler = scheduler
         self.renderer = renderer
@@ -169,11 +173,16 @@ class MultiplayerState(object):
         self.event_distributor.add_handler(
             event_debug_printer, ALL_EVENT_TYPES)
 
+        # the world is drawn unscrolled, so the screen is the viewport
+        self.client.send_event(
+            SetViewportEvent(0, 0, screen_width, screen_height))
+
     def on_event(self, event):
         self.hud.on_event(event)
 
     def update(self, screen, frame_time):
         self.client.read_from_server()
+        self.snapshots.read_snapshots()
         self.scheduler.update(frame_time)
         screen.fill((255, 255, 255))
         self.client_world.update(screen, frame_time)
@@ -193,6 +202,7 @@ class MultiplayerState(object):
     def on_disconnected_from_server(self):
         if self.client.is_connected():
             self.client.disconnect()
+        self.snapshots.close()
 
     def on_player_spawn_mob(self, event):
         LOG.info('Player spawn mob %s at %r', event.actor_type, event.pos)
@@ -224,8 +234,9 @@ class SingleplayerState(object):
 """
 
 class Session(object):
-    def __init__(self, screen):
+    def __init__(self, screen, compression=None):
         self.screen = screen
+        self.compression = compression
         self.is_running = True
         self.menu_state = None
         self.play_state = None
@@ -250,16 +261,22 @@ class Session(object):
 
     def multiplayer_game(self, address, port):
         event_distributor = EventDistributor()
-        client = Client(event_distributor)
+        actor_store = ActorStore('actors.json')
+        codec = EventCodec(actor_store)
+        client = Client(event_distributor, codec, self.compression)
 
         if client.connect(address, port):
             scheduler = Scheduler()
             renderer = Renderer()
-            actor_store = ActorStore('actors.json')
+
+            # only used if the server offers a snapshot channel
+            snapshots = SnapshotClient(
+                event_distributor, codec, create_client_socket(), address)
 
             self.play_state = MultiplayerState(
-                self, client, event_distributor, scheduler, renderer,
-                actor_store, self.screen.get_width(), self.screen.get_height())
+                self, client, snapshots, event_distributor, scheduler,
+                renderer, actor_store, self.screen.get_width(),
+                self.screen.get_height())
 
             self.current_state = self.play_state
 
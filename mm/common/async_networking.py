@@ -0,0 +1,263 @@
+"""asyncio transport for Server and Client.
+
+The event loop accepts connections and reads sockets as data arrives, so
+nothing is polled per tick and an idle connection costs nothing but its
+buffers. Received events are posted to the EventDistributor as soon as a
+message is complete; outbound events are still batched per tick and
+written when write_to_clients or write_to_server is called. Framing,
+compression and the event codec are the same as for the select based
+transport, so both ends can use either one.
+
+The select based Server stays the default. The server only runs on this
+transport when "transport" is set to "asyncio" in the server section of
+mm.conf.
+"""
+
+import asyncio
+import logging
+
+from mm.common.events import (ClientConnectedEvent,
+                              ClientDisconnectedEvent,
+                              ClientEvent)
+from mm.common.networking import Channel, Server, WriteBuffer
+
+LOG = logging.getLogger(__name__)
+
+
+class ChannelProtocol(asyncio.Protocol):
+    """Connects a Channel to an asyncio transport."""
+
+    def __init__(self, codec, compression, on_connected, on_events,
+                 on_disconnected):
+        self.codec = codec
+        self.compression = compression
+        self.on_connected = on_connected
+        self.on_events = on_events
+        self.on_disconnected = on_disconnected
+        self.transport = None
+        self.channel = None
+        self.client_id = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.channel = Channel(None, self.codec, self.compression)
+        self.on_connected(self)
+
+    def data_received(self, data):
+        channel = self.channel
+        channel.received_bytes += len(data)
+        channel.read_buffer.feed(data)
+        try:
+            channel.on_data_received()
+        except Exception:
+            LOG.exception('Failed to parse data from peer, closing connection')
+            self.transport.abort()
+            return
+
+        if channel.in_events:
+            self.on_events(self, list(channel.receive_events()))
+
+    def connection_lost(self, exc):
+        if exc:
+            LOG.info('Connection lost: %s', exc)
+        self.on_disconnected(self)
+
+    def is_open(self):
+        return self.transport is not None and not self.transport.is_closing()
+
+    def flush(self):
+        channel = self.channel
+        # while the transport holds on to earlier data, events wait in the
+        # channel, where state events are merged
+        channel.is_blocked = (self.transport.get_write_buffer_size() >=
+                              channel.MAX_WRITE_BUFFER_SIZE)
+        if channel.is_blocked:
+            return
+        channel.fill_write_buffer()
+
+        write_buffer = channel.write_buffer
+        if not write_buffer.is_empty():
+            # the transport may hold on to the data, so hand it over and
+            # start a new buffer
+            channel.write_buffer = WriteBuffer()
+            data = write_buffer.get_buffer_data()
+            channel.sent_bytes += len(data)
+            self.transport.write(data)
+
+    def close(self):
+        if self.is_open():
+            self.transport.close()
+
+    def abort(self):
+        # unlike close, does not wait for buffered data to go out
+        if self.transport is not None:
+            self.transport.abort()
+
+
+class AsyncServer(Server):
+    """Server on an asyncio event loop.
+
+    Keeps the event API of Server: broadcast_event, multicast_event,
+    send_event, and ClientConnectedEvent, ClientEvent and
+    ClientDisconnectedEvent posted to the event distributor. start_server
+    has to be awaited from the loop.
+    """
+
+    def __init__(self, event_distributor, port, codec, compression=None):
+        super(AsyncServer, self).__init__(
+            event_distributor, port, codec, compression)
+        self.client_id_generator = 0
+        self.protocols = {}
+
+        # clients with outbound data since the last write_to_clients
+        self.pending_client_ids = set()
+
+    async def start_server(self):
+        loop = asyncio.get_running_loop()
+        self.server_socket = await loop.create_server(
+            self.create_protocol, '', self.port, reuse_address=True)
+
+    def stop_server(self):
+        if self.server_socket:
+            self.server_socket.close()
+            self.server_socket = None
+        for protocol in list(self.protocols.values()):
+            protocol.close()
+
+    def create_protocol(self):
+        return ChannelProtocol(
+            self.codec, self.compression, self.on_connected, self.on_events,
+            self.on_disconnected)
+
+    def on_connected(self, protocol):
+        # the new client must not get broadcasts from before it joined
+        self.flush_broadcast_events()
+
+        self.client_id_generator += 1
+        client_id = self.client_id_generator
+        protocol.client_id = client_id
+        self.protocols[client_id] = protocol
+        self.channels[client_id] = protocol.channel
+        self.event_distributor.post(ClientConnectedEvent(client_id))
+        LOG.info('Client %d connected', client_id)
+
+    def on_events(self, protocol, events):
+        for event in events:
+            self.event_distributor.post(ClientEvent(protocol.client_id, event))
+
+    def on_disconnected(self, protocol):
+        client_id = protocol.client_id
+        if self.protocols.pop(client_id, None):
+            LOG.info('Client %d disconnected', client_id)
+            del self.channels[client_id]
+            self.pending_client_ids.discard(client_id)
+            self.event_distributor.post(ClientDisconnectedEvent(client_id))
+
+    def accept_pending_clients(self):
+        # the event loop accepts connections as they come in
+        pass
+
+    def read_from_clients(self):
+        # the event loop posts client events as they arrive
+        pass
+
+    def get_client_stats(self):
+        client_stats = super(AsyncServer, self).get_client_stats()
+        for client_id, protocol in self.protocols.items():
+            if protocol.transport is not None:
+                client_stats[client_id]['queued_bytes'] += (
+                    protocol.transport.get_write_buffer_size())
+        return client_stats
+
+    def disconnect_client(self, client_id):
+        protocol = self.protocols.get(client_id)
+        if protocol:
+            protocol.abort()
+            # connection_lost only follows on a later loop iteration
+            self.on_disconnected(protocol)
+
+    def send_event(self, client_id, event):
+        super(AsyncServer, self).send_event(client_id, event)
+        if client_id in self.channels:
+            self.pending_client_ids.add(client_id)
+
+    def write_to_clients(self):
+        self.flush_broadcast_events()
+
+        pending_client_ids = self.pending_client_ids
+        self.pending_client_ids = set()
+        for client_id in pending_client_ids:
+            protocol = self.protocols.get(client_id)
+            if protocol and protocol.is_open():
+                protocol.flush()
+                # big events are streamed over several ticks
+                if protocol.channel.has_pending_data():
+                    self.pending_client_ids.add(client_id)
+
+        self.disconnect_slow_clients()
+
+
+class AsyncClient(object):
+    """Client on an asyncio event loop, with the event API of Client.
+    connect has to be awaited from the loop.
+    """
+
+    def __init__(self, event_distributor, codec, compression=None):
+        self.event_distributor = event_distributor
+        self.codec = codec
+        self.compression = compression
+        self.protocol = None
+
+    def is_connected(self):
+        return self.protocol is not None
+
+    async def connect(self, address, port):
+        if self.is_connected():
+            self.disconnect()
+
+        LOG.info('Connecting to server %s:%d', address, port)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.create_connection(
+                self.create_protocol, address, port)
+        except OSError:
+            LOG.info('Failed to connect to server %s:%d', address, port)
+            return False
+        return True
+
+    def create_protocol(self):
+        return ChannelProtocol(
+            self.codec, self.compression, self.on_connected, self.on_events,
+            self.on_disconnected)
+
+    def on_connected(self, protocol):
+        self.protocol = protocol
+
+    def on_events(self, protocol, events):
+        for event in events:
+            self.event_distributor.post(event)
+
+    def on_disconnected(self, protocol):
+        if protocol is self.protocol:
+            LOG.info('Server closed the connection')
+            self.protocol = None
+            self.event_distributor.post(ClientDisconnectedEvent(0))
+
+    def disconnect(self):
+        if self.is_connected():
+            LOG.info('Disconnecting from server')
+            protocol = self.protocol
+            self.protocol = None
+            protocol.close()
+
+    def send_event(self, event):
+        if self.is_connected():
+            self.protocol.channel.send_event(event)
+
+    def read_from_server(self):
+        # the event loop posts server events as they arrive
+        pass
+
+    def write_to_server(self):
+        if self.is_connected() and self.protocol.is_open():
+            self.protocol.flush()
@@ -0,0 +1,522 @@
+"""Binary wire format for events.
+
+Every event type in ALL_EVENT_TYPES has a schema: its constructor
+arguments in order, each with a field type. The codec compiles a schema
+into a single struct layout, so an event goes over the wire as a one byte
+type tag followed by packed fields, without the class paths and attribute
+names pickle repeats in every message. Decoding only ever builds the
+registered types, unlike pickle.loads.
+
+Actor types are sent as small integer ids, numbered in name order from the
+ActorStore, so both ends need to load the same actors.json.
+
+Fixed-size fields come first in a schema. At most one variable-size field
+(a nested actor state, a list of them, a list of actor deltas or a nested
+event) may end it.
+
+DeltaStateEvent carries ActorDeltas instead of full states: per actor a
+bitmask of the changed fields followed by just those fields, with
+positions in int16 fixed point and health as an int16. The deltas come
+from World.take_actor_deltas, which only looks at the actors changed since
+the last call, and only sends the fields that differ from the values it
+sent then.
+"""
+
+import math
+import operator
+import struct
+
+from thirdparty.vec2 import vec2
+
+from mm.common.events import (ALL_EVENT_TYPES,
+                              ClientEvent,
+                              ClientConnectedEvent,
+                              ClientDisconnectedEvent,
+                              EnterGameEvent,
+                              DeltaStateEvent,
+                              ActorSpawnedEvent,
+                              ActorDiedEvent,
+                              AttackEvent,
+                              HealEvent,
+                              LootEvent,
+                              SetTargetEvent,
+                              PlayerActionSpawnMobEvent,
+                              SetViewportEvent,
+                              ActorEnteredViewEvent,
+                              ActorLeftViewEvent,
+                              SnapshotChannelEvent,
+                              SnapshotEvent,
+                              SnapshotAckEvent,
+                              CompressionOfferEvent)
+from mm.common.scheduling import Timer
+from mm.common.world import ActorState, ActorDelta
+
+TAG = struct.Struct('!B')
+COUNT = struct.Struct('!I')
+DELTA_HEADER = struct.Struct('!IB')
+
+# fixed-point positions in half pixels, covering -16384 to 16383.5 px
+POSITION_SCALE = 2.
+INT16_MIN = -0x8000
+INT16_MAX = 0x7fff
+
+
+class FieldType(object):
+    """Fixed-size field: a struct format plus conversions to and from the
+    tuple of values it packs to. Without conversions the field is a single
+    value packed as is.
+    """
+
+    def __init__(self, fmt, to_wire=None, from_wire=None):
+        self.fmt = fmt
+        self.count = len(struct.unpack(
+            '!' + fmt, bytes(struct.calcsize('!' + fmt))))
+        self.to_wire = to_wire
+        self.from_wire = from_wire
+
+
+def _timer_to_wire(timer):
+    max_duration = timer.max_duration
+    if max_duration is None:
+        max_duration = float('nan')
+    return (timer.min_duration, max_duration, timer.time_left)
+
+
+def _timer_from_wire(values):
+    min_duration, max_duration, time_left = values
+    if math.isnan(max_duration):
+        max_duration = None
+    # skip Timer.__init__, the fields are all known
+    timer = Timer.__new__(Timer)
+    timer.__setstate__((min_duration, max_duration, time_left))
+    return timer
+
+
+BOOL = FieldType('?')
+UINT16 = FieldType('H')
+UINT32 = FieldType('I')
+INT32 = FieldType('i')
+FLOAT = FieldType('f')
+
+# actor ids start above zero, so zero stands in for None
+OPTIONAL_ID = FieldType(
+    'I', lambda actor_id: (actor_id or 0,), lambda values: values[0] or None)
+
+VEC2 = FieldType(
+    'ff', lambda pos: (pos.x, pos.y), lambda values: vec2(*values))
+
+FLOAT_PAIR = FieldType('ff', tuple, tuple)
+
+TIMER = FieldType('fff', _timer_to_wire, _timer_from_wire)
+
+
+def _clamp_int16(value):
+    return min(max(int(round(value)), INT16_MIN), INT16_MAX)
+
+
+def _position_to_wire(pos):
+    return (_clamp_int16(pos.x * POSITION_SCALE),
+            _clamp_int16(pos.y * POSITION_SCALE))
+
+
+def _position_from_wire(values):
+    return vec2(values[0] / POSITION_SCALE, values[1] / POSITION_SCALE)
+
+
+QUANTIZED_VEC2 = FieldType('hh', _position_to_wire, _position_from_wire)
+
+SMALL_INT = FieldType(
+    'h', lambda value: (_clamp_int16(value),), lambda values: values[0])
+
+
+class Layout(object):
+    """Packs the fixed-size fields of cls into one struct."""
+
+    def __init__(self, cls, fields):
+        self.cls = cls
+        names = [name for name, _ in fields]
+        field_types = [field_type for _, field_type in fields]
+
+        if not names:
+            self.getter = lambda obj: ()
+        elif len(names) == 1:
+            getter = operator.attrgetter(names[0])
+            self.getter = lambda obj: (getter(obj),)
+        else:
+            self.getter = operator.attrgetter(*names)
+
+        self.field_types = field_types
+        self.is_plain = all(
+            field_type.to_wire is None for field_type in field_types)
+        self.struct = struct.Struct(
+            '!' + ''.join(field_type.fmt for field_type in field_types))
+        self.size = self.struct.size
+
+        # (start, end, from_wire) over the wire values, with runs of plain
+        # fields merged into one slice
+        self.decode_steps = []
+        index = 0
+        for field_type in field_types:
+            end = index + field_type.count
+            steps = self.decode_steps
+            if (field_type.from_wire is None and steps and
+                steps[-1][2] is None and steps[-1][1] == index):
+                steps[-1] = (steps[-1][0], end, None)
+            else:
+                steps.append((index, end, field_type.from_wire))
+            index = end
+
+    def to_wire(self, obj):
+        values = self.getter(obj)
+        if self.is_plain:
+            return values
+
+        wire_values = []
+        for value, field_type in zip(values, self.field_types):
+            if field_type.to_wire is None:
+                wire_values.append(value)
+            else:
+                wire_values.extend(field_type.to_wire(value))
+        return wire_values
+
+    def from_wire(self, wire_values):
+        if self.is_plain:
+            return list(wire_values)
+
+        args = []
+        for start, end, from_wire in self.decode_steps:
+            if from_wire is None:
+                args.extend(wire_values[start:end])
+            else:
+                args.append(from_wire(wire_values[start:end]))
+        return args
+
+    def pack(self, obj):
+        return self.struct.pack(*self.to_wire(obj))
+
+    def unpack_from(self, data, offset):
+        return (self.from_wire(self.struct.unpack_from(data, offset)),
+                offset + self.size)
+
+
+class ObjectField(object):
+    def __init__(self, layout):
+        self.layout = layout
+
+    def iter_encode(self, value):
+        yield self.layout.pack(value)
+
+    def decode(self, data, offset):
+        args, offset = self.layout.unpack_from(data, offset)
+        return self.layout.cls(*args), offset
+
+
+class ObjectListField(object):
+    def __init__(self, layout):
+        self.layout = layout
+
+    def iter_encode(self, values):
+        yield COUNT.pack(len(values))
+        pack = self.layout.struct.pack
+        to_wire = self.layout.to_wire
+        for value in values:
+            yield pack(*to_wire(value))
+
+    def decode(self, data, offset):
+        count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        end = offset + count * self.layout.size
+
+        cls = self.layout.cls
+        from_wire = self.layout.from_wire
+        values = [
+            cls(*from_wire(wire_values)) for wire_values in
+            self.layout.struct.iter_unpack(memoryview(data)[offset:end])]
+        return values, end
+
+
+class ActorDeltaListField(object):
+    """List of ActorDeltas, each an actor id and a bitmask of the fields
+    that follow. Bit n stands for the n-th of fields.
+    """
+
+    def __init__(self, fields):
+        if len(fields) > 8:
+            raise ValueError('Too many delta fields: %d' % (len(fields),))
+        self.fields = [
+            (1 << bit, name, field_type)
+            for bit, (name, field_type) in enumerate(fields)]
+        self.all_fields_mask = (1 << len(fields)) - 1
+        # mask -> (struct with header, struct of the fields, decode steps)
+        self.formats = {}
+
+    def get_format(self, mask):
+        delta_format = self.formats.get(mask)
+        if delta_format is None:
+            if mask & ~self.all_fields_mask:
+                raise ValueError('Unknown delta fields in mask %#x' % (mask,))
+            fmt = ''
+            steps = []
+            index = 0
+            for bit, name, field_type in self.fields:
+                if mask & bit:
+                    fmt += field_type.fmt
+                    end = index + field_type.count
+                    steps.append((name, index, end, field_type.from_wire))
+                    index = end
+            delta_format = self.formats[mask] = (
+                struct.Struct(DELTA_HEADER.format + fmt),
+                struct.Struct('!' + fmt), steps)
+        return delta_format
+
+    def iter_encode(self, deltas):
+        yield COUNT.pack(len(deltas))
+        fields = self.fields
+        for delta in deltas:
+            changes = delta.changes
+            mask = 0
+            wire_values = [delta.actor_id, 0]
+            for bit, name, field_type in fields:
+                if name in changes:
+                    mask |= bit
+                    if field_type.to_wire is None:
+                        wire_values.append(changes[name])
+                    else:
+                        wire_values.extend(field_type.to_wire(changes[name]))
+            wire_values[1] = mask
+            yield self.get_format(mask)[0].pack(*wire_values)
+
+    def decode(self, data, offset):
+        count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+
+        deltas = []
+        for _ in range(count):
+            actor_id, mask = DELTA_HEADER.unpack_from(data, offset)
+            _, fields_struct, steps = self.get_format(mask)
+            wire_values = fields_struct.unpack_from(
+                data, offset + DELTA_HEADER.size)
+            offset += DELTA_HEADER.size + fields_struct.size
+
+            changes = {}
+            for name, start, end, from_wire in steps:
+                if from_wire is None:
+                    changes[name] = wire_values[start]
+                else:
+                    changes[name] = from_wire(wire_values[start:end])
+            deltas.append(ActorDelta(actor_id, changes))
+        return deltas, offset
+
+
+class EventField(object):
+    def __init__(self, codec):
+        self.codec = codec
+
+    def iter_encode(self, event):
+        if type(event) is ClientEvent:
+            raise ValueError('ClientEvents can not be nested')
+        return self.codec.iter_encode(event)
+
+    def decode(self, data, offset):
+        # events nest one level deep, so no input recurses without limit
+        if self.codec.get_event_type(data, offset) is ClientEvent:
+            raise ValueError('ClientEvents can not be nested')
+        return self.codec.decode_from(data, offset)
+
+
+ACTOR_STATE_SCHEMA = (
+    ('actor_id', 'uint32'),
+    ('actor_type', 'actor_type'),
+    ('is_hero', 'bool'),
+    ('speed', 'float'),
+    ('radius', 'float'),
+    ('attack_range', 'uint16'),
+    ('threat_range', 'float'),
+    ('damage_range', 'float_pair'),
+    ('max_health', 'int32'),
+    ('health', 'int32'),
+    ('health_regen', 'int32'),
+    ('wander_radius', 'float'),
+    ('miss_rate', 'float'),
+    ('loot_value', 'int32'),
+    ('wander_timer', 'timer'),
+    ('attack_timer', 'timer'),
+    ('regen_timer', 'timer'),
+    ('pos', 'vec2'),
+    ('target_id', 'optional_id'),
+    ('move_dest', 'vec2'))
+
+# in bitmask order, the fields of ActorDelta.FIELDS
+ACTOR_DELTA_FIELDS = (
+    ('pos', QUANTIZED_VEC2),
+    ('move_dest', QUANTIZED_VEC2),
+    ('health', SMALL_INT),
+    ('target_id', OPTIONAL_ID),
+    ('loot_value', INT32))
+
+
+# fields in constructor argument order
+EVENT_SCHEMAS = {
+    ClientEvent: (('client_id', 'uint32'), ('event', 'event')),
+    ClientConnectedEvent: (('client_id', 'uint32'),),
+    ClientDisconnectedEvent: (('client_id', 'uint32'),),
+    EnterGameEvent: (
+        ('width', 'uint16'), ('height', 'uint16'),
+        ('actor_states', 'actor_states')),
+    DeltaStateEvent: (('actor_deltas', 'actor_deltas'),),
+    ActorSpawnedEvent: (('actor_state', 'actor_state'),),
+    ActorDiedEvent: (('actor_id', 'uint32'),),
+    AttackEvent: (
+        ('attacker_id', 'uint32'), ('victim_id', 'uint32'),
+        ('damage', 'int32')),
+    HealEvent: (('actor_id', 'uint32'), ('heal', 'int32')),
+    LootEvent: (('actor_id', 'uint32'), ('loot', 'int32')),
+    SetTargetEvent: (
+        ('actor_id', 'uint32'), ('target_id', 'optional_id'),
+        ('previous_target_id', 'optional_id')),
+    PlayerActionSpawnMobEvent: (
+        ('actor_type', 'actor_type'), ('pos', 'vec2')),
+    SetViewportEvent: (
+        ('x', 'int32'), ('y', 'int32'), ('width', 'uint16'),
+        ('height', 'uint16')),
+    ActorEnteredViewEvent: (('actor_state', 'actor_state'),),
+    ActorLeftViewEvent: (('actor_id', 'uint32'),),
+    SnapshotChannelEvent: (('port', 'uint16'), ('token', 'uint32')),
+    SnapshotEvent: (
+        ('sequence', 'uint32'), ('baseline_sequence', 'uint32'),
+        ('actor_deltas', 'actor_deltas')),
+    SnapshotAckEvent: (('token', 'uint32'), ('sequence', 'uint32')),
+    CompressionOfferEvent: (('schemes', 'uint32'), ('dictionary_id', 'uint32')),
+}
+
+
+class EventCodec(object):
+    def __init__(self, actor_store, event_types=ALL_EVENT_TYPES,
+                 event_schemas=EVENT_SCHEMAS):
+        actor_types = self.actor_types = sorted(actor_store.get_all_names())
+        if len(actor_types) > 0xffff:
+            raise ValueError('Too many actor types: %d' % (len(actor_types),))
+        self.actor_type_ids = dict(
+            (actor_type, actor_type_id)
+            for actor_type_id, actor_type in enumerate(actor_types))
+
+        self.field_types = {
+            'bool': BOOL,
+            'uint16': UINT16,
+            'uint32': UINT32,
+            'int32': INT32,
+            'float': FLOAT,
+            'optional_id': OPTIONAL_ID,
+            'vec2': VEC2,
+            'float_pair': FLOAT_PAIR,
+            'timer': TIMER,
+            'actor_type': FieldType(
+                'H', self.actor_type_to_wire, self.actor_type_from_wire),
+        }
+
+        actor_state_layout = self.compile_layout(
+            ActorState, ACTOR_STATE_SCHEMA)
+        self.variable_field_types = {
+            'actor_state': ObjectField(actor_state_layout),
+            'actor_states': ObjectListField(actor_state_layout),
+            'actor_deltas': ActorDeltaListField(ACTOR_DELTA_FIELDS),
+            'event': EventField(self),
+        }
+
+        if len(event_types) > 0xff:
+            raise ValueError('Too many event types: %d' % (len(event_types),))
+
+        # event type -> (tag, layout, (name, variable field) or None)
+        self.encoders = {}
+        # tag -> (event type, layout, variable field or None)
+        self.decoders = []
+
+        for tag, event_type in enumerate(event_types):
+            schema = event_schemas[event_type]
+            tail = None
+            if schema and schema[-1][1] in self.variable_field_types:
+                name, field_type_name = schema[-1]
+                tail = (name, self.variable_field_types[field_type_name])
+                schema = schema[:-1]
+
+            layout = self.compile_layout(event_type, schema)
+            self.encoders[event_type] = (tag, layout, tail)
+            self.decoders.append(
+                (event_type, layout, tail[1] if tail else None))
+
+    def compile_layout(self, cls, schema):
+        fields = []
+        for name, field_type_name in schema:
+            if field_type_name not in self.field_types:
+                raise ValueError(
+                    '%s.%s: %s is not a fixed-size field type' %
+                    (cls.__name__, name, field_type_name))
+            fields.append((name, self.field_types[field_type_name]))
+        return Layout(cls, fields)
+
+    def actor_type_to_wire(self, actor_type):
+        try:
+            return (self.actor_type_ids[actor_type],)
+        except KeyError:
+            raise ValueError('Unknown actor type %r' % (actor_type,))
+
+    def actor_type_from_wire(self, values):
+        actor_type_id, = values
+        if actor_type_id >= len(self.actor_types):
+            raise ValueError('Unknown actor type id %d' % (actor_type_id,))
+        return self.actor_types[actor_type_id]
+
+    def encode(self, event):
+        return b''.join(self.iter_encode(event))
+
+    def iter_encode(self, event):
+        """Yield the encoded event in parts, a list of actor states one
+        state at a time, so big events can be encoded incrementally.
+        """
+        try:
+            tag, layout, tail = self.encoders[type(event)]
+        except KeyError:
+            raise ValueError(
+                'No schema for event type %s' % (type(event).__name__,))
+
+        yield TAG.pack(tag)
+        if layout.size:
+            yield layout.pack(event)
+        if tail:
+            name, field = tail
+            yield from field.iter_encode(getattr(event, name))
+
+    def get_event_type(self, data, offset=0):
+        """Return the type of the event at offset in data from its tag
+        alone, or None if the tag is unknown.
+        """
+        if len(data) < offset + TAG.size:
+            return None
+        tag, = TAG.unpack_from(data, offset)
+        if tag >= len(self.decoders):
+            return None
+        return self.decoders[tag][0]
+
+    def decode(self, data):
+        """Return the event in data. Malformed data raises ValueError."""
+        try:
+            event, offset = self.decode_from(data, 0)
+        except struct.error as e:
+            raise ValueError('Truncated event: %s' % (e,))
+        if offset != len(data):
+            raise ValueError(
+                '%d bytes left after decoding %s' %
+                (len(data) - offset, type(event).__name__))
+        return event
+
+    def decode_from(self, data, offset):
+        tag, = TAG.unpack_from(data, offset)
+        if tag >= len(self.decoders):
+            raise ValueError('Unknown event tag %d' % (tag,))
+
+        event_type, layout, tail = self.decoders[tag]
+        args, offset = layout.unpack_from(data, offset + TAG.size)
+        if tail:
+            value, offset = tail.decode(data, offset)
+            args.append(value)
+        return event_type(*args), offset
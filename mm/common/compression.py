@@ -0,0 +1,205 @@
+"""Compression of the messages on a Channel.
+
+Every message starts with a byte naming how it was compressed:
+
+ * COMPRESSION_NONE: not at all, for messages below the size threshold,
+   where compression costs more than it saves.
+ * COMPRESSION_MESSAGE: a zlib stream of its own, the only scheme before
+   the peer's CompressionOfferEvent comes in.
+ * COMPRESSION_STREAM: the next part of one zlib stream per direction of a
+   connection, sync flushed after every message, so later messages can
+   refer back to earlier ones.
+ * COMPRESSION_STREAM_DICTIONARY: the same, with the stream primed with a
+   preset dictionary trained on recorded traffic.
+
+Both ends of a connection send a CompressionOfferEvent with the schemes
+they can decompress and the id of their dictionary as their first event.
+A sender picks the best scheme both ends support once the offer of the
+other end arrives. Since every message names its scheme, nothing has to
+wait for the negotiation.
+
+As in the permessage-deflate extension of WebSocket, the four bytes every
+sync flush ends with are left out on the wire.
+"""
+
+import collections
+import logging
+import zlib
+
+from mm.common.events import CompressionOfferEvent
+
+LOG = logging.getLogger(__name__)
+
+COMPRESSION_LEVEL = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_MESSAGE = 1
+COMPRESSION_STREAM = 2
+COMPRESSION_STREAM_DICTIONARY = 3
+
+SYNC_FLUSH_TAIL = b'\x00\x00\xff\xff'
+
+# zlib only looks back this far
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+
+def get_dictionary_id(dictionary):
+    if not dictionary:
+        return 0
+    # zero stands for no dictionary
+    return zlib.crc32(dictionary) or 1
+
+
+def load_dictionary(filename):
+    with open(filename, 'rb') as dictionary_file:
+        return dictionary_file.read()
+
+
+def train_dictionary(messages, size=MAX_DICTIONARY_SIZE, segment_size=8):
+    """Build a preset dictionary from recorded uncompressed messages, out
+    of the segment_size byte segments that occur in most of them. The most
+    common segments go last, where they are cheapest to refer to.
+    """
+    counts = collections.Counter()
+    for message in messages:
+        message = bytes(message)
+        segments = set(
+            message[start:start + segment_size]
+            for start in range(len(message) - segment_size + 1))
+        counts.update(segments)
+
+    segments = [
+        segment for segment, count in counts.most_common(
+            size // segment_size) if count > 1]
+    return b''.join(reversed(segments))
+
+
+class Compression(object):
+    """Compression settings of a connection, shared by its channels."""
+
+    DEFAULT_MIN_SIZE = 16
+
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, dictionary=None,
+                 enable_streams=True):
+        if dictionary and len(dictionary) > MAX_DICTIONARY_SIZE:
+            dictionary = dictionary[-MAX_DICTIONARY_SIZE:]
+        self.min_size = min_size
+        self.dictionary = dictionary or None
+        self.dictionary_id = get_dictionary_id(dictionary)
+
+        self.schemes = [COMPRESSION_NONE, COMPRESSION_MESSAGE]
+        if enable_streams:
+            self.schemes.append(COMPRESSION_STREAM)
+            if self.dictionary:
+                self.schemes.append(COMPRESSION_STREAM_DICTIONARY)
+
+    def get_offer(self):
+        return CompressionOfferEvent(
+            sum(1 << scheme for scheme in self.schemes), self.dictionary_id)
+
+    def create_compressor(self):
+        return MessageCompressor(self)
+
+    def create_decompressor(self, max_size):
+        return MessageDecompressor(self, max_size)
+
+
+class MessageCompressor(object):
+    """Compresses the outbound messages of one connection, in the order they
+    go out on the wire.
+    """
+
+    def __init__(self, compression):
+        self.compression = compression
+        self.scheme = COMPRESSION_MESSAGE
+        self.compressobj = None
+
+    def on_peer_offer(self, event):
+        if self.compressobj:
+            # the stream has started, it can not change any more
+            return
+
+        compression = self.compression
+        schemes = [
+            scheme for scheme in compression.schemes
+            if event.schemes & (1 << scheme)]
+
+        if (COMPRESSION_STREAM_DICTIONARY in schemes and
+            event.dictionary_id == compression.dictionary_id):
+            self.scheme = COMPRESSION_STREAM_DICTIONARY
+        elif COMPRESSION_STREAM in schemes:
+            self.scheme = COMPRESSION_STREAM
+        else:
+            self.scheme = COMPRESSION_MESSAGE
+        LOG.debug('Compressing messages with scheme %d', self.scheme)
+
+    def compress(self, data):
+        if len(data) < self.compression.min_size:
+            return b'\x00' + data
+
+        scheme = self.scheme
+        if scheme == COMPRESSION_MESSAGE:
+            compressed_data = zlib.compress(data, COMPRESSION_LEVEL)
+            if len(compressed_data) >= len(data):
+                return b'\x00' + data
+            return b'\x01' + compressed_data
+
+        compressobj = self.compressobj
+        if compressobj is None:
+            if scheme == COMPRESSION_STREAM_DICTIONARY:
+                compressobj = zlib.compressobj(
+                    COMPRESSION_LEVEL, zdict=self.compression.dictionary)
+            else:
+                compressobj = zlib.compressobj(COMPRESSION_LEVEL)
+            self.compressobj = compressobj
+
+        compressed_data = (
+            compressobj.compress(data) + compressobj.flush(zlib.Z_SYNC_FLUSH))
+        # the stream can not skip data, so this is sent even if it grew
+        return bytes((scheme,)) + compressed_data[:-len(SYNC_FLUSH_TAIL)]
+
+
+class MessageDecompressor(object):
+    def __init__(self, compression, max_size):
+        self.compression = compression
+        self.max_size = max_size
+        self.decompressobj = None
+        self.stream_scheme = None
+
+    def decompress(self, data):
+        if not data:
+            raise RuntimeError('Empty message')
+
+        scheme = data[0]
+        if scheme == COMPRESSION_NONE:
+            return data[1:]
+
+        if scheme == COMPRESSION_MESSAGE:
+            decompressobj = zlib.decompressobj()
+            message_data = decompressobj.decompress(data[1:], self.max_size)
+            if decompressobj.unconsumed_tail or not decompressobj.eof:
+                raise RuntimeError('Bad or oversized compressed message')
+            return message_data
+
+        if scheme not in (COMPRESSION_STREAM, COMPRESSION_STREAM_DICTIONARY):
+            raise RuntimeError('Unknown compression scheme %d' % (scheme,))
+
+        decompressobj = self.decompressobj
+        if decompressobj is None:
+            if scheme == COMPRESSION_STREAM_DICTIONARY:
+                if not self.compression.dictionary:
+                    raise RuntimeError('Peer compresses with a dictionary')
+                decompressobj = zlib.decompressobj(
+                    zdict=self.compression.dictionary)
+            else:
+                decompressobj = zlib.decompressobj()
+            self.decompressobj = decompressobj
+            self.stream_scheme = scheme
+        elif scheme != self.stream_scheme:
+            raise RuntimeError('Compression stream changed scheme')
+
+        message_data = decompressobj.decompress(
+            bytes(data[1:]) + SYNC_FLUSH_TAIL, self.max_size)
+        if decompressobj.unconsumed_tail:
+            raise RuntimeError('Oversized compressed message')
+        return message_data
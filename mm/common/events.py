@@ -1,20 +1,15 @@
-import pickle
-
-
-def serialize_event_to_string(event):
-    return pickle.dumps(event)
-
-
-def serialize_event_from_string(string):
-    return pickle.loads(string)
-
-
 class ClientEvent(object):
     def __init__(self, client_id, event):
         self.client_id = client_id
         self.event = event
 
 
+class CompressionOfferEvent(object):
+    def __init__(self, schemes, dictionary_id):
+        self.schemes = schemes
+        self.dictionary_id = dictionary_id
+
+
 class ClientConnectedEvent(object):
     def __init__(self, client_id):
         self.client_id = client_id
@@ -33,8 +28,8 @@ class EnterGameEvent(object):
 
 
 class DeltaStateEvent(object):
-    def __init__(self, actor_states):
-        self.actor_states = actor_states
+    def __init__(self, actor_deltas):
+        self.actor_deltas = actor_deltas
 
 
 class ActorSpawnedEvent(object):
@@ -73,12 +68,49 @@ class SetTargetEvent(object):
         self.previous_target_id = previous_target_id
 
 
+class ActorEnteredViewEvent(object):
+    def __init__(self, actor_state):
+        self.actor_state = actor_state
+
+
+class ActorLeftViewEvent(object):
+    def __init__(self, actor_id):
+        self.actor_id = actor_id
+
+
 class PlayerActionSpawnMobEvent(object):
     def __init__(self, actor_type, pos):
         self.actor_type = actor_type
         self.pos = pos
 
 
+class SetViewportEvent(object):
+    def __init__(self, x, y, width, height):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+
+class SnapshotChannelEvent(object):
+    def __init__(self, port, token):
+        self.port = port
+        self.token = token
+
+
+class SnapshotEvent(object):
+    def __init__(self, sequence, baseline_sequence, actor_deltas):
+        self.sequence = sequence
+        self.baseline_sequence = baseline_sequence
+        self.actor_deltas = actor_deltas
+
+
+class SnapshotAckEvent(object):
+    def __init__(self, token, sequence):
+        self.token = token
+        self.sequence = sequence
+
+
 ALL_GAME_EVENT_TYPES = [
     ActorSpawnedEvent, ActorDiedEvent, AttackEvent, HealEvent, LootEvent,
     SetTargetEvent]
@@ -86,33 +118,66 @@ ALL_GAME_EVENT_TYPES = [
 ALL_SERVER_EVENT_TYPES = [
     ClientEvent, ClientConnectedEvent, ClientDisconnectedEvent]
 
-ALL_PLAYER_EVENT_TYPES = [PlayerActionSpawnMobEvent]
+ALL_PLAYER_EVENT_TYPES = [PlayerActionSpawnMobEvent, SetViewportEvent]
+
+ALL_VIEW_EVENT_TYPES = [ActorEnteredViewEvent, ActorLeftViewEvent]
+
+ALL_SNAPSHOT_EVENT_TYPES = [
+    SnapshotChannelEvent, SnapshotEvent, SnapshotAckEvent]
+
+# handled by the Channel itself, never posted
+ALL_CHANNEL_EVENT_TYPES = [CompressionOfferEvent]
 
 ALL_EVENT_TYPES = \
     ALL_GAME_EVENT_TYPES + \
     ALL_SERVER_EVENT_TYPES + \
     ALL_PLAYER_EVENT_TYPES + \
-    [EnterGameEvent, DeltaStateEvent]
+    [EnterGameEvent, DeltaStateEvent] + \
+    ALL_VIEW_EVENT_TYPES + \
+    ALL_SNAPSHOT_EVENT_TYPES + \
+    ALL_CHANNEL_EVENT_TYPES
 
 
 class EventDistributor(object):
+    """Calls the handlers added for the type of an event, or for any of its
+    base classes, in the order they were added.
+
+    The handlers of every event type are looked up once and kept until a
+    handler is added or removed.
+    """
+
     def __init__(self):
         self.handler_id = 100
         self.handlers = {}
         self.queue = []
 
+        # event type -> tuple of handlers
+        self.dispatch = {}
+
     def add_handler(self, handler, event_types):
         if not isinstance(event_types, (list, tuple)):
             event_types = [event_types]
 
         self.handler_id += 1
         handler_id = self.handler_id
-        self.handlers[handler_id] = (handler, event_types)
+        self.handlers[handler_id] = (handler, frozenset(event_types))
+        self.dispatch = {}
         return self.handler_id
 
     def remove_handler(self, handler_id):
         if handler_id in self.handlers:
             del self.handlers[handler_id]
+            self.dispatch = {}
+
+    def get_handlers(self, event_type):
+        handlers = self.dispatch.get(event_type)
+        if handlers is None:
+            base_types = event_type.__mro__
+            handlers = tuple(
+                handler for handler, event_types in self.handlers.values()
+                if not event_types.isdisjoint(base_types))
+            self.dispatch[event_type] = handlers
+        return handlers
 
     def update(self):
         q = self.queue
@@ -121,9 +186,28 @@ class EventDistributor(object):
             self.send(event)
 
     def send(self, event):
-        for (handler, event_types) in self.handlers.values():
-            if type(event) in event_types:
-                handler(event)
+        for handler in self.get_handlers(type(event)):
+            handler(event)
+
+    def send_many(self, events):
+        """Send a batch of events grouped by type, in the order each type
+        first comes up. Events of a type keep their order, events of
+        different types do not.
+        """
+        events_by_type = {}
+        for event in events:
+            event_type = type(event)
+            same_type_events = events_by_type.get(event_type)
+            if same_type_events is None:
+                events_by_type[event_type] = [event]
+            else:
+                same_type_events.append(event)
+
+        for event_type, same_type_events in events_by_type.items():
+            handlers = self.get_handlers(event_type)
+            for event in same_type_events:
+                for handler in handlers:
+                    handler(event)
 
     def post(self, event):
         self.queue.append(event)
@@ -0,0 +1,165 @@
+"""Area of interest filtering of what the server sends to each client.
+
+Every client has a viewport, declared with SetViewportEvent or derived from
+the world size until it does. A client is only sent the actors within its
+viewport grown by a margin on all sides: their deltas and the game events
+about them. ActorEnteredViewEvent brings the full state of an actor coming
+into view and ActorLeftViewEvent drops one going out of it, so the traffic
+to a client depends on how crowded its surroundings are rather than on the
+size of the world.
+
+Visible actors are found with find_actors_in_rect of the world, which
+walks the spatial grid the world keeps over its actors anyway. With a
+SnapshotServer the states of clients that set up a snapshot channel go
+over UDP instead.
+"""
+
+import logging
+
+import pygame
+
+from mm.common.events import (DeltaStateEvent,
+                              ActorSpawnedEvent,
+                              ActorDiedEvent,
+                              AttackEvent,
+                              ActorEnteredViewEvent,
+                              ActorLeftViewEvent)
+
+LOG = logging.getLogger(__name__)
+
+
+def is_inside(rect, pos):
+    # the same test as find_actors_in_rect, without rounding pos
+    return rect.left <= pos.x < rect.right and rect.top <= pos.y < rect.bottom
+
+
+class ClientInterest(object):
+    def __init__(self, viewport):
+        self.viewport = viewport
+        # actors the client has been sent and not told to drop
+        self.known_ids = set()
+
+
+class InterestManager(object):
+    DEFAULT_MARGIN = 100
+
+    # clients can not ask for all of a big world
+    MAX_VIEWPORT_SIZE = 4096
+
+    def __init__(self, server, world, margin=DEFAULT_MARGIN, snapshots=None):
+        self.server = server
+        self.world = world
+        self.margin = margin
+        self.snapshots = snapshots
+        self.clients = {}
+
+    def get_default_viewport(self):
+        return pygame.Rect(
+            0, 0, min(self.world.width, self.MAX_VIEWPORT_SIZE),
+            min(self.world.height, self.MAX_VIEWPORT_SIZE))
+
+    def get_interest_rect(self, client):
+        return client.viewport.inflate(2 * self.margin, 2 * self.margin)
+
+    def add_client(self, client_id):
+        """Start tracking client_id and return the states of the actors it
+        can see, for its EnterGameEvent.
+        """
+        client = ClientInterest(self.get_default_viewport())
+        self.clients[client_id] = client
+
+        actor_states = self.world.get_actor_states_in_rect(
+            self.get_interest_rect(client))
+        client.known_ids = set(state.actor_id for state in actor_states)
+        return actor_states
+
+    def remove_client(self, client_id):
+        self.clients.pop(client_id, None)
+
+    def set_viewport(self, client_id, x, y, width, height):
+        client = self.clients.get(client_id)
+        if client is None:
+            LOG.warning('Viewport for unknown client %d', client_id)
+            return
+
+        # actors coming into or going out of view are sent on the next tick
+        client.viewport = pygame.Rect(
+            x, y, min(width, self.MAX_VIEWPORT_SIZE),
+            min(height, self.MAX_VIEWPORT_SIZE))
+
+    def on_game_event(self, event):
+        event_type = type(event)
+        client_ids = []
+
+        if event_type is ActorSpawnedEvent:
+            state = event.actor_state
+            for client_id, client in self.clients.items():
+                if is_inside(self.get_interest_rect(client), state.pos):
+                    client.known_ids.add(state.actor_id)
+                    client_ids.append(client_id)
+
+        elif event_type is ActorDiedEvent:
+            for client_id, client in self.clients.items():
+                if event.actor_id in client.known_ids:
+                    client.known_ids.discard(event.actor_id)
+                    client_ids.append(client_id)
+
+        elif event_type is AttackEvent:
+            # the client needs to know both sides to show the attack
+            for client_id, client in self.clients.items():
+                known_ids = client.known_ids
+                if (event.attacker_id in known_ids and
+                    event.victim_id in known_ids):
+                    client_ids.append(client_id)
+
+        else:
+            for client_id, client in self.clients.items():
+                if event.actor_id in client.known_ids:
+                    client_ids.append(client_id)
+
+        # encoded once for all the clients interested in it
+        if client_ids:
+            self.server.multicast_event(client_ids, event)
+
+    def send_states(self, actor_deltas):
+        """Send every client the deltas of the actors it can see, after
+        enter and leave events for the actors that came into or went out of
+        its view since the last call.
+        """
+        deltas_by_id = dict((delta.actor_id, delta) for delta in actor_deltas)
+        send_event = self.server.send_event
+        snapshots = self.snapshots
+        if snapshots:
+            snapshots.receive_acks()
+            snapshots.add_snapshot(actor_deltas)
+
+        for client_id, client in self.clients.items():
+            rect = self.get_interest_rect(client)
+            visible_ids = set(
+                actor.actor_id for actor in self.world.find_actors_in_rect(rect))
+            known_ids = client.known_ids
+            entered_ids = visible_ids - known_ids
+
+            # full states are only needed for actors coming into view
+            states_by_id = None
+            if entered_ids:
+                states_by_id = dict(
+                    (state.actor_id, state)
+                    for state in self.world.get_actor_states_in_rect(rect))
+
+            for actor_id in known_ids - visible_ids:
+                send_event(client_id, ActorLeftViewEvent(actor_id))
+
+            for actor_id in entered_ids:
+                send_event(
+                    client_id, ActorEnteredViewEvent(states_by_id[actor_id]))
+
+            client.known_ids = visible_ids
+
+            if snapshots and snapshots.send_snapshot(
+                    client_id, visible_ids):
+                continue
+
+            send_event(client_id, DeltaStateEvent([
+                deltas_by_id[actor_id] for actor_id in visible_ids & known_ids
+                if actor_id in deltas_by_id]))
@@ -0,0 +1,192 @@
+"""Per tick metrics of the server loop.
+
+TickMetrics times the phases of every tick, and records them along with the
+events distributed, the actors simulated and the bytes that went over the
+client connections into Histograms. Reports cover the ticks since the last
+report, so they are rolling windows of one report interval each.
+
+The server loop only calls into TickMetrics when it has one, so disabled
+metrics cost a check per phase.
+"""
+
+import collections
+import json
+import logging
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """Counts of non-negative integers in log-linear buckets, as in
+    HdrHistogram. Values below 2 ** SUB_BUCKET_BITS get a bucket each,
+    every power of two above is split into half as many buckets, so values
+    are off by less than 2 ** (1 - SUB_BUCKET_BITS) of themselves.
+    """
+
+    SUB_BUCKET_BITS = 7
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self):
+        # bucket index -> count
+        self.counts = collections.defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        value = max(0, int(value))
+        shift = value.bit_length() - self.SUB_BUCKET_BITS
+        if shift > 0:
+            index = (shift << (self.SUB_BUCKET_BITS - 1)) + (value >> shift)
+        else:
+            index = value
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def get_bucket_value(self, index):
+        """Return the lowest value in a bucket."""
+        half_count_bits = self.SUB_BUCKET_BITS - 1
+        shift = (index >> half_count_bits) - 1
+        if shift <= 0:
+            return index
+        return (index - (shift << half_count_bits)) << shift
+
+    def get_percentile(self, percentile):
+        if not self.count:
+            return 0
+        # the rank of the value, counting from one
+        rank = max(1, int(percentile / 100. * self.count + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.get_bucket_value(index), self.max)
+        return self.max
+
+    def get_summary(self, scale=1.):
+        summary = {
+            'count': self.count,
+            'mean': scale * self.total / self.count if self.count else 0.,
+            'max': scale * self.max,
+        }
+        for percentile in self.PERCENTILES:
+            summary['p%g' % (percentile,)] = (
+                scale * self.get_percentile(percentile))
+        return summary
+
+
+class TickMetrics(object):
+    """Records what every server tick did, and reports it once per
+    interval, as a log line or as a line of JSON appended to a file.
+    """
+
+    # phase times are recorded in microseconds, reported in milliseconds
+    PHASE_SCALE = 1e6
+
+    def __init__(self, server, world, filename=None):
+        self.server = server
+        self.world = world
+        self.filename = filename
+
+        self.tick_start = None
+        self.phase_start = None
+        # seconds spent in every phase of the current tick, catch up steps
+        # add to the same phases
+        self.phase_times = {}
+        self.event_count = 0
+
+        # client id -> (received bytes, sent bytes) at the end of last tick
+        self.client_bytes = {}
+
+        self.reset()
+
+    def reset(self):
+        self.interval_start = time.monotonic()
+        self.tick_count = 0
+        self.step_count = 0
+        self.tick_times = Histogram()
+        self.phase_histograms = {}
+        self.event_histogram = Histogram()
+        self.actor_histogram = Histogram()
+        self.bytes_in_histogram = Histogram()
+        self.bytes_out_histogram = Histogram()
+        self.event_counts = collections.Counter()
+
+    def on_event(self, event):
+        self.event_counts[type(event).__name__] += 1
+        self.event_count += 1
+
+    def start_tick(self):
+        self.tick_start = self.phase_start = time.perf_counter()
+
+    def end_phase(self, name):
+        now = time.perf_counter()
+        self.phase_times[name] = (
+            self.phase_times.get(name, 0.) + now - self.phase_start)
+        self.phase_start = now
+
+    def end_tick(self, num_ticks):
+        scale = self.PHASE_SCALE
+        self.tick_times.record((time.perf_counter() - self.tick_start) * scale)
+        for name, seconds in self.phase_times.items():
+            histogram = self.phase_histograms.get(name)
+            if histogram is None:
+                histogram = self.phase_histograms[name] = Histogram()
+            histogram.record(seconds * scale)
+        self.phase_times = {}
+
+        self.tick_count += 1
+        self.step_count += num_ticks
+        self.event_histogram.record(self.event_count)
+        self.event_count = 0
+        self.actor_histogram.record(self.world.get_actor_count())
+
+        bytes_in = 0
+        bytes_out = 0
+        client_bytes = {}
+        last_client_bytes = self.client_bytes
+        for client_id, stats in self.server.get_client_stats().items():
+            received, sent = client_bytes[client_id] = (
+                stats['received_bytes'], stats['sent_bytes'])
+            last_received, last_sent = last_client_bytes.get(client_id, (0, 0))
+            bytes_in += received - last_received
+            bytes_out += sent - last_sent
+        self.client_bytes = client_bytes
+        self.bytes_in_histogram.record(bytes_in)
+        self.bytes_out_histogram.record(bytes_out)
+
+    def get_report(self):
+        """Return the metrics of the ticks since the last report, and start
+        a new interval.
+        """
+        milliseconds = 1000. / self.PHASE_SCALE
+        report = {
+            'time': time.time(),
+            'interval': time.monotonic() - self.interval_start,
+            'ticks': self.tick_count,
+            'steps': self.step_count,
+            'clients': len(self.client_bytes),
+            'tick_ms': self.tick_times.get_summary(milliseconds),
+            'phase_ms': dict(
+                (name, histogram.get_summary(milliseconds))
+                for name, histogram in self.phase_histograms.items()),
+            'events_per_tick': self.event_histogram.get_summary(),
+            'event_counts': dict(self.event_counts),
+            'actors': self.actor_histogram.get_summary(),
+            'bytes_in_per_tick': self.bytes_in_histogram.get_summary(),
+            'bytes_out_per_tick': self.bytes_out_histogram.get_summary(),
+        }
+        self.reset()
+        return report
+
+    def write_report(self):
+        report = json.dumps(self.get_report(), sort_keys=True)
+        if self.filename:
+            with open(self.filename, 'a') as metrics_file:
+                metrics_file.write(report + '\n')
+        else:
+            LOG.info('Tick metrics: %s', report)
@@ -1,19 +1,22 @@
+import collections
 import logging
 import socket
 import select
 import struct
+import time
 import zlib
 
-from mm.common.events import (serialize_event_to_string,
-                              serialize_event_from_string,
-                              ClientConnectedEvent,
+from mm.common.compression import Compression, COMPRESSION_LEVEL
+from mm.common.events import (ClientConnectedEvent,
                               ClientDisconnectedEvent,
-                              ClientEvent)
+                              ClientEvent,
+                              CompressionOfferEvent,
+                              DeltaStateEvent)
+from mm.common.world import merge_actor_deltas
 
 LOG = logging.getLogger(__name__)
 
 DEFAULT_NETWORK_PORT = 8888
-COMPRESSION_LEVEL = 1
 
 
 def compress_data(data):
@@ -24,143 +27,328 @@ def decompress_data(data):
     return zlib.decompress(data)
 
 
+UINT8 = struct.Struct('!B')
+INT16 = struct.Struct('!h')
+UINT16 = struct.Struct('!H')
+INT32 = struct.Struct('!i')
+UINT32 = struct.Struct('!I')
+FLOAT = struct.Struct('!f')
+
+# consumed bytes at the front of a buffer are only dropped once there are
+# this many of them, and at least as many as there are bytes left to move
+COMPACT_THRESHOLD = 4096
+
+
+def _compact(buffer, offset):
+    if offset == len(buffer) or (
+            offset >= COMPACT_THRESHOLD and 2 * offset >= len(buffer)):
+        try:
+            del buffer[:offset]
+        except BufferError:
+            # a memoryview handed out earlier still points into the buffer,
+            # leave it be and continue in a copy of the tail
+            buffer = buffer[offset:]
+        offset = 0
+    return buffer, offset
+
+
+def _append(buffer, data):
+    try:
+        buffer += data
+    except BufferError:
+        buffer = buffer + data
+    return buffer
+
+
 class WriteBuffer(object):
+    """Growable output buffer. Sent data is skipped by moving an offset
+    and only dropped from the front once enough of it has piled up.
+    """
+
     def __init__(self, max_size=None):
         self.buffer = bytearray()
+        self.offset = 0
         self.max_size = max_size
 
     def get_buffer_data(self):
-        return self.buffer
+        # a view, so the data isn't copied to hand it to a socket
+        return memoryview(self.buffer)[self.offset:]
 
     def get_buffer_size(self):
-        return len(self.buffer)
+        return len(self.buffer) - self.offset
 
     def is_empty(self):
-        return len(self.buffer) == 0
+        return len(self.buffer) == self.offset
 
     def can_write(self, length=1):
         if self.max_size is None:
             return True
         else:
-            return len(self.buffer) + length <= self.max_size
+            return len(self.buffer) - self.offset + length <= self.max_size
 
     def skip(self, length):
-        if len(self.buffer) >= length:
-            self.buffer = self.buffer[length:]
+        if len(self.buffer) - self.offset >= length:
+            self.buffer, self.offset = _compact(
+                self.buffer, self.offset + length)
         else:
             raise RuntimeError(
                 'Not enough data in buffer to skip %d bytes' % (length,))
 
     def _write(self, data):
         if self.can_write(len(data)):
-            self.buffer += data
+            self.buffer = _append(self.buffer, data)
             return True
         else:
             return False
 
     def write_bytes(self, data):
-        return (self.can_write(2 + len(data)) and
-                self.write_uint16(len(data)) and
-                self._write(data))
+        if not self.can_write(2 + len(data)):
+            return False
+        buffer = _append(self.buffer, UINT16.pack(len(data)))
+        self.buffer = _append(buffer, data)
+        return True
 
     def write_string(self, string):
         return self.write_bytes(string.encode('utf-8'))
 
+    def write_uint8(self, data):
+        return self._write(UINT8.pack(data))
+
     def write_int16(self, data):
-        return self.can_write(2) and self._write(struct.pack('!h', data))
+        return self._write(INT16.pack(data))
 
     def write_uint16(self, data):
-        return self.can_write(2) and self._write(struct.pack('!H', data))
+        return self._write(UINT16.pack(data))
 
     def write_int32(self, data):
-        return self.can_write(4) and self._write(struct.pack('!i', data))
+        return self._write(INT32.pack(data))
 
     def write_uint32(self, data):
-        return self.can_write(4) and self._write(struct.pack('!I', data))
+        return self._write(UINT32.pack(data))
 
     def write_float(self, data):
-        return self.can_write(4) and self._write(struct.pack('!f', data))
+        return self._write(FLOAT.pack(data))
 
 
 class ReadBuffer(object):
+    """Input buffer read through a cursor.
+
+    Reads return memoryview slices of the buffer instead of copies. They
+    stay valid after later reads and feeds, since the buffer is never
+    changed in place while a view is alive.
+    """
+
     def __init__(self, buf=None):
         if buf:
             self.buffer = buf
         else:
             self.buffer = bytearray()
+        self.offset = 0
 
     def get_buffer_data(self):
-        return self.buffer
+        return memoryview(self.buffer)[self.offset:]
 
     def get_buffer_size(self):
-        return len(self.buffer)
+        return len(self.buffer) - self.offset
 
     def feed(self, data):
-        self.buffer += data
+        if not isinstance(self.buffer, bytearray):
+            # started out reading someone else's bytes
+            self.buffer = bytearray(self.buffer[self.offset:])
+            self.offset = 0
+        buffer, self.offset = _compact(self.buffer, self.offset)
+        self.buffer = _append(buffer, data)
 
     def peek(self, length):
         if self.can_read(length):
-            return self.buffer[:length]
+            return memoryview(self.buffer)[self.offset:self.offset + length]
         else:
             return None
 
     def can_read(self, length=1):
-        return len(self.buffer) >= length
+        return len(self.buffer) - self.offset >= length
 
     def skip(self, length):
         if self.can_read(length):
-            self.buffer = self.buffer[length:]
+            self.offset += length
 
     def _read(self, length):
-        if len(self.buffer) >= length:
-            data = self.buffer[:length]
-            self.buffer = self.buffer[length:]
-            return data
+        if self.can_read(length):
+            offset = self.offset
+            self.offset = offset + length
+            return memoryview(self.buffer)[offset:offset + length]
         else:
             return None
 
-    def read_bytes(self):
-        length = struct.unpack('!H', self.peek(2))[0]
-        if self.can_read(2 + length):
-            self.skip(2)
-            return self._read(length)
+    def _unpack(self, fmt):
+        if self.can_read(fmt.size):
+            value, = fmt.unpack_from(self.buffer, self.offset)
+            self.offset += fmt.size
+            return value
         else:
             return None
 
+    def read_bytes(self):
+        # hot when parsing messages, so it doesn't go through can_read
+        buffer = self.buffer
+        offset = self.offset
+        if len(buffer) - offset < 2:
+            return None
+        length, = UINT16.unpack_from(buffer, offset)
+        start = offset + 2
+        end = start + length
+        if end > len(buffer):
+            return None
+        self.offset = end
+        return memoryview(buffer)[start:end]
+
     def read_string(self):
-        return self.read_bytes().decode('utf-8')
+        return str(self.read_bytes(), 'utf-8')
+
+    def read_uint8(self):
+        return self._unpack(UINT8)
 
     def read_int16(self):
-        data = self._read(2)
-        if data:
-            data = struct.unpack('!h', data)[0]
-        return data
+        return self._unpack(INT16)
 
     def read_uint16(self):
-        data = self._read(2)
-        if data:
-            data = struct.unpack('!H', data)[0]
-        return data
+        return self._unpack(UINT16)
 
     def read_int32(self):
-        data = self._read(4)
-        if data:
-            data = struct.unpack('!i', data)[0]
-        return data
+        return self._unpack(INT32)
 
     def read_uint32(self):
-        data = self._read(2)
-        if data:
-            data = struct.unpack('!I', data)[0]
-        return data
+        return self._unpack(UINT32)
+
+
+# a zero length record in a message is followed by one fragment of an
+# event too big for a message: its index, a last fragment flag and the data
+FRAGMENT_MARKER = 0
+FRAGMENT_HEADER_SIZE = 2 + 4 + 1 + 2
+
+
+class EncodedEvent(object):
+    """An event encoded once, to be packed into the messages of several
+    clients.
+    """
+
+    __slots__ = ('event', 'data')
+
+    def __init__(self, event, data):
+        self.event = event
+        self.data = data
+
+
+class SharedMessages(object):
+    """Events packed into messages once, queued like an event on the
+    channels of all the clients they go to.
+    """
+
+    __slots__ = ('events', 'messages')
+
+    def __init__(self, events, messages):
+        self.events = events
+        self.messages = messages
+
+
+def pack_events(codec, events, max_message_size):
+    """Encode events and pack them into messages of at most
+    max_message_size bytes, yielding the uncompressed message data.
+
+    Events too big for a message are split into fragments, one per message.
+    Encoding is lazy, so a caller pulling a few messages at a time only
+    holds those in memory, not the whole encoded event.
+    """
+    message_writer = WriteBuffer(max_message_size)
+    max_event_size = max_message_size - 2
+
+    for event in events:
+        if type(event) is EncodedEvent:
+            chunks = iter((event.data,))
+        else:
+            chunks = codec.iter_encode(event)
+
+        # encode until the event is done or known not to fit in a message
+        serialized_event = bytearray()
+        is_complete = True
+        for chunk in chunks:
+            serialized_event += chunk
+            if len(serialized_event) > max_event_size:
+                is_complete = False
+                break
+
+        if not is_complete:
+            if not message_writer.is_empty():
+                yield message_writer.get_buffer_data()
+                message_writer = WriteBuffer(max_message_size)
+
+            for message_data in pack_fragments(
+                    serialized_event, chunks, max_message_size):
+                yield message_data
+
+        elif not message_writer.write_bytes(serialized_event):
+            # send message and continue with the next
+            yield message_writer.get_buffer_data()
+            message_writer = WriteBuffer(max_message_size)
+            if not message_writer.write_bytes(serialized_event):
+                raise RuntimeError('Failed to write event')
+
+    # send remaining data
+    if not message_writer.is_empty():
+        yield message_writer.get_buffer_data()
+
+
+def pack_fragments(data, chunks, max_message_size):
+    # data is the start of the encoded event, chunks yields the rest
+    fragment_size = max_message_size - FRAGMENT_HEADER_SIZE
+    fragment_index = 0
+    is_last = False
+
+    while not is_last:
+        # only a fragment with nothing left after it is the last one
+        while len(data) <= fragment_size:
+            chunk = next(chunks, None)
+            if chunk is None:
+                is_last = True
+                break
+            data += chunk
+
+        message_writer = WriteBuffer(max_message_size)
+        message_writer.write_uint16(FRAGMENT_MARKER)
+        message_writer.write_uint32(fragment_index)
+        message_writer.write_uint8(1 if is_last else 0)
+        message_writer.write_bytes(data[:fragment_size])
+        yield message_writer.get_buffer_data()
+
+        del data[:fragment_size]
+        fragment_index += 1
 
 
 class Channel(object):
     MAX_MESSAGE_SIZE = 8192
-    MAX_RECEIVE_SIZE = 8192
+    MAX_RECEIVE_SIZE = 65536
+
+    # stop pulling more outbound messages while this much is waiting to be
+    # sent, so a huge event is streamed over several ticks
+    MAX_WRITE_BUFFER_SIZE = 64 * 1024
+
+    # a peer that has taken no more data for this long, or has this many
+    # events waiting meanwhile, is not keeping up
+    MAX_BEHIND_TIME = 10.
+    MAX_QUEUED_EVENTS = 4096
+
+    # refuse to reassemble fragmented events bigger than this
+    MAX_EVENT_SIZE = 64 * 1024 * 1024
 
-    def __init__(self, sock):
+    def __init__(self, sock, codec, compression=None):
         self.sock = sock
+        self.codec = codec
+
+        if compression is None:
+            compression = Compression()
+        self.compressor = compression.create_compressor()
+        self.decompressor = compression.create_decompressor(
+            self.MAX_MESSAGE_SIZE)
 
         # in- and outbound buffers
         self.write_buffer = WriteBuffer()
@@ -176,6 +364,31 @@ class Channel(object):
         self.in_events = []
         self.out_events = []
 
+        # index in out_events of the DeltaStateEvent newer ones are merged
+        # into, and how many were merged away
+        self.state_event_index = None
+        self.dropped_state_count = 0
+
+        # whether the peer took no more data on the last send, and since
+        # when it has been blocked, None while it keeps up
+        self.is_blocked = False
+        self.behind_since = None
+
+        # bytes that went over the socket, before decompression
+        self.received_bytes = 0
+        self.sent_bytes = 0
+
+        # iterators over messages, compressed as they go into the write
+        # buffer, so a compression stream sees them in wire order
+        self.out_messages = collections.deque()
+
+        # event being reassembled from fragments
+        self.fragment_data = bytearray()
+        self.fragment_index = 0
+
+        # the peer needs this before it can pick a compression scheme
+        self.send_event(compression.get_offer())
+
     def synchronize(self):
         return self.send_data() and self.receive_data()
 
@@ -192,6 +405,7 @@ class Channel(object):
                     return False
 
                 # handle recevied data
+                self.received_bytes += len(data)
                 self.read_buffer.feed(data)
                 self.on_data_received()
 
@@ -200,57 +414,82 @@ class Channel(object):
             LOG.exception('Socket error')
             return False
 
-    def send_message(self, message_data):
-        compressed_message_data = compress_data(message_data)
-
-        #LOG.debug(
-        #    'Compression %d -> %d bytes, compression factor %f',
-        #    len(message_data), len(compressed_message_data),
-        #    float(len(compressed_message_data)) / len(message_data))
-
+    def write_message(self, message_data):
         self.write_buffer.write_int32(self.send_message_id)
-        self.write_buffer.write_bytes(compressed_message_data)
+        self.write_buffer.write_bytes(self.compressor.compress(message_data))
 
         self.send_message_id += 1
 
     def send_all_events(self):
-        message_writer = WriteBuffer(self.MAX_MESSAGE_SIZE)
-
+        # messages are encoded as they are pulled, shared messages only
+        # have to be compressed
+        events = []
         for event in self.out_events:
-            # serialize event to string
-            serialized_event = serialize_event_to_string(event)
+            if type(event) is SharedMessages:
+                if events:
+                    self.out_messages.append(pack_events(
+                        self.codec, events, self.MAX_MESSAGE_SIZE))
+                    events = []
+                self.out_messages.append(iter(event.messages))
+            else:
+                events.append(event)
+        if events:
+            self.out_messages.append(pack_events(
+                self.codec, events, self.MAX_MESSAGE_SIZE))
 
-            if not message_writer.write_bytes(serialized_event):
-                if len(serialized_event) > self.MAX_MESSAGE_SIZE:
+        # no outbound events left
+        self.out_events = []
+        self.state_event_index = None
+
+    def fill_write_buffer(self):
+        out_messages = self.out_messages
+        write_buffer = self.write_buffer
+        while write_buffer.get_buffer_size() < self.MAX_WRITE_BUFFER_SIZE:
+            if not out_messages:
+                if not self.out_events:
+                    break
+                # events are only encoded once everything before them is in
+                # the write buffer, until then state events can be merged
+                self.send_all_events()
 
-                    # TODO(fpj):
-                    # This will crash the game when there are a lot of entities
-                    # in the world. I haven't checked but it's probably the
-                    # DeltaStateEvent that becomes too large if there are a lot
-                    # of actors in it.
+            message_data = next(out_messages[0], None)
+            if message_data is None:
+                out_messages.popleft()
+            else:
+                self.write_message(message_data)
+
+    def has_pending_data(self):
+        return bool(self.out_events or self.out_messages or
+                    not self.write_buffer.is_empty())
+
+    def is_over_budget(self, now):
+        """Track whether the peer keeps up with the events sent to it, and
+        return True once it has been blocked for too long. Queued events,
+        like the rest of a big fragmented event, only count while the peer
+        takes no more data.
+        """
+        if not (self.is_blocked and self.has_pending_data()):
+            self.behind_since = None
+            return False
 
-                    # event will never fit in a message
-                    raise RuntimeError(
-                        'Event size %d too big' % (len(serialized_event),))
-                else:
-                    # send message and continue with the next
-                    self.send_message(message_writer.get_buffer_data())
-                    message_writer = WriteBuffer(self.MAX_MESSAGE_SIZE)
-                    if not message_writer.write_bytes(serialized_event):
-                        raise RuntimeError('Failed to write event')
-
-        # send remaining data
-        if not message_writer.is_empty():
-            self.send_message(message_writer.get_buffer_data())
+        if self.behind_since is None:
+            self.behind_since = now
+        return (len(self.out_events) > self.MAX_QUEUED_EVENTS or
+                now - self.behind_since > self.MAX_BEHIND_TIME)
 
-        # no outbound events left
-        self.out_events = []
+    def get_stats(self):
+        return {
+            'queued_events': len(self.out_events),
+            'queued_bytes': self.write_buffer.get_buffer_size(),
+            'dropped_states': self.dropped_state_count,
+            'received_bytes': self.received_bytes,
+            'sent_bytes': self.sent_bytes,
+        }
 
     def send_data(self):
         try:
-            # serialize and send all outbound events
-            if self.out_events:
-                self.send_all_events()
+            # serialize and send outbound events, as far as the peer keeps up
+            self.fill_write_buffer()
 
             # check if we have anything to send, and try to send it
             if not self.write_buffer.is_empty():
@@ -266,6 +505,13 @@ class Channel(object):
                         return False
 
                     self.write_buffer.skip(bytes_sent)
+                    self.sent_bytes += bytes_sent
+
+                self.is_blocked = (
+                    not writable or self.write_buffer.get_buffer_size() >=
+                    self.MAX_WRITE_BUFFER_SIZE)
+            else:
+                self.is_blocked = False
 
             return True
         except socket.error:
@@ -273,10 +519,13 @@ class Channel(object):
             return False
 
     def on_data_received(self):
-        # read message id
-        if not self.recv_message_id:
-            message_id = self.read_buffer.read_int32()
-            if message_id:
+        # a single read can hold several messages, or only part of one
+        while True:
+            # read message id
+            if not self.recv_message_id:
+                message_id = self.read_buffer.read_int32()
+                if not message_id:
+                    break
                 if (self.recv_message_id and
                     self.recv_message_id != (message_id - 1)):
                     raise RuntimeError(
@@ -284,22 +533,24 @@ class Channel(object):
                         (self.recv_message_id, message_id))
                 self.recv_message_id = message_id
 
-        # read message data
-        if self.recv_message_id:
+            # read message data
             message_data = self.read_buffer.read_bytes()
-            if message_data:
-                self.on_message_received(decompress_data(message_data))
+            if message_data is None:
+                break
+            self.on_message_received(
+                self.decompressor.decompress(message_data))
 
     def on_message_received(self, message_data):
         event_reader = ReadBuffer(message_data)
         while event_reader.can_read():
             serialized_event = event_reader.read_bytes()
-            if serialized_event:
-                self.in_events.append(
-                    serialize_event_from_string(serialized_event))
-            else:
+            if serialized_event is None:
                 # no more events
                 break
+            elif len(serialized_event) == FRAGMENT_MARKER:
+                self.on_fragment_received(event_reader)
+            else:
+                self.on_event_received(self.codec.decode(serialized_event))
 
         if event_reader.can_read():
             LOG.warning(
@@ -309,8 +560,66 @@ class Channel(object):
         # ready for next message
         self.recv_message_id = None
 
+    def on_fragment_received(self, event_reader):
+        fragment_index = event_reader.read_uint32()
+        is_last = event_reader.read_uint8()
+        fragment_data = event_reader.read_bytes()
+        if fragment_data is None:
+            raise RuntimeError('Truncated fragment')
+
+        if fragment_index != self.fragment_index:
+            raise RuntimeError(
+                'Fragment out of sync %d != %d' %
+                (fragment_index, self.fragment_index))
+
+        if len(self.fragment_data) + len(fragment_data) > self.MAX_EVENT_SIZE:
+            raise RuntimeError(
+                'Fragmented event bigger than %d bytes' %
+                (self.MAX_EVENT_SIZE,))
+
+        self.fragment_data += fragment_data
+        self.fragment_index += 1
+
+        if is_last:
+            serialized_event = self.fragment_data
+            self.fragment_data = bytearray()
+            self.fragment_index = 0
+            self.on_event_received(self.codec.decode(serialized_event))
+
+    def on_event_received(self, event):
+        if type(event) is CompressionOfferEvent:
+            self.compressor.on_peer_offer(event)
+        else:
+            self.in_events.append(event)
+
     def send_event(self, event):
-        self.out_events.append(event)
+        out_events = self.out_events
+        if type(event) is DeltaStateEvent:
+            index = self.state_event_index
+            if index is not None:
+                # the peer has not been sent the older state yet, so only
+                # the newest one goes out, after the events queued since
+                event = self.merge_state_events(
+                    out_events.pop(index), event, out_events[index:])
+                self.dropped_state_count += 1
+            self.state_event_index = len(out_events)
+        out_events.append(event)
+
+    def merge_state_events(self, event, newer_event, events_between):
+        # actors that entered the view or spawned in between come with their
+        # full state, older changes would overwrite it
+        reset_ids = set()
+        for other_event in events_between:
+            if type(other_event) is SharedMessages:
+                other_events = other_event.events
+            else:
+                other_events = (other_event,)
+            reset_ids.update(
+                shared_event.actor_state.actor_id
+                for shared_event in other_events
+                if hasattr(shared_event, 'actor_state'))
+        return DeltaStateEvent(merge_actor_deltas(
+            event.actor_deltas, newer_event.actor_deltas, reset_ids))
 
     def receive_events(self):
         for event in self.in_events:
@@ -321,8 +630,10 @@ class Channel(object):
 
 
 class Client(object):
-    def __init__(self, event_distributor):
+    def __init__(self, event_distributor, codec, compression=None):
         self.event_distributor = event_distributor
+        self.codec = codec
+        self.compression = compression
         self.server_socket = None
         self.channel = None
 
@@ -336,7 +647,8 @@ class Client(object):
         LOG.info('Connecting to server %s:%d', address, port)
         self.server_socket = socket.create_connection((address, port))
         if self.server_socket:
-            self.channel = Channel(self.server_socket)
+            self.channel = Channel(
+                self.server_socket, self.codec, self.compression)
             return True
         else:
             LOG.info('Failed to connect to server %s:%d', address, port)
@@ -372,13 +684,19 @@ class Client(object):
 
 
 class Server(object):
-    def __init__(self, event_distributor, port):
+    def __init__(self, event_distributor, port, codec, compression=None):
         self.event_distributor = event_distributor
         self.port = port
+        self.codec = codec
+        self.compression = compression
         self.server_socket = None
         self.client_sockets = []
         self.channels = {}
 
+        # broadcast and multicast events as (client ids or None for all
+        # clients, event), packed once for all the clients they go to
+        self.broadcast_events = []
+
     def start_server(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -393,19 +711,102 @@ class Server(object):
     def accept_pending_clients(self):
         readable, _, _ = select.select([self.server_socket], [], [], 0)
         if readable:
+            # the new client must not get broadcasts from before it joined
+            self.flush_broadcast_events()
+
             client_socket, address = self.server_socket.accept()
             self.client_sockets.append(client_socket)
             client_id = client_socket.fileno()
-            self.channels[client_id] = Channel(client_socket)
+            self.channels[client_id] = Channel(
+                client_socket, self.codec, self.compression)
             self.event_distributor.post(ClientConnectedEvent(client_id))
             LOG.info('Client %d connected', client_id)
 
+    def send_event(self, client_id, event):
+        channel = self.channels.get(client_id)
+        if channel is None:
+            # the client is gone, its ClientDisconnectedEvent is still queued
+            return
+
+        # keep the order relative to broadcasts sent earlier
+        self.flush_broadcast_events()
+        channel.send_event(event)
+
     def broadcast_event(self, event):
-        for channel in self.channels.values():
-            channel.send_event(event)
+        self.broadcast_events.append((None, event))
+
+    def multicast_event(self, client_ids, event):
+        """Send event to all clients in client_ids, like broadcast_event
+        does to all clients.
+        """
+        if client_ids:
+            self.broadcast_events.append((client_ids, event))
+
+    def flush_broadcast_events(self):
+        broadcast_events = self.broadcast_events
+        if not broadcast_events:
+            return
+        self.broadcast_events = []
 
-    def send_event(self, client_id, event):
-        self.channels[client_id].send_event(event)
+        channels = self.channels
+        if not channels:
+            return
+
+        # the indices in broadcast_events of the events of every client
+        event_indices = collections.defaultdict(list)
+        for index, (client_ids, _) in enumerate(broadcast_events):
+            if client_ids is None:
+                client_ids = channels
+            for client_id in client_ids:
+                event_indices[client_id].append(index)
+
+        # clients sent the same events share the same messages
+        client_ids_by_indices = collections.defaultdict(list)
+        for client_id, indices in event_indices.items():
+            if client_id in channels:
+                client_ids_by_indices[tuple(indices)].append(client_id)
+
+        # every event is encoded once and every set of events packed once,
+        # every channel compresses with its own stream
+        encoded_events = {}
+        for indices, client_ids in client_ids_by_indices.items():
+            events = []
+            for index in indices:
+                encoded_event = encoded_events.get(index)
+                if encoded_event is None:
+                    event = broadcast_events[index][1]
+                    encoded_event = encoded_events[index] = EncodedEvent(
+                        event, bytes(self.codec.encode(event)))
+                events.append(encoded_event)
+
+            shared_messages = SharedMessages(
+                [encoded_event.event for encoded_event in events],
+                [bytes(message_data) for message_data in pack_events(
+                    self.codec, events, Channel.MAX_MESSAGE_SIZE)])
+            for client_id in client_ids:
+                self.send_event(client_id, shared_messages)
+
+    def get_client_stats(self):
+        """Return the outbound queue stats of every client by client id."""
+        return dict(
+            (client_id, channel.get_stats())
+            for client_id, channel in self.channels.items())
+
+    def disconnect_client(self, client_id):
+        channel = self.channels.pop(client_id)
+        self.client_sockets.remove(channel.sock)
+        channel.sock.close()
+        self.event_distributor.post(ClientDisconnectedEvent(client_id))
+
+    def disconnect_slow_clients(self):
+        now = time.monotonic()
+        for client_id, channel in list(self.channels.items()):
+            if channel.is_over_budget(now):
+                LOG.warning(
+                    'Client %d has been blocked for %.1f s with %d queued '
+                    'events, disconnecting', client_id,
+                    now - channel.behind_since, len(channel.out_events))
+                self.disconnect_client(client_id)
 
     def read_from_clients(self):
         if not self.client_sockets:
@@ -414,7 +815,17 @@ class Server(object):
         for sock in readable:
             client_id = sock.fileno()
             channel = self.channels[client_id]
-            if channel.receive_data():
+            try:
+                is_open = channel.receive_data()
+            except Exception:
+                # only this client is affected by what it sent
+                LOG.exception(
+                    'Failed to parse data from client %d, disconnecting',
+                    client_id)
+                self.disconnect_client(client_id)
+                continue
+
+            if is_open:
                 for event in channel.receive_events():
                     self.event_distributor.post(ClientEvent(client_id, event))
             else:
@@ -425,9 +836,16 @@ class Server(object):
                     ClientDisconnectedEvent(client_id))
 
     def write_to_clients(self):
+        self.flush_broadcast_events()
+
         if not self.client_sockets:
             return
         _, writable, _ = select.select([], self.client_sockets, [], 0)
+        writable_sockets = set(writable)
+        for sock in self.client_sockets:
+            if sock not in writable_sockets:
+                self.channels[sock.fileno()].is_blocked = True
+
         for sock in writable:
             client_id = sock.fileno()
             if not self.channels[client_id].send_data():
@@ -436,3 +854,5 @@ class Server(object):
                 del self.channels[client_id]
                 self.event_distributor.post(
                     ClientDisconnectedEvent(client_id))
+
+        self.disconnect_slow_clients()
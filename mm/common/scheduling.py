@@ -1,26 +1,120 @@
+import asyncio
+import heapq
 import random
+import time
+
+
+class TimerHandle(object):
+    """Returned by Scheduler.post and Scheduler.periodic, cancels the timer."""
+
+    __slots__ = (
+        'scheduler', 'func', 'period', 'deadline', 'cancelled', 'in_heap')
+
+    def __init__(self, scheduler, func, period):
+        self.scheduler = scheduler
+        self.func = func
+        self.period = period
+        self.deadline = None
+        self.cancelled = False
+        # periodic handles are out of the heap while their callback runs
+        self.in_heap = False
+
+    def is_active(self):
+        return self.scheduler is not None and not self.cancelled
+
+    def cancel(self):
+        if self.is_active():
+            self.cancelled = True
+            if self.in_heap:
+                self.scheduler.on_timer_cancelled()
 
 
 class Scheduler(object):
+    """Runs callbacks after a delay or periodically, in game time.
+
+    Timers sit in a binary heap ordered on their absolute deadline, so an
+    update only touches the timers that actually fire. Cancelling marks the
+    handle and leaves the entry in the heap; cancelled entries are skipped
+    when they surface and purged once they make up half of the heap.
+    """
+
     def __init__(self):
+        self.time = 0.
         self.timers = []
+        self.sequence = 0
+        self.cancelled_count = 0
 
     def post(self, func, delay):
-        self.timers.append((Timer(delay), func, False))
+        handle = TimerHandle(self, func, None)
+        self.schedule(handle, self.time + get_duration(delay))
+        return handle
 
     def periodic(self, func, period):
-        self.timers.append((Timer(period, False), func, True))
+        # periodic timers fire on the first update, then every period
+        handle = TimerHandle(self, func, period)
+        self.schedule(handle, self.time)
+        return handle
+
+    def schedule(self, handle, deadline):
+        handle.deadline = deadline
+        # the sequence number keeps timers with equal deadlines in post order
+        self.sequence += 1
+        handle.in_heap = True
+        heapq.heappush(self.timers, (deadline, self.sequence, handle))
 
     def update(self, frame_time):
-        for (timer, func, periodic) in self.timers:
-            timer.update(frame_time)
-            if timer.is_expired_then_reset():
-                func()
-                if not periodic:
-                    self.timers.remove((timer, func, periodic))
+        self.time += frame_time
+
+        rescheduled = []
+
+        # callbacks may cancel timers, which can swap out self.timers
+        while self.timers and self.timers[0][0] <= self.time:
+            _, _, handle = heapq.heappop(self.timers)
+            handle.in_heap = False
+
+            if handle.cancelled:
+                self.cancelled_count -= 1
+                continue
+
+            if handle.period is None:
+                handle.scheduler = None
+            else:
+                rescheduled.append(handle)
+
+            handle.func()
+
+        # rescheduled after the loop so a zero period fires once per update
+        for handle in rescheduled:
+            if not handle.cancelled:
+                self.schedule(handle, self.time + get_duration(handle.period))
+
+    def on_timer_cancelled(self):
+        self.cancelled_count += 1
+        if self.cancelled_count > len(self.timers) // 2:
+            timers = []
+            for entry in self.timers:
+                if entry[2].cancelled:
+                    entry[2].in_heap = False
+                else:
+                    timers.append(entry)
+            self.timers = timers
+            heapq.heapify(self.timers)
+            self.cancelled_count = 0
+
+    def get_timer_count(self):
+        return len(self.timers) - self.cancelled_count
+
+
+def get_duration(duration):
+    if isinstance(duration, (list, tuple)):
+        return random.uniform(duration[0], duration[1])
+    else:
+        return duration
 
 
 class Timer(object):
+    __slots__ = ('min_duration', 'max_duration', 'time_left')
+
     def __init__(self, duration, do_reset=True):
         if isinstance(duration, (list, tuple)):
             self.min_duration = duration[0]
@@ -34,6 +128,12 @@ class Timer(object):
         if do_reset:
             self.reset()
 
+    def __getstate__(self):
+        return (self.min_duration, self.max_duration, self.time_left)
+
+    def __setstate__(self, state):
+        self.min_duration, self.max_duration, self.time_left = state
+
     def update(self, frame_time):
         self.time_left -= frame_time
         return not self.is_expired()
@@ -60,3 +160,77 @@ class Timer(object):
 
     def fforward(self):
         self.time_left = 0
+
+
+class FixedTimestep(object):
+    """Paces a loop at a fixed tick rate on a monotonic clock.
+
+    wait() sleeps until the next tick deadline and returns how many fixed
+    steps of tick_time the caller should simulate. When a loop iteration
+    overruns its budget the missed ticks are caught up with extra steps, at
+    most max_catch_up_ticks per call; anything beyond that is dropped so a
+    long stall can't snowball into an ever growing backlog.
+    """
+
+    def __init__(self, tick_rate, max_catch_up_ticks=3, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.tick_time = 1. / tick_rate
+        self.max_catch_up_ticks = max(1, max_catch_up_ticks)
+        self.clock = clock
+        self.sleep = sleep
+
+        self.next_tick_time = None
+
+        # number of steps handed out, calls that started late, steps skipped
+        # because of the catch-up limit and the worst lateness seen
+        self.tick_count = 0
+        self.overrun_count = 0
+        self.dropped_tick_count = 0
+        self.max_lateness = 0.
+
+    def start(self):
+        self.next_tick_time = self.clock()
+
+    def wait(self):
+        time_until_tick = self.get_time_until_tick()
+        if time_until_tick > 0:
+            self.sleep(time_until_tick)
+        return self.advance()
+
+    async def wait_async(self):
+        # same as wait for loops running as an asyncio task, but always
+        # yields so that socket I/O is served even when ticks run late
+        await asyncio.sleep(self.get_time_until_tick())
+        return self.advance()
+
+    def get_time_until_tick(self):
+        if self.next_tick_time is None:
+            self.start()
+        return max(0., self.next_tick_time - self.clock())
+
+    def advance(self):
+        now = self.clock()
+        lateness = max(0., now - self.next_tick_time)
+        due_ticks = int(lateness / self.tick_time) + 1
+
+        if due_ticks > 1:
+            self.overrun_count += 1
+            self.max_lateness = max(self.max_lateness, lateness)
+
+        # the deadlines of dropped ticks are skipped, not rescheduled
+        self.next_tick_time += due_ticks * self.tick_time
+
+        if due_ticks > self.max_catch_up_ticks:
+            self.dropped_tick_count += due_ticks - self.max_catch_up_ticks
+            due_ticks = self.max_catch_up_ticks
+
+        self.tick_count += due_ticks
+        return due_ticks
+
+    def get_stats(self):
+        return {
+            'tick_count': self.tick_count,
+            'overrun_count': self.overrun_count,
+            'dropped_tick_count': self.dropped_tick_count,
+            'max_lateness': self.max_lateness,
+        }
@@ -0,0 +1,413 @@
+"""Region sharding of a single world across worker processes.
+
+The map is cut into vertical strips. Every strip is simulated by a
+RegionWorld in its own process, so a large map can use all cores of one
+machine. ShardedWorld is the coordinator living in the server process: it
+steps all regions in lock step over multiprocessing pipes and merges their
+events and actor states for the Server.
+
+Each tick a region reports:
+
+ * actors that walked out of its strip, which are handed off to the region
+   they walked into,
+ * actors within the ghost band along its borders, which the neighbouring
+   regions insert as read-only ghosts so that targeting and
+   find_nearby_actors work across the border,
+ * damage dealt to ghosts, which is applied to the real actor in its own
+   region on the next tick.
+
+Ghosts, handoffs and remote damage are one tick behind. An actor chasing a
+target deeper into another region than the ghost band loses it and goes
+back to wandering. Until its new region reports it, the coordinator keeps a
+handed off actor in its merged states, and the actor takes the values it
+was last sent in along, so clients never see it leave.
+"""
+
+import logging
+import multiprocessing
+import random
+
+from mm.common.events import ALL_GAME_EVENT_TYPES, EventDistributor
+from mm.common.scheduling import Scheduler
+from mm.common.spatial import SpatialGrid
+from mm.common.world import World
+
+LOG = logging.getLogger(__name__)
+
+
+class RegionWorld(World):
+    """World simulating the actors in the strip min_x <= x < max_x."""
+
+    def __init__(self, event_distributor, scheduler, actor_store, width,
+                 height, region_index, min_x, max_x, ghost_band,
+                 cold_update_interval=World.COLD_UPDATE_INTERVAL):
+        super(RegionWorld, self).__init__(
+            event_distributor, scheduler, actor_store, width, height,
+            cold_update_interval=cold_update_interval)
+
+        self.region_index = region_index
+        self.min_x = min_x
+        self.max_x = max_x
+        self.ghost_band = ghost_band
+
+        # actor id -> ghost actor / region owning the real actor
+        self.ghosts = {}
+        self.ghost_regions = {}
+
+        # (region index, victim id, damage, attacker id)
+        self.remote_damage = []
+
+        # deltas of the actors handed off since take_actor_deltas
+        self.handoff_deltas = []
+
+    def is_inside(self, pos):
+        return self.min_x <= pos.x < self.max_x
+
+    def is_ghost(self, actor):
+        return self.ghosts.get(actor.actor_id) is actor
+
+    def set_ghosts(self, ghost_states):
+        for ghost in self.ghosts.values():
+            self.grid.remove(ghost)
+
+        self.ghosts = {}
+        self.ghost_regions = {}
+
+        for region_index, states in ghost_states:
+            for state in states:
+                # an actor handed off to us this tick is real, not a ghost
+                if self.actors.get(state.actor_id):
+                    continue
+                ghost = self.create_actor_from_state(state)
+                self.ghosts[ghost.actor_id] = ghost
+                self.ghost_regions[ghost.actor_id] = region_index
+                self.grid.insert(ghost)
+
+    def apply_remote_damage(self, remote_damage):
+        for victim_id, damage, attacker_id in remote_damage:
+            victim = self.actors.get(victim_id)
+            if victim and victim.is_alive():
+                victim.take_damage(
+                    damage, attacker=self.find_actor_by_id(attacker_id))
+
+    def take_remote_damage(self):
+        remote_damage = self.remote_damage
+        self.remote_damage = []
+        return remote_damage
+
+    def take_handoffs(self):
+        """Remove the actors that left the strip, and return their states
+        with the values their deltas went out with.
+        """
+        handoffs = []
+        sent_values = self.sent_values
+        for actor in list(self.actors):
+            if not self.is_inside(actor.pos):
+                slot = self.actors.get_slot(actor.actor_id)
+
+                # the changes of this tick still go out from here
+                actor_delta = actor.take_delta(sent_values, slot)
+                if actor_delta:
+                    self.handoff_deltas.append(actor_delta)
+
+                # moved, not removed, as far as the clients are concerned
+                sent_row = sent_values.get_row(slot)
+                sent_values.clear(slot)
+                self.remove_actor(actor)
+                handoffs.append((actor.get_state(), sent_row))
+        return handoffs
+
+    def add_handoff(self, state, sent_row):
+        actor = self.create_actor_from_state(state)
+        self.add_actor(actor)
+        # clients have the actor already, only later changes go out
+        actor.changed_mask = 0
+        self.sent_values.set_row(
+            self.actors.get_slot(actor.actor_id), sent_row)
+
+    def take_actor_deltas(self):
+        actor_deltas = self.handoff_deltas
+        self.handoff_deltas = []
+        actor_deltas.extend(super(RegionWorld, self).take_actor_deltas())
+        return actor_deltas
+
+    def get_border_states(self, states):
+        left_edge = self.min_x + self.ghost_band
+        right_edge = self.max_x - self.ghost_band
+        left_band = [state for state in states if state.pos.x < left_edge]
+        right_band = [state for state in states if state.pos.x >= right_edge]
+        return left_band, right_band
+
+    def find_actor_by_id(self, actor_id):
+        actor = self.actors.get(actor_id)
+        if actor is None:
+            actor = self.ghosts.get(actor_id)
+        return actor
+
+    def assign_targets(self, seekers, candidates):
+        # ghosts are simulated by their own region
+        seekers = [actor for actor in seekers if not self.is_ghost(actor)]
+        if seekers:
+            super(RegionWorld, self).assign_targets(seekers, candidates)
+
+    def on_actor_died(self, actor):
+        if self.is_ghost(actor):
+            # the owning region decides when the real actor dies
+            del self.ghosts[actor.actor_id]
+            self.grid.remove(actor)
+        else:
+            super(RegionWorld, self).on_actor_died(actor)
+
+    def on_attack(self, attacker, victim, damage):
+        super(RegionWorld, self).on_attack(attacker, victim, damage)
+        if damage and self.is_ghost(victim):
+            self.remote_damage.append((
+                self.ghost_regions[victim.actor_id], victim.actor_id, damage,
+                attacker.actor_id))
+
+    def on_heal(self, actor, heal):
+        if not self.is_ghost(actor):
+            super(RegionWorld, self).on_heal(actor, heal)
+
+    def on_set_target(self, actor, target):
+        if not self.is_ghost(actor):
+            super(RegionWorld, self).on_set_target(actor, target)
+
+    def on_loot(self, actor, loot):
+        if not self.is_ghost(actor):
+            super(RegionWorld, self).on_loot(actor, loot)
+
+
+def run_region(connection, actor_store, width, height, region_index, min_x,
+               max_x, ghost_band, cold_update_interval, seed):
+    # forked workers would otherwise all share the parent's random state
+    if seed is None:
+        random.seed()
+    else:
+        random.seed('%d/%d' % (seed, region_index))
+
+    event_distributor = EventDistributor()
+    scheduler = Scheduler()
+    world = RegionWorld(
+        event_distributor, scheduler, actor_store, width, height,
+        region_index, min_x, max_x, ghost_band,
+        cold_update_interval=cold_update_interval)
+
+    events = []
+    event_distributor.add_handler(events.append, ALL_GAME_EVENT_TYPES)
+
+    while True:
+        command = connection.recv()
+        if command is None:
+            break
+
+        frame_time, spawns, handoffs, ghost_states, remote_damage = command
+
+        for state, sent_row in handoffs:
+            world.add_handoff(state, sent_row)
+
+        world.set_ghosts(ghost_states)
+
+        for actor_type, pos, actor_id in spawns:
+            world.spawn_actor(actor_type, pos, actor_id=actor_id)
+
+        world.apply_remote_damage(remote_damage)
+
+        scheduler.update(frame_time)
+        world.update(frame_time)
+        event_distributor.update()
+
+        outgoing_handoffs = world.take_handoffs()
+        states = world.get_actor_states()
+        left_band, right_band = world.get_border_states(states)
+
+        connection.send((
+            events, outgoing_handoffs, states, left_band, right_band,
+            world.take_remote_damage(), world.take_actor_deltas()))
+
+        del events[:]
+
+    connection.close()
+
+
+class Region(object):
+    def __init__(self, index, min_x, max_x, process, connection):
+        self.index = index
+        self.min_x = min_x
+        self.max_x = max_x
+        self.process = process
+        self.connection = connection
+
+        # input for the next tick, handoffs are (state, sent values)
+        self.spawns = []
+        self.handoffs = []
+        self.ghost_states = []
+        self.remote_damage = []
+
+        # output of the last tick
+        self.states = []
+        self.left_band = []
+        self.right_band = []
+
+
+class ShardedWorld(object):
+    """Coordinator splitting a world into num_regions worker processes.
+
+    Offers the parts of the World interface the server uses: spawn_actor,
+    update, get_actor_states, get_actor_states_in_rect, find_actors_in_rect,
+    take_actor_deltas and close, plus width and height.
+    """
+
+    def __init__(self, event_distributor, scheduler, actor_store, width,
+                 height, num_regions=None,
+                 cold_update_interval=World.COLD_UPDATE_INTERVAL, seed=None):
+        self.event_distributor = event_distributor
+        self.scheduler = scheduler
+        self.actor_store = actor_store
+
+        self.width = width
+        self.height = height
+
+        self.actor_id_generator = 100
+
+        if not num_regions:
+            num_regions = multiprocessing.cpu_count()
+
+        # a region needs to see at least as far as its actors can
+        self.ghost_band = (actor_store.get_max_threat_range() +
+                           actor_store.get_max_radius())
+
+        self.region_width = float(width) / num_regions
+        self.regions = []
+
+        # the merged actor states of the last tick, for area queries
+        self.grid = SpatialGrid(self.ghost_band)
+
+        # deltas of the regions since the last take_actor_deltas
+        self.actor_deltas = []
+
+        for index in range(num_regions):
+            # the outer regions also own everything beyond the map edges
+            min_x = index * self.region_width if index else float('-inf')
+            if index < num_regions - 1:
+                max_x = (index + 1) * self.region_width
+            else:
+                max_x = float('inf')
+
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_region,
+                name='region-%d' % (index,),
+                args=(worker_connection, actor_store, width, height, index,
+                      min_x, max_x, self.ghost_band, cold_update_interval,
+                      seed))
+            process.daemon = True
+            process.start()
+            worker_connection.close()
+
+            self.regions.append(
+                Region(index, min_x, max_x, process, connection))
+
+        LOG.info(
+            'Sharded world into %d regions of %.1f px, ghost band %.1f px',
+            num_regions, self.region_width, self.ghost_band)
+
+    def get_next_actor_id(self):
+        self.actor_id_generator += 1
+        return self.actor_id_generator
+
+    def get_region_at(self, pos):
+        index = int(pos.x // self.region_width)
+        return self.regions[min(max(index, 0), len(self.regions) - 1)]
+
+    def spawn_actor(self, actor_type, pos):
+        # ids are handed out here so they are unique across regions
+        actor_id = self.get_next_actor_id()
+        self.get_region_at(pos).spawns.append((actor_type, pos, actor_id))
+        return actor_id
+
+    def update(self, frame_time):
+        regions = self.regions
+
+        # step all regions in parallel
+        for region in regions:
+            region.connection.send((
+                frame_time, region.spawns, region.handoffs,
+                region.ghost_states, region.remote_damage))
+            region.spawns = []
+            region.handoffs = []
+            region.remote_damage = []
+
+        events = []
+        for region in regions:
+            (region_events, handoffs, region.states, region.left_band,
+             region.right_band, remote_damage,
+             actor_deltas) = region.connection.recv()
+
+            events.extend(region_events)
+            self.actor_deltas.extend(actor_deltas)
+
+            for handoff in handoffs:
+                self.get_region_at(handoff[0].pos).handoffs.append(handoff)
+
+            for target_index, victim_id, damage, attacker_id in remote_damage:
+                regions[target_index].remote_damage.append(
+                    (victim_id, damage, attacker_id))
+
+        # each region sees the border bands of its neighbours as ghosts
+        for index, region in enumerate(regions):
+            region.ghost_states = []
+            if index > 0:
+                region.ghost_states.append(
+                    (index - 1, regions[index - 1].right_band))
+            if index < len(regions) - 1:
+                region.ghost_states.append(
+                    (index + 1, regions[index + 1].left_band))
+
+        self.grid = SpatialGrid(self.grid.cell_size)
+        for state in self.get_actor_states():
+            self.grid.insert(state)
+
+        for event in events:
+            self.event_distributor.post(event)
+
+    def get_actor_states(self):
+        states = []
+        for region in self.regions:
+            states.extend(region.states)
+            # handed off actors are in no region until the next tick
+            states.extend(state for state, _ in region.handoffs)
+        return states
+
+    def get_actor_count(self):
+        return sum(
+            len(region.states) + len(region.handoffs)
+            for region in self.regions)
+
+    def take_actor_deltas(self):
+        actor_deltas = self.actor_deltas
+        self.actor_deltas = []
+        return actor_deltas
+
+    def find_actors_in_rect(self, rect):
+        # yields actor states, the actors live in the regions
+        left, top, right, bottom = rect.left, rect.top, rect.right, rect.bottom
+        for state in self.grid.find_candidates_in_rect(
+                left, top, right, bottom):
+            pos = state.pos
+            if left <= pos.x < right and top <= pos.y < bottom:
+                yield state
+
+    def get_actor_states_in_rect(self, rect):
+        return list(self.find_actors_in_rect(rect))
+
+    def close(self):
+        for region in self.regions:
+            try:
+                region.connection.send(None)
+            except (EOFError, OSError):
+                pass
+        for region in self.regions:
+            region.process.join(1)
+            region.connection.close()
+        self.regions = []
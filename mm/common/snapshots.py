@@ -0,0 +1,515 @@
+"""Actor state snapshots over UDP.
+
+On a single TCP stream a lost segment holds back every later position
+update until it has been retransmitted, although only the newest state
+matters. With the snapshot channel the server sends the state of the
+actors a client can see as a SnapshotEvent in datagrams every tick, instead
+of a DeltaStateEvent on TCP. A lost snapshot is simply superseded by the
+next one. Everything else, including the ActorEnteredViewEvent and
+ActorLeftViewEvent deciding which actors a client has, stays on TCP.
+
+Every tick the server adds the actor deltas of the world to a SnapshotRing,
+a bounded history of the actor fields shared by all clients. A snapshot
+sent to a client has the sequence number of its tick and is delta encoded
+against the last snapshot the client acknowledged: it only holds the actors
+with fields changed since that baseline, plus an empty ActorDelta for every
+actor dropped from it. Per client the server only keeps which actors it was
+sent in each unacknowledged snapshot, and the client keeps its recent
+snapshots, so it can rebuild the full snapshot from its copy of the
+baseline. Until the first acknowledgement arrives, or if the baseline has
+left the ring, a snapshot is sent in full.
+
+The server tells a client its UDP port and a token with a
+SnapshotChannelEvent on TCP. The SnapshotAckEvents of the client carry the
+token, and the first of them registers the address to send snapshots to.
+Clients that never acknowledge keep getting DeltaStateEvents on TCP.
+
+Snapshots are compressed and split into datagrams of at most
+MAX_DATAGRAM_SIZE bytes, each starting with the sequence number, its index
+and the number of datagrams in the snapshot. A snapshot with a datagram
+missing is dropped as a whole.
+
+The snapshot channel is optional, the server only opens it when
+snapshot_port is set in the server section of mm.conf.
+"""
+
+import collections
+import logging
+import math
+import secrets
+import socket
+import struct
+
+from mm.common.events import (DeltaStateEvent,
+                              SnapshotChannelEvent,
+                              SnapshotEvent,
+                              SnapshotAckEvent)
+from mm.common.networking import compress_data, decompress_data
+from mm.common.world import ActorDelta
+
+LOG = logging.getLogger(__name__)
+
+DATAGRAM_HEADER = struct.Struct('!IBB')
+
+# fits the payload of a datagram into the MTU of about any path
+MAX_DATAGRAM_SIZE = 1200
+MAX_RECEIVE_SIZE = 65536
+
+# the datagram header counts the datagrams of a snapshot in a byte
+MAX_DATAGRAMS = 0xff
+MAX_SNAPSHOT_SIZE = MAX_DATAGRAMS * (MAX_DATAGRAM_SIZE - DATAGRAM_HEADER.size)
+
+# snapshots kept for baselines, at one per tick
+HISTORY_SIZE = 32
+
+
+def create_server_socket(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', port))
+    sock.setblocking(False)
+    return sock
+
+
+def create_client_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', 0))
+    sock.setblocking(False)
+    return sock
+
+
+def pack_datagrams(sequence, data, max_datagram_size=MAX_DATAGRAM_SIZE):
+    chunk_size = max_datagram_size - DATAGRAM_HEADER.size
+    count = max(1, int(math.ceil(float(len(data)) / chunk_size)))
+    if count > MAX_DATAGRAMS:
+        raise ValueError('Snapshot of %d bytes is too big' % (len(data),))
+
+    return [
+        DATAGRAM_HEADER.pack(sequence, index, count) +
+        data[index * chunk_size:(index + 1) * chunk_size]
+        for index in range(count)]
+
+
+def receive_datagrams(sock):
+    while True:
+        try:
+            yield sock.recvfrom(MAX_RECEIVE_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionError:
+            # an ICMP error for an earlier datagram, not fatal for UDP
+            continue
+
+
+def send_datagram(sock, datagram, address):
+    try:
+        sock.sendto(datagram, address)
+    except (BlockingIOError, InterruptedError):
+        # the socket buffer is full, to the receiver this is packet loss
+        LOG.debug('Dropped datagram to %s', address)
+    except OSError as e:
+        LOG.debug('Failed to send datagram to %s: %s', address, e)
+
+
+class DatagramAssembler(object):
+    """Puts snapshots back together from their datagrams."""
+
+    # incomplete snapshots kept waiting for their missing datagrams
+    MAX_PENDING = 8
+
+    def __init__(self):
+        # sequence -> list of chunks, None for the ones still missing
+        self.pending = {}
+
+    def add(self, datagram):
+        """Return (sequence, data) once all datagrams of a snapshot are in,
+        otherwise None.
+        """
+        if len(datagram) < DATAGRAM_HEADER.size:
+            return None
+        sequence, index, count = DATAGRAM_HEADER.unpack_from(datagram)
+        if index >= count:
+            return None
+
+        chunk = datagram[DATAGRAM_HEADER.size:]
+        if count == 1:
+            return sequence, chunk
+
+        chunks = self.pending.get(sequence)
+        if chunks is None:
+            if len(self.pending) >= self.MAX_PENDING:
+                del self.pending[min(self.pending)]
+            chunks = self.pending[sequence] = [None] * count
+        elif len(chunks) != count:
+            return None
+
+        chunks[index] = chunk
+        if None in chunks:
+            return None
+
+        # anything older is not worth waiting for any more
+        del self.pending[sequence]
+        for pending_sequence in list(self.pending):
+            if pending_sequence < sequence:
+                del self.pending[pending_sequence]
+        return sequence, b''.join(chunks)
+
+
+class SnapshotRing(object):
+    """The actor fields of the whole world over the last size ticks.
+
+    Only changes are stored: every actor has a list of (sequence, row)
+    pairs, a row being a tuple of its ActorDelta.FIELDS values, or None
+    once the actor is gone. An actor that did not change shares its row
+    with all earlier snapshots, so adding a snapshot costs time and memory
+    in proportion to the number of changed actors.
+    """
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.sequence = 0
+
+        # actor id -> list of (sequence, row), oldest first
+        self.rows = {}
+
+        # ids of the actors changed in each snapshot still in the ring
+        self.changed_ids = collections.deque()
+
+    def get_oldest_sequence(self):
+        return max(1, self.sequence - self.size + 1)
+
+    def contains(self, sequence):
+        return self.get_oldest_sequence() <= sequence <= self.sequence
+
+    def add(self, actor_deltas):
+        """Add the snapshot after actor_deltas and return its sequence."""
+        self.sequence += 1
+        sequence = self.sequence
+        rows = self.rows
+        fields = ActorDelta.FIELDS
+
+        changed_ids = []
+        for actor_delta in actor_deltas:
+            actor_id = actor_delta.actor_id
+            changes = actor_delta.changes
+            history = rows.get(actor_id)
+            if history is None:
+                if not changes:
+                    continue
+                history = rows[actor_id] = []
+
+            if not changes:
+                row = None
+            else:
+                row = history[-1][1] if history else None
+                if row is None:
+                    # the first delta of an actor has all its fields
+                    row = tuple(changes.get(name) for name in fields)
+                else:
+                    row = tuple(
+                        changes[name] if name in changes else value
+                        for name, value in zip(fields, row))
+
+            if history and history[-1][0] == sequence:
+                history[-1] = (sequence, row)
+            else:
+                history.append((sequence, row))
+                changed_ids.append(actor_id)
+
+        self.changed_ids.append(changed_ids)
+        if len(self.changed_ids) > self.size:
+            self.trim(self.changed_ids.popleft())
+        return sequence
+
+    def trim(self, actor_ids):
+        # drop rows only older snapshots than the oldest one still need
+        oldest_sequence = self.get_oldest_sequence()
+        rows = self.rows
+        for actor_id in actor_ids:
+            history = rows.get(actor_id)
+            if history is None:
+                continue
+            keep = 0
+            while (keep + 1 < len(history) and
+                   history[keep + 1][0] <= oldest_sequence):
+                keep += 1
+            if keep:
+                del history[:keep]
+            if len(history) == 1 and history[0][1] is None:
+                del rows[actor_id]
+
+    def get_row(self, actor_id, sequence):
+        """Return the row of actor_id in snapshot sequence, or None."""
+        history = self.rows.get(actor_id)
+        if history:
+            for row_sequence, row in reversed(history):
+                if row_sequence <= sequence:
+                    return row
+        return None
+
+
+class ClientSnapshots(object):
+    def __init__(self, token):
+        self.token = token
+        self.address = None
+        self.sequence = 0
+        self.acked_sequence = 0
+
+        # ids of the actors in the last sent snapshot, and (sequence, added
+        # ids, removed ids) of the sent snapshots newer than the acked one
+        self.view = frozenset()
+        self.view_changes = collections.deque()
+
+    def get_view(self, sequence):
+        """Return the ids of the actors sent in snapshot sequence, which
+        can be no older than the acked one.
+        """
+        view = set(self.view)
+        for change_sequence, added_ids, removed_ids in reversed(
+                self.view_changes):
+            if change_sequence <= sequence:
+                break
+            view -= added_ids
+            view |= removed_ids
+        return view
+
+    def set_view(self, sequence, view, oldest_sequence):
+        view_changes = self.view_changes
+        view_changes.append((sequence, view - self.view, self.view - view))
+        # older ones are only needed for baselines gone from the ring
+        while view_changes and view_changes[0][0] < oldest_sequence:
+            view_changes.popleft()
+
+        self.view = view
+        self.sequence = sequence
+
+    def set_acked_sequence(self, sequence):
+        self.acked_sequence = sequence
+        view_changes = self.view_changes
+        while view_changes and view_changes[0][0] <= sequence:
+            view_changes.popleft()
+
+
+class SnapshotServer(object):
+    def __init__(self, codec, sock, history_size=HISTORY_SIZE):
+        self.codec = codec
+        self.sock = sock
+        self.ring = SnapshotRing(history_size)
+        self.clients = {}
+        self.client_ids = {}
+
+    def close(self):
+        self.sock.close()
+
+    def add_client(self, client_id):
+        """Return the SnapshotChannelEvent to send client_id over TCP."""
+        token = secrets.randbits(32)
+        while not token or token in self.client_ids:
+            token = secrets.randbits(32)
+
+        self.clients[client_id] = ClientSnapshots(token)
+        self.client_ids[token] = client_id
+        return SnapshotChannelEvent(self.sock.getsockname()[1], token)
+
+    def remove_client(self, client_id):
+        client = self.clients.pop(client_id, None)
+        if client:
+            del self.client_ids[client.token]
+
+    def add_snapshot(self, actor_deltas):
+        """Add the changes of the world since the last call. Call once per
+        tick, before sending the snapshots of the tick.
+        """
+        self.ring.add(actor_deltas)
+
+    def receive_acks(self):
+        for data, address in receive_datagrams(self.sock):
+            # anyone can send to the port, only acks are ever decoded
+            if self.codec.get_event_type(data) is not SnapshotAckEvent:
+                LOG.debug('Dropped datagram from %s', address)
+                continue
+            try:
+                event = self.codec.decode(data)
+            except Exception as e:
+                LOG.debug('Dropped malformed ack from %s: %s', address, e)
+                continue
+
+            client_id = self.client_ids.get(event.token)
+            if client_id is None:
+                continue
+
+            client = self.clients[client_id]
+            if client.address != address:
+                LOG.info('Sending client %d snapshots to %s', client_id, address)
+                client.address = address
+
+            if client.acked_sequence < event.sequence <= client.sequence:
+                client.set_acked_sequence(event.sequence)
+
+    def send_snapshot(self, client_id, actor_ids):
+        """Send the actors in actor_ids as client_id sees them in the last
+        added snapshot. Returns False if the client has no snapshot channel
+        or the snapshot does not fit into MAX_DATAGRAMS datagrams, so the
+        states have to go over TCP.
+        """
+        client = self.clients.get(client_id)
+        if client is None or client.address is None:
+            return False
+
+        ring = self.ring
+        sequence = ring.sequence
+
+        baseline_sequence = client.acked_sequence
+        if baseline_sequence and ring.contains(baseline_sequence):
+            baseline_ids = client.get_view(baseline_sequence)
+        else:
+            baseline_sequence = 0
+            baseline_ids = frozenset()
+
+        fields = ActorDelta.FIELDS
+        get_row = ring.get_row
+        view = []
+        actor_deltas = []
+        for actor_id in actor_ids:
+            row = get_row(actor_id, sequence)
+            if row is None:
+                continue
+            view.append(actor_id)
+
+            if actor_id not in baseline_ids:
+                actor_deltas.append(ActorDelta(actor_id, dict(zip(fields, row))))
+                continue
+
+            baseline_row = get_row(actor_id, baseline_sequence)
+            if row is baseline_row:
+                continue
+            if baseline_row is None:
+                changes = dict(zip(fields, row))
+            else:
+                changes = dict(
+                    (name, value) for name, value, baseline_value
+                    in zip(fields, row, baseline_row)
+                    if value != baseline_value)
+            if changes:
+                actor_deltas.append(ActorDelta(actor_id, changes))
+
+        view = frozenset(view)
+        for actor_id in baseline_ids - view:
+            actor_deltas.append(ActorDelta(actor_id, {}))
+
+        data = compress_data(self.codec.encode(SnapshotEvent(
+            sequence, baseline_sequence, actor_deltas)))
+        if len(data) > MAX_SNAPSHOT_SIZE:
+            # to the client this is a lost snapshot, the states of this
+            # tick go over TCP instead
+            LOG.debug('Snapshot of %d bytes for client %d is too big',
+                      len(data), client_id)
+            return False
+
+        client.set_view(sequence, view, ring.get_oldest_sequence())
+        for datagram in pack_datagrams(sequence, data):
+            send_datagram(self.sock, datagram, client.address)
+        return True
+
+
+class SnapshotClient(object):
+    """Receives snapshots once the server sent a SnapshotChannelEvent, and
+    posts the changes to the last applied one as a DeltaStateEvent.
+    """
+
+    def __init__(self, event_distributor, codec, sock, server_address):
+        self.event_distributor = event_distributor
+        self.codec = codec
+        self.sock = sock
+        self.server_address = server_address
+
+        self.address = None
+        self.token = None
+        self.assembler = DatagramAssembler()
+
+        # sequence -> {actor id: changes dict} of rebuilt snapshots
+        self.history = {}
+        self.sequence = 0
+
+        self.event_distributor.add_handler(
+            self.on_snapshot_channel, SnapshotChannelEvent)
+
+    def close(self):
+        self.sock.close()
+
+    def on_snapshot_channel(self, event):
+        LOG.info('Receiving snapshots from port %d', event.port)
+        self.address = (self.server_address, event.port)
+        self.token = event.token
+        self.send_ack()
+
+    def send_ack(self):
+        send_datagram(
+            self.sock, self.codec.encode(
+                SnapshotAckEvent(self.token, self.sequence)), self.address)
+
+    def read_snapshots(self):
+        if self.address is None:
+            return
+
+        newest = None
+        for datagram, _ in receive_datagrams(self.sock):
+            snapshot_data = self.assembler.add(datagram)
+            if snapshot_data is None:
+                continue
+
+            sequence, data = snapshot_data
+            try:
+                event = self.codec.decode(decompress_data(data))
+            except Exception:
+                LOG.exception('Dropping broken snapshot %d', sequence)
+                continue
+
+            view = self.rebuild(event)
+            if view is None:
+                continue
+
+            self.history[event.sequence] = view
+            if len(self.history) > HISTORY_SIZE:
+                del self.history[min(self.history)]
+            if newest is None or event.sequence > newest:
+                newest = event.sequence
+
+        if newest is not None and newest > self.sequence:
+            self.apply(self.history.get(self.sequence, {}), self.history[newest])
+            self.sequence = newest
+            self.send_ack()
+        elif not self.sequence:
+            # keep knocking until the server knows our address
+            self.send_ack()
+
+    def rebuild(self, event):
+        if event.baseline_sequence:
+            baseline = self.history.get(event.baseline_sequence)
+            if baseline is None:
+                LOG.debug(
+                    'No baseline %d for snapshot %d', event.baseline_sequence,
+                    event.sequence)
+                return None
+            view = dict(baseline)
+        else:
+            view = {}
+
+        for actor_delta in event.actor_deltas:
+            changes = actor_delta.changes
+            if not changes:
+                view.pop(actor_delta.actor_id, None)
+                continue
+
+            fields = view.get(actor_delta.actor_id)
+            if fields:
+                fields = dict(fields)
+                fields.update(changes)
+            else:
+                fields = changes
+            view[actor_delta.actor_id] = fields
+        return view
+
+    def apply(self, last_view, view):
+        self.event_distributor.post(DeltaStateEvent([
+            ActorDelta(actor_id, fields) for actor_id, fields in view.items()
+            if last_view.get(actor_id) != fields]))
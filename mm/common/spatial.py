@@ -0,0 +1,134 @@
+import math
+
+
+class SpatialGrid(object):
+    """Uniform grid of square cells used to answer radius queries over actors
+    without touching the whole world. Actors are bucketed by the cell their
+    position falls in and re-bucketed whenever they cross a cell border.
+
+    Buckets are dicts rather than sets so that iteration order only depends
+    on insertion order, which keeps seeded simulations reproducible.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.actor_cells = {}
+        self.hero_counts = {}
+        self.max_radius = 0
+
+    def get_cell(self, pos):
+        return (int(math.floor(pos.x / self.cell_size)),
+                int(math.floor(pos.y / self.cell_size)))
+
+    def insert(self, actor):
+        cell = self.get_cell(actor.pos)
+        self.add_to_cell(actor, cell)
+        self.actor_cells[actor] = cell
+        if actor.radius > self.max_radius:
+            self.max_radius = actor.radius
+
+    def remove(self, actor):
+        cell = self.actor_cells.pop(actor, None)
+        if cell is not None:
+            self.remove_from_cell(actor, cell)
+
+    def update(self, actor):
+        old_cell = self.actor_cells.get(actor)
+        if old_cell is None:
+            return
+        new_cell = self.get_cell(actor.pos)
+        if new_cell != old_cell:
+            self.remove_from_cell(actor, old_cell)
+            self.add_to_cell(actor, new_cell)
+            self.actor_cells[actor] = new_cell
+
+    def add_to_cell(self, actor, cell):
+        self.cells.setdefault(cell, {})[actor] = None
+        if actor.is_hero:
+            self.hero_counts[cell] = self.hero_counts.get(cell, 0) + 1
+
+    def remove_from_cell(self, actor, cell):
+        bucket = self.cells[cell]
+        del bucket[actor]
+        if not bucket:
+            del self.cells[cell]
+        if actor.is_hero:
+            self.hero_counts[cell] -= 1
+            if not self.hero_counts[cell]:
+                del self.hero_counts[cell]
+
+    def get_cell_reach(self, search_radius):
+        return int(math.ceil((search_radius + self.max_radius) /
+                             self.cell_size))
+
+    def find_contested_cells(self, search_radius):
+        """Return the cells holding heroes or non-heroes that may have an
+        actor of the other side within search_radius. Only the neighbourhood
+        of cells with heroes in them is visited.
+        """
+        reach = self.get_cell_reach(search_radius)
+        cells = self.cells
+        hero_counts = self.hero_counts
+        contested = set()
+
+        for hero_cell in hero_counts:
+            hero_x, hero_y = hero_cell
+            for cell_x in range(hero_x - reach, hero_x + reach + 1):
+                for cell_y in range(hero_y - reach, hero_y + reach + 1):
+                    cell = (cell_x, cell_y)
+                    bucket = cells.get(cell)
+                    if bucket and len(bucket) > hero_counts.get(cell, 0):
+                        contested.add(cell)
+                        contested.add(hero_cell)
+
+        return contested
+
+    def get_cell_range(self, pos, search_radius):
+        # actors are matched on the distance to their edge, so widen the
+        # search by the largest radius we have seen
+        reach = search_radius + self.max_radius
+        size = self.cell_size
+        return (int(math.floor((pos.x - reach) / size)),
+                int(math.floor((pos.y - reach) / size)),
+                int(math.floor((pos.x + reach) / size)),
+                int(math.floor((pos.y + reach) / size)))
+
+    def find_candidates(self, pos, search_radius):
+        return self.find_candidates_in_cells(
+            *self.get_cell_range(pos, search_radius))
+
+    def find_candidates_near_cell(self, cell, search_radius):
+        # everything that may be within search_radius of any point in cell
+        reach = self.get_cell_reach(search_radius)
+        cell_x, cell_y = cell
+        return self.find_candidates_in_cells(
+            cell_x - reach, cell_y - reach, cell_x + reach, cell_y + reach)
+
+    def find_candidates_in_rect(self, left, top, right, bottom):
+        # every actor whose position may be inside the rectangle
+        size = self.cell_size
+        return self.find_candidates_in_cells(
+            int(math.floor(left / size)), int(math.floor(top / size)),
+            int(math.floor(right / size)), int(math.floor(bottom / size)))
+
+    def find_candidates_in_cells(self, min_x, min_y, max_x, max_y):
+        cells = self.cells
+
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(cells):
+            # the query covers more cells than are occupied, walk those instead
+            for (cell_x, cell_y), bucket in cells.items():
+                if min_x <= cell_x <= max_x and min_y <= cell_y <= max_y:
+                    for actor in bucket:
+                        yield actor
+            return
+
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                bucket = cells.get((cell_x, cell_y))
+                if bucket:
+                    for actor in bucket:
+                        yield actor
+
+    def __len__(self):
+        return len(self.actor_cells)
@@ -1,3 +1,4 @@
+import array
 import logging
 import random
 import math
@@ -9,6 +10,7 @@ import pygame
 from thirdparty.vec2 import vec2
 
 from mm.common.scheduling import Timer
+from mm.common.spatial import SpatialGrid
 from mm.common.events import *
 
 LOG = logging.getLogger(__name__)
@@ -25,22 +27,293 @@ class ActorStore(object):
     def get_all_names(self):
         return self.actors.keys()
 
+    def get_max_radius(self):
+        return max(params.get('radius', 1) for params in self.actors.values())
 
-class ObjectState(dict):
-    def __init__(self, object_type, *args, **kwargs):
-        super(ObjectState, self).__init__(*args, **kwargs)
-        self.object_type = object_type
+    def get_max_threat_range(self):
+        # mirrors the defaults in Actor.from_params
+        max_threat_range = 1
+        for params in self.actors.values():
+            radius = params.get('radius', 1)
+            min_attack_range = params.get('min_range', radius)
+            max_attack_range = params.get('max_range', min_attack_range)
+            threat_range = params.get('threat_range', 1.5 * max_attack_range)
+            max_threat_range = max(max_threat_range, radius, threat_range)
+        return max_threat_range
 
-    def __getattr__(self, key):
-        try:
-            return self[key]
-        except KeyError as error:
-            raise AttributeError(error)
+
+class ObjectState(object):
+    """Snapshot of an object's fields.
+
+    Subclasses name their fields in FIELDS and use them as __slots__, so a
+    state record is a fixed-size object without a per-instance dict.
+    """
+
+    __slots__ = ()
+
+    object_type = None
+
+    FIELDS = ()
+
+    def __init__(self, *values):
+        for key, value in zip(self.FIELDS, values):
+            setattr(self, key, value)
+
+    def items(self):
+        for key in self.FIELDS:
+            yield key, getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __reduce__(self):
+        # much cheaper to pickle than the default slot-by-slot state dict
+        return (type(self), tuple(getattr(self, key) for key in self.FIELDS))
+
+    def __repr__(self):
+        return '%s(%s)' % (
+            type(self).__name__,
+            ', '.join('%s=%r' % item for item in self.items()))
+
+
+class ActorState(ObjectState):
+    FIELDS = (
+        'actor_id', 'actor_type', 'is_hero', 'speed', 'radius',
+        'attack_range', 'threat_range', 'damage_range', 'max_health',
+        'health', 'health_regen', 'wander_radius', 'miss_rate', 'loot_value',
+        'wander_timer', 'attack_timer', 'regen_timer', 'pos', 'target_id',
+        'move_dest')
+
+    __slots__ = FIELDS
+
+    object_type = 'actor'
+
+
+class ActorDelta(object):
+    """Fields of an actor that changed since its last sent state, as a
+    dict of field name to new value.
+
+    Only the fields in FIELDS change during play. The others are fixed at
+    spawn time and only sent in the full ActorState of EnterGameEvent and
+    ActorSpawnedEvent.
+    """
+
+    FIELDS = ('pos', 'move_dest', 'health', 'target_id', 'loot_value')
+
+    # field name -> its bit in Actor.changed_mask
+    FIELD_MASKS = dict((name, 1 << bit) for bit, name in enumerate(FIELDS))
+    ALL_FIELDS_MASK = (1 << len(FIELDS)) - 1
+
+    __slots__ = ('actor_id', 'changes')
+
+    def __init__(self, actor_id, changes):
+        self.actor_id = actor_id
+        self.changes = changes
+
+    def __reduce__(self):
+        return (type(self), (self.actor_id, self.changes))
+
+    def __repr__(self):
+        return 'ActorDelta(actor_id=%r, changes=%r)' % (
+            self.actor_id, self.changes)
+
+
+POS_MASK = ActorDelta.FIELD_MASKS['pos']
+MOVE_DEST_MASK = ActorDelta.FIELD_MASKS['move_dest']
+HEALTH_MASK = ActorDelta.FIELD_MASKS['health']
+TARGET_ID_MASK = ActorDelta.FIELD_MASKS['target_id']
+LOOT_VALUE_MASK = ActorDelta.FIELD_MASKS['loot_value']
+
+
+def merge_actor_deltas(actor_deltas, newer_actor_deltas, reset_ids=()):
+    """Merge two consecutive lists of deltas into one taking an actor from
+    its state before the first to its state after the second. The changes
+    in the first list of the actors in reset_ids are left out, because
+    their full state was sent in between.
+    """
+    changes_by_id = {}
+    for actor_delta in actor_deltas:
+        if actor_delta.actor_id not in reset_ids:
+            changes_by_id[actor_delta.actor_id] = dict(actor_delta.changes)
+
+    for actor_delta in newer_actor_deltas:
+        changes = changes_by_id.get(actor_delta.actor_id)
+        if changes is None:
+            changes_by_id[actor_delta.actor_id] = actor_delta.changes
+        else:
+            changes.update(actor_delta.changes)
+
+    return [
+        ActorDelta(actor_id, changes)
+        for actor_id, changes in changes_by_id.items()]
+
+
+class ActorList(object):
+    """Actor storage with O(1) insert, removal and lookup by actor id.
+
+    Actors live in a list of slots. Removing an actor leaves a hole that is
+    recorded in a free-list and reused by the next insert, so no other actor
+    changes position and iterating while actors die is safe.
+    """
+
+    def __init__(self, actors=None):
+        self.slots = []
+        self.free_slots = []
+        self.slot_by_id = {}
+
+        if actors:
+            for actor in actors:
+                self.append(actor)
+
+    def append(self, actor):
+        if actor.actor_id in self.slot_by_id:
+            raise ValueError('Actor %d already added' % (actor.actor_id,))
+
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.slots[slot] = actor
+        else:
+            slot = len(self.slots)
+            self.slots.append(actor)
+
+        self.slot_by_id[actor.actor_id] = slot
+
+    def remove(self, actor):
+        slot = self.slot_by_id.pop(actor.actor_id, None)
+        if slot is None:
+            raise ValueError('Actor %d not in list' % (actor.actor_id,))
+        self.slots[slot] = None
+        self.free_slots.append(slot)
+
+    def get(self, actor_id):
+        slot = self.slot_by_id.get(actor_id)
+        if slot is None:
+            return None
+        return self.slots[slot]
+
+    def get_slot(self, actor_id):
+        return self.slot_by_id.get(actor_id)
+
+    def compact(self):
+        # only call this when nobody is iterating, it moves actors around
+        self.slots = [actor for actor in self.slots if actor is not None]
+        self.free_slots = []
+        self.slot_by_id = dict(
+            (actor.actor_id, slot) for slot, actor in enumerate(self.slots))
+
+    def get_hole_count(self):
+        return len(self.free_slots)
+
+    def __contains__(self, actor):
+        return self.get(actor.actor_id) is actor
+
+    def __iter__(self):
+        for actor in self.slots:
+            if actor is not None:
+                yield actor
+
+    def __len__(self):
+        return len(self.slot_by_id)
+
+
+class SentValues(object):
+    """The ActorDelta.FIELDS values the deltas of the actors of an
+    ActorList went out with, in one flat array of doubles for the whole
+    world, with a row per slot. Rows of actors not sent yet are NaN.
+    """
+
+    # pos.x, pos.y, move_dest.x, move_dest.y, health, target_id or 0 for
+    # None, loot_value
+    ROW_SIZE = 7
+    UNSENT_ROW = array.array('d', [float('nan')] * ROW_SIZE)
+
+    def __init__(self):
+        self.values = array.array('d')
+
+    def clear(self, slot):
+        start = slot * self.ROW_SIZE
+        missing_rows = (
+            (start + self.ROW_SIZE - len(self.values)) // self.ROW_SIZE)
+        if missing_rows > 0:
+            self.values.extend(self.UNSENT_ROW * missing_rows)
+        self.values[start:start + self.ROW_SIZE] = self.UNSENT_ROW
+
+    def is_sent(self, slot):
+        return not math.isnan(self.values[slot * self.ROW_SIZE])
+
+    def get_row(self, slot):
+        start = slot * self.ROW_SIZE
+        return tuple(self.values[start:start + self.ROW_SIZE])
+
+    def set_row(self, slot, row):
+        start = slot * self.ROW_SIZE
+        self.values[start:start + self.ROW_SIZE] = array.array('d', row)
+
+    def move_rows(self, old_slot_by_id, slot_by_id):
+        """Move the rows along with the actors of a compacted ActorList."""
+        row_size = self.ROW_SIZE
+        old_values = self.values
+        values = self.UNSENT_ROW * len(slot_by_id)
+        for actor_id, slot in slot_by_id.items():
+            old_start = old_slot_by_id[actor_id] * row_size
+            values[slot * row_size:(slot + 1) * row_size] = (
+                old_values[old_start:old_start + row_size])
+        self.values = values
+
+    def update(self, slot, actor, mask):
+        """Store the values of the fields of actor in mask that differ
+        from the row of slot, and return them by field name.
+        """
+        values = self.values
+        start = slot * self.ROW_SIZE
+        changes = {}
+
+        # NaN differs from everything, so unsent fields always go out
+        if mask & POS_MASK:
+            pos = actor.pos
+            x = pos.x
+            y = pos.y
+            if values[start] != x or values[start + 1] != y:
+                values[start] = x
+                values[start + 1] = y
+                changes['pos'] = vec2(x, y)
+
+        if mask & MOVE_DEST_MASK:
+            move_dest = actor.move_dest
+            x = move_dest.x
+            y = move_dest.y
+            if values[start + 2] != x or values[start + 3] != y:
+                values[start + 2] = x
+                values[start + 3] = y
+                changes['move_dest'] = vec2(x, y)
+
+        if mask & HEALTH_MASK:
+            health = actor.health
+            if values[start + 4] != health:
+                values[start + 4] = changes['health'] = health
+
+        if mask & TARGET_ID_MASK:
+            target_id = actor.target_id
+            if values[start + 5] != (target_id or 0):
+                values[start + 5] = target_id or 0
+                changes['target_id'] = target_id
+
+        if mask & LOOT_VALUE_MASK:
+            loot_value = actor.loot_value
+            if values[start + 6] != loot_value:
+                values[start + 6] = changes['loot_value'] = loot_value
+
+        return changes
 
 
 class World(object):
+    # idle actors away from any enemy only think every this many ticks
+    COLD_UPDATE_INTERVAL = 5
+
     def __init__(self, event_distributor, scheduler, actor_store,
-                 width, height, actors=None):
+                 width, height, actors=None,
+                 cold_update_interval=COLD_UPDATE_INTERVAL,
+                 track_changes=True):
         self.event_distributor = event_distributor
         self.scheduler = scheduler
         self.actor_store = actor_store
@@ -55,25 +328,107 @@ class World(object):
 
         self.actor_id_generator = 100
 
+        self.time = 0.
+        self.tick_count = 0
+        self.cold_update_interval = max(1, cold_update_interval)
+        self.awake_count = 0
+
+        # cells as wide as the longest threat range plus the largest radius
+        # keep every targeting query within the 3x3 block around the
+        # searching actor
+        self.max_threat_range = self.actor_store.get_max_threat_range()
+        self.grid = SpatialGrid(
+            self.max_threat_range + self.actor_store.get_max_radius())
+
+        self.actors = ActorList()
+
+        # actor id -> actor with fields changed since take_actor_deltas, and
+        # ids of the actors removed since, only kept by worlds whose deltas
+        # are taken
+        self.track_changes = track_changes
+        self.changed_actors = {}
+        self.removed_actor_ids = set()
+        self.sent_values = SentValues()
+
         if actors:
-            self.actors = actors
-        else:
-            self.actors = []
+            for actor in actors:
+                self.add_actor(actor)
 
     def add_actor(self, actor):
+        actor.world = self
+        actor.last_think_time = self.time
         self.actors.append(actor)
+        self.grid.insert(actor)
 
-    def spawn_actor(self, actor_type, pos):
-        actor_id = self.get_next_actor_id()
+        # all fields go out in the first delta of an actor
+        actor.changed_mask = ActorDelta.ALL_FIELDS_MASK
+        self.sent_values.clear(self.actors.get_slot(actor.actor_id))
+        if self.track_changes:
+            self.changed_actors[actor.actor_id] = actor
 
-        actor = Actor.from_params(
-            self.actor_store.get_params(actor_type), actor_id, self, pos=pos)
+    def remove_actor(self, actor):
+        slot = self.actors.get_slot(actor.actor_id)
+        self.actors.remove(actor)
+        self.grid.remove(actor)
+        self.changed_actors.pop(actor.actor_id, None)
+        if self.sent_values.is_sent(slot):
+            # only actors that went out in a delta have to be taken back
+            self.removed_actor_ids.add(actor.actor_id)
 
-        self.actors.append(actor)
+    def spawn_actor(self, actor_type, pos, actor_id=None):
+        if actor_id is None:
+            actor_id = self.get_next_actor_id()
+
+        actor = self.create_actor(actor_type, actor_id, pos)
+
+        self.add_actor(actor)
         self.event_distributor.post(ActorSpawnedEvent(actor.get_state()))
 
         return actor
 
+    def create_actor(self, actor_type, actor_id, pos):
+        return Actor.from_params(
+            self.actor_store.get_params(actor_type), actor_id, self, pos=pos)
+
+    def create_actor_from_state(self, state):
+        return Actor.from_state(state, self)
+
+    def get_actor_states(self):
+        return [actor.get_state() for actor in self.actors]
+
+    def get_actor_count(self):
+        return len(self.actors)
+
+    def take_actor_deltas(self):
+        """Return the ActorDeltas of the actors changed since the last call,
+        in time proportional to the number of changed actors. Actors removed
+        since get an ActorDelta without changes.
+        """
+        changed_actors = self.changed_actors
+        self.changed_actors = {}
+        removed_actor_ids = self.removed_actor_ids
+        self.removed_actor_ids = set()
+
+        actors = self.actors
+        actor_deltas = [
+            ActorDelta(actor_id, {}) for actor_id in removed_actor_ids
+            if actors.get(actor_id) is None]
+        for actor in changed_actors.values():
+            if actor in actors:
+                actor_delta = actor.take_delta(
+                    self.sent_values, actors.get_slot(actor.actor_id))
+                if actor_delta:
+                    actor_deltas.append(actor_delta)
+            else:
+                actor.changed_mask = 0
+        return actor_deltas
+
+    def get_actor_states_in_rect(self, rect):
+        return [actor.get_state() for actor in self.find_actors_in_rect(rect)]
+
+    def close(self):
+        pass
+
     def spawn_hero(self):
         pad = 64.
 
@@ -105,18 +460,108 @@ class World(object):
         return self.actor_id_generator
 
     def update(self, frame_time):
+        self.time += frame_time
+        self.tick_count += 1
+
+        # reclaim slots left by dead actors while nobody is iterating
+        if self.actors.get_hole_count() > len(self.actors):
+            old_slot_by_id = self.actors.slot_by_id
+            self.actors.compact()
+            self.sent_values.move_rows(
+                old_slot_by_id, self.actors.slot_by_id)
+
+        # heroes and non-heroes can only see each other in contested cells
+        contested_cells = self.grid.find_contested_cells(self.max_threat_range)
+
+        self.acquire_targets(contested_cells)
+        awake_actors = self.think_actors(contested_cells)
+        self.move_actors(frame_time, awake_actors)
+
+    def think_actors(self, contested_cells):
+        """Let hot actors think every tick and cold ones every
+        cold_update_interval ticks, with a time step covering the ticks they
+        slept through. Hot actors have a target or share a contested cell
+        with one, so an enemy coming close or an attack (which makes the
+        victim target its attacker) wakes an actor on the next tick.
+
+        Returns (actor, time step) for every actor that thought.
+        """
+        now = self.time
+        actor_cells = self.grid.actor_cells
+        interval = self.cold_update_interval
+        phase = self.tick_count % interval
+
+        awake_actors = []
         for actor in self.actors:
+            if not actor.is_alive():
+                continue
+
+            # cold actors are spread over the interval by id
+            if (actor.target_id or
+                actor_cells.get(actor) in contested_cells or
+                actor.actor_id % interval == phase):
+                time_step = now - actor.last_think_time
+                actor.last_think_time = now
+                actor.think(time_step)
+                awake_actors.append((actor, time_step))
+
+        self.awake_count = len(awake_actors)
+        return awake_actors
+
+    def acquire_targets(self, contested_cells):
+        # hand out targets to every idle actor in one pass. Only contested
+        # cells can hold a match, and actors sharing a cell share the
+        # candidate gathering.
+        grid = self.grid
+
+        for cell in contested_cells:
+            seekers = [
+                actor for actor in grid.cells[cell]
+                if actor.is_seeking_target()]
+            if not seekers:
+                continue
+
+            search_radius = max(actor.threat_range for actor in seekers)
+            candidates = [
+                actor for actor in
+                grid.find_candidates_near_cell(cell, search_radius)
+                if actor.is_alive()]
+
+            self.assign_targets(seekers, candidates)
+
+    def assign_targets(self, seekers, candidates):
+        heroes = [actor for actor in candidates if actor.is_hero]
+        non_heroes = [actor for actor in candidates if not actor.is_hero]
+
+        for seeker in seekers:
+            enemies = non_heroes if seeker.is_hero else heroes
+            pos = seeker.pos
+            threat_range = seeker.threat_range
+            nearby_enemies = [
+                enemy for enemy in enemies
+                if pos.get_distance(enemy.pos) - enemy.radius < threat_range]
+            if nearby_enemies:
+                seeker.set_target(random.choice(nearby_enemies))
+
+    def move_actors(self, frame_time, awake_actors):
+        # actors move by the same time step they thought with
+        for actor, time_step in awake_actors:
             if actor.is_alive():
-                actor.think(frame_time)
+                actor.move(time_step)
 
     def find_actor_by_id(self, actor_id):
-        for actor in self.actors:
-            if actor.actor_id == actor_id:
-                return actor
-        return None
+        return self.actors.get(actor_id)
+
+    def find_actors_in_rect(self, rect):
+        left, top, right, bottom = rect.left, rect.top, rect.right, rect.bottom
+        for actor in self.grid.find_candidates_in_rect(
+                left, top, right, bottom):
+            pos = actor.pos
+            if left <= pos.x < right and top <= pos.y < bottom:
+                yield actor
 
     def find_nearby_actors(self, pos, search_radius):
-        for actor in self.actors:
+        for actor in self.grid.find_candidates(pos, search_radius):
             if (actor.is_alive() and
                 pos.get_distance(actor.pos) - actor.radius < search_radius):
                 yield actor
@@ -127,10 +572,19 @@ class World(object):
     def on_actor_died(self, actor):
         LOG.info('Actor %d died', actor.actor_id)
         self.event_distributor.post(ActorDiedEvent(actor.actor_id))
-        self.actors.remove(actor)
+        self.remove_actor(actor)
         #self.scheduler.post(
         #    functools.partial(self.actors.remove, actor), 30)
 
+    def on_actor_moved(self, actor):
+        self.grid.update(actor)
+
+    def on_actor_changed(self, actor):
+        # removed actors, like the bodies the client keeps around, may still
+        # change but are not sent any more
+        if self.track_changes and actor in self.actors:
+            self.changed_actors[actor.actor_id] = actor
+
     def on_attack(self, attacker, victim, damage):
         self.event_distributor.post(
             AttackEvent(attacker.actor_id, victim.actor_id, damage))
@@ -157,6 +611,13 @@ class World(object):
 
 
 class Actor(object):
+    __slots__ = (
+        'actor_id', 'actor_type', 'is_hero', 'speed', 'radius',
+        'attack_range', 'threat_range', 'damage_range', 'max_health',
+        'health', 'health_regen', 'wander_radius', 'miss_rate', 'loot_value',
+        'wander_timer', 'attack_timer', 'regen_timer', 'pos', 'world',
+        'last_think_time', 'target_id', 'move_dest', 'changed_mask')
+
     @classmethod
     def from_state(cls, state, world):
         actor = cls(
@@ -259,6 +720,13 @@ class Actor(object):
 
         self.world = world
 
+        # world time of the last think, cold actors skip ticks
+        self.last_think_time = 0.
+
+        # ActorDelta.FIELD_MASKS of the fields written since the last
+        # take_delta, the world keeps the values they went out with
+        self.changed_mask = 0
+
         self.target_id = None
 
         self.move_dest = vec2(0, 0)
@@ -266,53 +734,65 @@ class Actor(object):
         self.set_random_destination()
 
     def get_state(self):
-        return ObjectState('actor', {
-            'actor_id': self.actor_id,
-            'actor_type': self.actor_type,
-            'is_hero': self.is_hero,
-            'speed': self.speed,
-            'radius': self.radius,
-            'attack_range': self.attack_range,
-            'threat_range': self.threat_range,
-            'damage_range': self.damage_range,
-            'max_health': self.max_health,
-            'health': self.health,
-            'health_regen': self.health_regen,
-            'wander_radius': self.wander_radius,
-            'miss_rate': self.miss_rate,
-            'loot_value': self.loot_value,
-            'wander_timer': self.wander_timer,
-            'attack_timer': self.attack_timer,
-            'regen_timer': self.regen_timer,
-            'pos': vec2(self.pos.x, self.pos.y),
-            'target_id': self.target_id,
-            'move_dest': self.move_dest
-        })
+        # in ActorState.FIELDS order
+        pos = self.pos
+        return ActorState(
+            self.actor_id, self.actor_type, self.is_hero, self.speed,
+            self.radius, self.attack_range, self.threat_range,
+            self.damage_range, self.max_health, self.health,
+            self.health_regen, self.wander_radius, self.miss_rate,
+            self.loot_value, self.wander_timer, self.attack_timer,
+            self.regen_timer, vec2(pos.x, pos.y), self.target_id,
+            self.move_dest)
 
     def update_state(self, state):
         assert state.object_type == 'actor'
         for key, value in state.items():
             setattr(self, key, value)
+        if self.world:
+            self.world.on_actor_moved(self)
+
+    def apply_delta(self, delta):
+        for key, value in delta.changes.items():
+            setattr(self, key, value)
+        if self.world:
+            self.world.on_actor_moved(self)
+
+    def mark_changed(self, name):
+        self.changed_mask |= ActorDelta.FIELD_MASKS[name]
+        if self.world:
+            self.world.on_actor_changed(self)
+
+    def take_delta(self, sent_values, slot):
+        """Return an ActorDelta of the fields written since the last call
+        that differ from the values they went out with, as kept in the row
+        of slot in sent_values, or None.
+        """
+        changed_mask = self.changed_mask
+        if not changed_mask:
+            return None
+        self.changed_mask = 0
+
+        changes = sent_values.update(slot, self, changed_mask)
+        if changes:
+            return ActorDelta(self.actor_id, changes)
+        return None
 
     def set_destination(self, pos, timeout=30):
         self.wander_timer.reset(timeout)
         self.move_dest = pos
+        self.mark_changed('move_dest')
 
     def set_random_destination(self):
         angle = random.random() * 2. * math.pi
         dx = math.cos(angle) * self.wander_radius
         dy = math.sin(angle) * self.wander_radius
         self.move_dest = self.pos + vec2(dx, dy)
+        self.mark_changed('move_dest')
 
-    def attack_or_wander(self):
-        if self.health > self.max_health / 2:
-            nearby_enemies = list(self.find_nearby_enemies())
-            if len(nearby_enemies) > 0:
-                self.set_target(random.choice(nearby_enemies))
-            else:
-                self.wander()
-        else:
-            self.wander()
+    def is_seeking_target(self):
+        return (not self.target_id and self.is_alive() and
+                self.health > self.max_health / 2)
 
     def find_nearby_enemies(self):
         for actor in self.world.find_nearby_actors(self.pos, self.threat_range):
@@ -324,6 +804,7 @@ class Actor(object):
 
     def take_damage(self, damage, attacker=None):
         self.health -= damage
+        self.mark_changed('health')
 
         if self.is_dead():
             self.world.on_actor_died(self)
@@ -339,11 +820,13 @@ class Actor(object):
             self.target_id = target.actor_id
         else:
             self.target_id = None
+        self.mark_changed('target_id')
 
         self.world.on_set_target(self, target)
 
     def reward(self, loot):
         self.loot_value += loot
+        self.mark_changed('loot_value')
         self.world.on_loot(self, loot)
 
     def shoot_at_target(self):
@@ -380,11 +863,16 @@ class Actor(object):
                 self.set_random_destination()
 
     def think(self, frame_time):
-        # update timers
+        self.update_timers(frame_time)
+        self.update_target()
+        self.regenerate()
+
+    def update_timers(self, frame_time):
         self.wander_timer.update(frame_time)
         self.attack_timer.update(frame_time)
         self.regen_timer.update(frame_time)
 
+    def update_target(self):
         # move to or attack target, if any
         if self.target_id:
             target = self.world.find_actor_by_id(self.target_id)
@@ -399,13 +887,17 @@ class Actor(object):
 
                 elif self.is_in_range(target, self.attack_range):
                     self.move_dest = self.pos
+                    self.mark_changed('move_dest')
                     self.shoot_at_target()
 
                 else:
                     self.move_dest = target.pos
+                    self.mark_changed('move_dest')
         else:
-            self.attack_or_wander()
+            # targets are handed out by World.acquire_targets
+            self.wander()
 
+    def regenerate(self):
         # heal actor
         if self.regen_timer.is_expired_then_reset() and not self.target_id:
             if self.health < self.max_health:
@@ -414,10 +906,9 @@ class Actor(object):
                 self.health += heal
 
                 if heal:
+                    self.mark_changed('health')
                     self.world.on_heal(self, heal)
 
-        self.move(frame_time)
-
     def move(self, frame_time):
         # move actor
         delta = self.move_dest - self.pos
@@ -425,3 +916,7 @@ class Actor(object):
         time = min(self.speed * frame_time, distance)
         movement = time * delta
         self.pos += time * delta
+        if self.world:
+            self.world.on_actor_moved(self)
+            if time:
+                self.mark_changed('pos')
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import asyncio
 import time
 import logging
 import logging.config
@@ -7,9 +8,13 @@ import functools
 
 from thirdparty.vec2 import vec2
 
+from mm.common.codec import EventCodec
+from mm.common.compression import Compression, load_dictionary
 from mm.common.networking import Server, DEFAULT_NETWORK_PORT
 from mm.common.config import Config
-from mm.common.scheduling import Scheduler
+from mm.common.interest import InterestManager
+from mm.common.metrics import TickMetrics
+from mm.common.scheduling import Scheduler, FixedTimestep
 from mm.common.world import World, ActorStore
 from mm.common.events import *
 
@@ -20,11 +25,136 @@ def event_debug_printer(event):
     LOG.info('event: ' + str(event))
 
 
+class ServerLoop(object):
+    def __init__(self, event_distributor, scheduler, server, world, interest,
+                 timestep, stats_interval, metrics=None):
+        self.event_distributor = event_distributor
+        self.scheduler = scheduler
+        self.server = server
+        self.world = world
+        self.interest = interest
+        self.timestep = timestep
+        self.stats_interval = stats_interval
+        self.metrics = metrics
+
+        self.last_overrun_count = 0
+        self.next_stats_time = None
+
+    def run(self):
+        LOG.info('Starting server')
+        self.server.start_server()
+
+        LOG.info('Entering main loop')
+        self.start()
+
+        while True:
+            # sleep until the next tick is due
+            num_ticks = self.timestep.wait()
+
+            metrics = self.metrics
+            if metrics:
+                metrics.start_tick()
+
+            # read data from clients
+            self.server.read_from_clients()
+            if metrics:
+                metrics.end_phase('read')
+
+            # accept new clients
+            self.server.accept_pending_clients()
+            if metrics:
+                metrics.end_phase('accept')
+
+            self.tick(num_ticks)
+
+    async def run_async(self):
+        LOG.info('Starting server')
+        await self.server.start_server()
+
+        # the event loop reads and accepts clients between ticks
+        LOG.info('Entering main loop')
+        self.start()
+
+        tick_task = asyncio.create_task(self.tick_forever())
+        try:
+            await tick_task
+        finally:
+            self.server.stop_server()
+
+    async def tick_forever(self):
+        while True:
+            num_ticks = await self.timestep.wait_async()
+            # reads and accepts happen in between, outside of the tick
+            if self.metrics:
+                self.metrics.start_tick()
+            self.tick(num_ticks)
+
+    def start(self):
+        self.next_stats_time = time.monotonic() + self.stats_interval
+        self.timestep.start()
+
+    def tick(self, num_ticks):
+        frame_time = self.timestep.tick_time
+        metrics = self.metrics
+
+        # catch up on missed ticks with fixed steps
+        for _ in range(num_ticks):
+            # update timers
+            self.scheduler.update(frame_time)
+            if metrics:
+                metrics.end_phase('scheduler')
+
+            # update world
+            self.world.update(frame_time)
+            if metrics:
+                metrics.end_phase('world')
+
+            # distribute posted events
+            self.event_distributor.update()
+            if metrics:
+                metrics.end_phase('events')
+
+        # only the actors around each client are sent to it
+        self.interest.send_states(self.world.take_actor_deltas())
+        if metrics:
+            metrics.end_phase('states')
+
+        # send data to clients
+        self.server.write_to_clients()
+        if metrics:
+            metrics.end_phase('write')
+            metrics.end_tick(num_ticks)
+
+        if time.monotonic() >= self.next_stats_time:
+            self.next_stats_time += self.stats_interval
+            timestep = self.timestep
+            if timestep.overrun_count != self.last_overrun_count:
+                self.last_overrun_count = timestep.overrun_count
+                LOG.warning(
+                    'Tick overruns: %(overrun_count)d, dropped ticks: '
+                    '%(dropped_tick_count)d, max lateness: '
+                    '%(max_lateness).3f s', timestep.get_stats())
+
+            client_stats = self.server.get_client_stats()
+            for client_id, stats in sorted(client_stats.items()):
+                if stats['queued_events'] or stats['dropped_states']:
+                    LOG.info(
+                        'Client %d: %d queued events, %d queued bytes, '
+                        '%d dropped states', client_id, stats['queued_events'],
+                        stats['queued_bytes'], stats['dropped_states'])
+
+            if metrics:
+                metrics.write_report()
+
+
 class ServerEventHandler(object):
-    def __init__(self, event_distributor, server, world):
+    def __init__(self, event_distributor, server, world, interest,
+                 snapshots=None):
         self.event_distributor = event_distributor
         self.server = server
         self.world = world
+        self.interest = interest
+        self.snapshots = snapshots
 
     def on_player_spawn_mob(self, event):
         LOG.info('Player spawning mob %s at %r', event.actor_type, event.pos)
@@ -32,22 +162,38 @@ class ServerEventHandler(object):
 
     def on_client_event(self, event):
         LOG.info('Client %d sent event %s', event.client_id, type(event.event))
-        self.event_distributor.send(event.event)
+        client_event = event.event
+        if isinstance(client_event, SetViewportEvent):
+            self.interest.set_viewport(
+                event.client_id, client_event.x, client_event.y,
+                client_event.width, client_event.height)
+        else:
+            self.event_distributor.send(client_event)
 
     def on_client_connected(self, event):
         enter_game_event = EnterGameEvent(
             self.world.width, self.world.height,
-            [actor.get_state() for actor in self.world.actors])
+            self.interest.add_client(event.client_id))
 
         self.server.send_event(event.client_id, enter_game_event)
 
+        if self.snapshots:
+            self.server.send_event(
+                event.client_id, self.snapshots.add_client(event.client_id))
+
     def on_client_disconnected(self, event):
         LOG.info('Client disconnected: %d' % (event.client_id,))
+        self.interest.remove_client(event.client_id)
+        if self.snapshots:
+            self.snapshots.remove_client(event.client_id)
 
 
 def main():
     logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
 
+    # startup may fail before any of these exist
+    server = snapshots = world = None
+
     try:
         config = Config()
         config.load('mm.conf')
@@ -65,14 +211,94 @@ def main():
         scheduler = Scheduler()
 
         LOG.info('...initializing server')
-        server = Server(event_distributor, DEFAULT_NETWORK_PORT)
-        event_distributor.add_handler(
-            server.broadcast_event, ALL_GAME_EVENT_TYPES)
+        try:
+            transport = config.get('server', 'transport')
+        except KeyError:
+            transport = 'select'
+
+        if transport == 'asyncio':
+            from mm.common.async_networking import AsyncServer as server_class
+        else:
+            server_class = Server
+
+        try:
+            compression_min_size = int(
+                config.get('network', 'compression_min_size'))
+        except KeyError:
+            compression_min_size = Compression.DEFAULT_MIN_SIZE
+
+        try:
+            dictionary_filename = config.get(
+                'network', 'compression_dictionary')
+        except KeyError:
+            dictionary_filename = None
+
+        dictionary = None
+        if dictionary_filename:
+            LOG.info('...loading compression dictionary %s',
+                     dictionary_filename)
+            dictionary = load_dictionary(dictionary_filename)
+
+        LOG.info('...using %s transport', transport)
+        codec = EventCodec(actor_store)
+        server = server_class(
+            event_distributor, DEFAULT_NETWORK_PORT, codec,
+            Compression(compression_min_size, dictionary))
+
+        try:
+            snapshot_port = config.get('server', 'snapshot_port')
+        except KeyError:
+            snapshot_port = None
+
+        snapshots = None
+        if snapshot_port:
+            from mm.common.snapshots import SnapshotServer, create_server_socket
+            snapshot_port = int(snapshot_port)
+            LOG.info('...sending snapshots over UDP port %d', snapshot_port)
+            snapshots = SnapshotServer(
+                codec, create_server_socket(snapshot_port))
 
         LOG.info('...initializing world')
         width = 800
         height = 600
-        world = World(event_distributor, scheduler, actor_store, width, height)
+
+        try:
+            world_backend = config.get('world', 'backend')
+        except KeyError:
+            world_backend = 'python'
+
+        try:
+            cold_update_interval = int(
+                config.get('world', 'cold_update_interval'))
+        except KeyError:
+            cold_update_interval = World.COLD_UPDATE_INTERVAL
+
+        try:
+            num_regions = int(config.get('world', 'regions'))
+        except KeyError:
+            num_regions = 1
+
+        if num_regions != 1:
+            if world_backend != 'python':
+                LOG.warning(
+                    'Sharded worlds only support the python backend, '
+                    'ignoring %s', world_backend)
+            from mm.common.sharding import ShardedWorld
+            LOG.info('...sharding world across worker processes')
+            world = ShardedWorld(
+                event_distributor, scheduler, actor_store, width, height,
+                num_regions=num_regions,
+                cold_update_interval=cold_update_interval)
+        else:
+            if world_backend == 'numpy':
+                from mm.common.array_world import ArrayWorld as world_class
+            else:
+                world_class = World
+
+            LOG.info('...using %s world backend', world_backend)
+            world = world_class(
+                event_distributor, scheduler, actor_store, width, height,
+                cold_update_interval=cold_update_interval)
         world.spawn_actor('hero', vec2(300, 200))
         world.spawn_actor('hero', vec2(310, 210))
         world.spawn_actor('hero', vec2(320, 220))
@@ -83,8 +309,20 @@ def main():
         world.spawn_actor('creep', vec2(420, 320))
         world.spawn_actor('supercreep', vec2(400, 300))
 
+        LOG.info('...initializing interest management')
+        try:
+            interest_margin = int(config.get('server', 'interest_margin'))
+        except KeyError:
+            interest_margin = InterestManager.DEFAULT_MARGIN
+
+        interest = InterestManager(
+            server, world, interest_margin, snapshots=snapshots)
+        event_distributor.add_handler(
+            interest.on_game_event, ALL_GAME_EVENT_TYPES)
+
         LOG.info('...initializing server event handler')
-        event_handler = ServerEventHandler(event_distributor, server, world)
+        event_handler = ServerEventHandler(
+            event_distributor, server, world, interest, snapshots=snapshots)
         event_distributor.add_handler(
             event_handler.on_client_connected, ClientConnectedEvent)
         event_distributor.add_handler(
@@ -94,63 +332,50 @@ def main():
         event_distributor.add_handler(
             event_handler.on_player_spawn_mob, PlayerActionSpawnMobEvent)
 
-        LOG.info('Starting server')
-        server.start_server()
-
-        LOG.info('Entering main loop')
-
-        last_time = time.time()
-
-        last_state = []
-
-        while True:
-            current_time = time.time()
-            frame_time = current_time - last_time
-            last_time = current_time
-
-            # read data from clients
-            server.read_from_clients()
-
-            # accept new clients
-            server.accept_pending_clients()
-
-            # update timers
-            scheduler.update(frame_time)
-
-            # update world
-            world.update(frame_time)
-
-            # distribute posted events
-            event_distributor.update()
-
-            # compute delta event
-            new_state = [actor.get_state() for actor in world.actors]
-
-            if last_state:
-                delta_state = []
-                for actor_state in new_state:
-                    found = False
-                    for last_actor_state in last_state:
-                        if actor_state.actor_id == last_actor_state.actor_id:
-                            found = True
-                            for key, value in actor_state.items():
-                                if value != last_actor_state.get(key):
-                                    delta_state.append(actor_state)
-                                    break
-                            break
-                    if not found:
-                        delta_state.append(actor_state)
-            else:
-                delta_state = new_state
-
-            last_state = new_state
-
-            server.broadcast_event(DeltaStateEvent(delta_state))
-
-            # send data to clients
-            server.write_to_clients()
-
-            time.sleep(0.1)
+        try:
+            tick_rate = float(config.get('server', 'tick_rate'))
+        except KeyError:
+            tick_rate = 10.
+
+        try:
+            max_catch_up_ticks = int(config.get('server', 'max_catch_up_ticks'))
+        except KeyError:
+            max_catch_up_ticks = 3
+
+        try:
+            stats_interval = float(config.get('server', 'stats_interval'))
+        except KeyError:
+            stats_interval = 10.
+
+        LOG.info(
+            'Tick rate %.2f Hz, catching up at most %d ticks', tick_rate,
+            max_catch_up_ticks)
+        timestep = FixedTimestep(tick_rate, max_catch_up_ticks)
+
+        try:
+            enable_metrics = config.get('server', 'metrics')
+        except KeyError:
+            enable_metrics = False
+
+        try:
+            metrics_filename = config.get('server', 'metrics_file')
+        except KeyError:
+            metrics_filename = None
+
+        metrics = None
+        if enable_metrics:
+            LOG.info('...recording tick metrics')
+            metrics = TickMetrics(server, world, metrics_filename)
+            event_distributor.add_handler(metrics.on_event, ALL_EVENT_TYPES)
+
+        server_loop = ServerLoop(
+            event_distributor, scheduler, server, world, interest, timestep,
+            stats_interval, metrics)
+
+        if transport == 'asyncio':
+            asyncio.run(server_loop.run_async())
+        else:
+            server_loop.run()
 
     except Exception:
         LOG.exception('Game crashed :-(')
@@ -159,8 +384,15 @@ def main():
 
     LOG.info('Shutting down game')
 
-    LOG.info('...stopping server')
-    server.stop_server()
+    if server:
+        LOG.info('...stopping server')
+        server.stop_server()
+    if snapshots:
+        snapshots.close()
+
+    if world:
+        LOG.info('...stopping world')
+        world.close()
 
 
 if __name__ == '__main__':